@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+"""Load test and benchmark for the SalaryHelper API.
+
+Many concurrent async clients run a weighted mix of scenarios, either
+against the app booted in-process (the default; a fresh SQLite database
+unless DATABASE_URL is set) or against a running server (``--url``).
+Throughput and latency percentiles per endpoint are written as JSON.
+
+    python scripts/benchmark.py --clients 50 --duration 30
+    python scripts/benchmark.py --url http://localhost:8000 --output result.json
+    python scripts/benchmark.py --mix post_message=3,get_conversation=1
+    python scripts/benchmark.py --baseline scripts/benchmark_baseline.json --threshold 0.25
+    python scripts/benchmark.py --smoke --url http://localhost:8000
+
+With ``--baseline`` the run fails (exit status 1) when an endpoint's p95
+latency grows, or the total throughput drops, by more than ``--threshold``
+of the baseline value, or when an endpoint starts returning errors. ``--save-baseline``
+records the run as the new baseline. Baselines only compare runs made on
+the same machine with the same target, clients and mix; against one that
+was not, regressions are still reported but the run does not fail. CI
+therefore records its baseline from the base branch on the same runner.
+
+``--smoke`` runs every scenario once and fails if any request does; it is
+what the deploy and demo scripts use.
+
+In-process runs share one event loop between the clients and the app, so
+they measure the application code rather than the HTTP server; they lift
+the per-user message rate limit, which a server under test (``--url``)
+needs started with ``MESSAGE_RATE_PER_MINUTE=0`` as well. Requires httpx.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "server")
+API_PREFIX = "/api/v1"
+SMS_CODE = "123456"
+# p95 changes smaller than this are noise, whatever the ratio
+MIN_LATENCY_DELTA_MS = 1.0
+
+MESSAGES = [
+    "公司拖欠了我三个月工资，应该怎么办？",
+    "没有签劳动合同可以要求双倍工资吗？",
+    "被辞退后经济补偿金怎么计算？",
+    "加班费的计算标准是什么？",
+    "申请劳动仲裁需要准备哪些材料？",
+]
+
+
+class RequestFailed(Exception):
+    def __init__(self, name: str, detail: str):
+        super().__init__(f"{name}: {detail}")
+        self.name = name
+
+
+class Recorder:
+    """Latency samples per endpoint; nothing is kept until ``start``."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.recording = False
+        self.started: Optional[float] = None
+
+    def start(self) -> None:
+        self.recording = True
+        self.started = time.perf_counter()
+
+    def add(self, name: str, seconds: float, ok: bool) -> None:
+        if not self.recording:
+            return
+        self.samples[name].append(seconds)
+        if not ok:
+            self.errors[name] += 1
+
+
+class VirtualUser:
+    """One logged-in client with a conversation of its own."""
+
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, phone: str, document_data: Dict[str, Any]):
+        self.client = client
+        self.recorder = recorder
+        self.phone = phone
+        self.document_data = document_data
+        self.headers: Dict[str, str] = {}
+        self.conversation_id: Optional[str] = None
+
+    async def call(self, name: str, method: str, path: str, **kwargs) -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, API_PREFIX + path, headers=self.headers, **kwargs)
+        except httpx.HTTPError as e:
+            self.recorder.add(name, time.perf_counter() - started, False)
+            raise RequestFailed(name, f"{type(e).__name__}: {e}")
+        ok = response.status_code < 400
+        self.recorder.add(name, time.perf_counter() - started, ok)
+        if not ok:
+            raise RequestFailed(name, f"HTTP {response.status_code} {response.text[:200]}")
+        return response.json()
+
+    async def setup(self) -> None:
+        await login(self)
+        await create_conversation(self)
+
+
+async def login(user: VirtualUser) -> None:
+    result = await user.call("login", "POST", "/auth/login", json={"phone": user.phone, "code": SMS_CODE})
+    user.headers = {"Authorization": f"Bearer {result['data']['token']}"}
+
+
+async def create_conversation(user: VirtualUser) -> None:
+    result = await user.call("create_conversation", "POST", "/conversations", json={"title": "benchmark"})
+    if user.conversation_id is None:
+        user.conversation_id = result["data"]["id"]
+
+
+async def post_message(user: VirtualUser) -> None:
+    await user.call(
+        "post_message", "POST", f"/conversations/{user.conversation_id}/messages",
+        json={"text": random.choice(MESSAGES)},
+    )
+
+
+async def list_conversations(user: VirtualUser) -> None:
+    await user.call("list_conversations", "GET", "/conversations")
+
+
+async def get_conversation(user: VirtualUser) -> None:
+    await user.call("get_conversation", "GET", f"/conversations/{user.conversation_id}")
+
+
+async def create_document(user: VirtualUser) -> None:
+    await user.call("create_document", "POST", "/documents", json=user.document_data)
+
+
+async def order(user: VirtualUser) -> None:
+    result = await user.call(
+        "order_create", "POST", "/orders/create",
+        json={"product_type": "consultation", "amount": 99.0, "payment_method": "wechat"},
+    )
+    await user.call("order_pay", "POST", f"/orders/{result['data']['order_id']}/pay")
+
+
+async def admin_stats(user: VirtualUser) -> None:
+    await user.call("admin_stats", "GET", "/admin/stats")
+
+
+# Scenario name -> (default weight, coroutine); a scenario may time several endpoints
+SCENARIOS = {
+    "login": (5, login),
+    "create_conversation": (5, create_conversation),
+    "post_message": (30, post_message),
+    "list_conversations": (15, list_conversations),
+    "get_conversation": (20, get_conversation),
+    "create_document": (10, create_document),
+    "order": (10, order),
+    "admin_stats": (5, admin_stats),
+}
+
+
+def parse_mix(spec: Optional[str]) -> Dict[str, float]:
+    """``post_message=3,order=1`` -> weights; unnamed scenarios are not run."""
+    if not spec:
+        return {name: weight for name, (weight, _) in SCENARIOS.items()}
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+        try:
+            mix[name] = float(weight) if weight else 1.0
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"bad weight for {name!r}: {weight!r}")
+        if mix[name] < 0:
+            raise argparse.ArgumentTypeError(f"bad weight for {name!r}: {weight!r}")
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("the mix needs at least one positive weight")
+    return mix
+
+
+async def document_data(user: VirtualUser) -> Dict[str, Any]:
+    """A create_document body for the first template, every field filled in."""
+    templates = await user.call("list_templates", "GET", "/templates")
+    template_id = templates["data"][0]["id"]
+    template = await user.call("get_template", "GET", f"/templates/{template_id}")
+    return {
+        "template_id": template_id,
+        "title": "压测文书",
+        "data": {field: f"测试{field}" for field in template["data"]["fields"]},
+    }
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    """Nearest-rank percentile of a sorted list."""
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(recorder: Recorder, elapsed: float) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    endpoints = {}
+    for name in sorted(recorder.samples):
+        ordered = sorted(recorder.samples[name])
+        endpoints[name] = {
+            "requests": len(ordered),
+            "errors": recorder.errors[name],
+            "rps": round(len(ordered) / elapsed, 2),
+            "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+            "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+            "p95_ms": round(percentile(ordered, 95) * 1000, 3),
+            "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+            "max_ms": round(ordered[-1] * 1000, 3),
+        }
+    requests = sum(e["requests"] for e in endpoints.values())
+    return {
+        "requests": requests,
+        "errors": sum(e["errors"] for e in endpoints.values()),
+        "rps": round(requests / elapsed, 2) if elapsed else 0.0,
+        "elapsed_s": round(elapsed, 3),
+    }, endpoints
+
+
+async def run_user(user: VirtualUser, mix: Dict[str, float], deadline: float, failures: Dict[str, str]) -> None:
+    names = [name for name, weight in mix.items() if weight > 0]
+    weights = [mix[name] for name in names]
+    while time.perf_counter() < deadline:
+        name = random.choices(names, weights)[0]
+        try:
+            await SCENARIOS[name][1](user)
+        except RequestFailed as e:
+            # Keep one example per endpoint for the report
+            failures.setdefault(e.name, str(e))
+
+
+async def benchmark(client: httpx.AsyncClient, args) -> Dict[str, Any]:
+    recorder = Recorder()
+    users = [
+        VirtualUser(client, recorder, f"{args.phone_prefix}{i:05d}", {})
+        for i in range(args.clients)
+    ]
+    # Setup requests (login, a conversation per user) are not measured
+    semaphore = asyncio.Semaphore(50)
+
+    async def setup(user):
+        async with semaphore:
+            await user.setup()
+
+    await asyncio.gather(*(setup(user) for user in users))
+    data = await document_data(users[0])
+    for user in users:
+        user.document_data = data
+
+    failures: Dict[str, str] = {}
+    loop_started = time.perf_counter()
+    deadline = loop_started + args.warmup + args.duration
+    tasks = [asyncio.create_task(run_user(user, args.mix, deadline, failures)) for user in users]
+    await asyncio.sleep(args.warmup)
+    recorder.start()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - recorder.started
+
+    total, endpoints = summarize(recorder, elapsed)
+    return {
+        "meta": {
+            "target": args.url or "in-process",
+            "clients": args.clients,
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "mix": args.mix,
+            "started_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "python": platform.python_version(),
+            "machine": platform.node(),
+        },
+        "total": total,
+        "endpoints": endpoints,
+        "failures": failures,
+    }
+
+
+async def smoke(client: httpx.AsyncClient, args) -> bool:
+    recorder = Recorder()
+    recorder.start()
+    user = VirtualUser(client, recorder, f"{args.phone_prefix}00000", {})
+    steps = [("health", None)] + [(name, fn) for name, (_, fn) in SCENARIOS.items()]
+    ok = True
+    for name, fn in steps:
+        try:
+            if fn is None:
+                await user.call("health", "GET", "/health")
+            else:
+                if name == "create_document" and not user.document_data:
+                    user.document_data = await document_data(user)
+                await fn(user)
+                if name == "login":
+                    await create_conversation(user)
+            print(f"✓ {name}")
+        except (RequestFailed, KeyError, IndexError, ValueError) as e:
+            print(f"✗ {name}: {e}")
+            ok = False
+            if user.conversation_id is None and name in ("health", "login"):
+                break
+    return ok
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Regressions of ``result`` against ``baseline``, as readable lines."""
+    regressions = []
+    for name, base in baseline["endpoints"].items():
+        current = result["endpoints"].get(name)
+        if current is None:
+            continue
+        if (current["p95_ms"] > base["p95_ms"] * (1 + threshold)
+                and current["p95_ms"] - base["p95_ms"] >= MIN_LATENCY_DELTA_MS):
+            regressions.append(f"{name}: p95 {base['p95_ms']}ms -> {current['p95_ms']}ms")
+        if current["errors"] and not base["errors"]:
+            regressions.append(f"{name}: {current['errors']} errors (baseline had none)")
+    # The random mix makes per-endpoint throughput too noisy to compare
+    if result["total"]["rps"] < baseline["total"]["rps"] * (1 - threshold):
+        regressions.append(f"total: throughput {baseline['total']['rps']}/s -> {result['total']['rps']}/s")
+    return regressions
+
+
+def print_report(result: Dict[str, Any]) -> None:
+    out = sys.stderr
+    total = result["total"]
+    print(
+        f"\n{total['requests']} requests in {total['elapsed_s']}s, "
+        f"{total['rps']}/s, {total['errors']} errors ({result['meta']['clients']} clients)",
+        file=out,
+    )
+    print(f"{'endpoint':<22}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}", file=out)
+    for name, e in result["endpoints"].items():
+        print(
+            f"{name:<22}{e['rps']:>10}{e['p50_ms']:>10}{e['p95_ms']:>10}{e['p99_ms']:>10}{e['errors']:>8}",
+            file=out,
+        )
+    for name, failure in result["failures"].items():
+        print(f"first failure: {failure}", file=out)
+
+
+@asynccontextmanager
+async def open_client(url: Optional[str], connections: int, timeout: float):
+    """Client for ``url``, or for the app booted in-process (with its startup/shutdown) if None."""
+    if url:
+        app = None
+        transport = None
+        base_url = url.rstrip("/")
+    else:
+        sys.path.insert(0, os.path.abspath(SERVER_DIR))
+        if "DATABASE_URL" not in os.environ:
+            workdir = tempfile.mkdtemp(prefix="salaryhelper-bench-")
+            os.environ["DATABASE_URL"] = os.path.join(workdir, "benchmark.db")
+        # Virtual users post far faster than the per-user message rate allows people to
+        os.environ.setdefault("MESSAGE_RATE_PER_MINUTE", "0")
+        from app.main import app
+        transport = httpx.ASGITransport(app=app)
+        base_url = "http://benchmark"
+
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    async with httpx.AsyncClient(
+        transport=transport, base_url=base_url, limits=limits, timeout=timeout,
+    ) as client:
+        if app is None:
+            yield client
+        else:
+            async with app.router.lifespan_context(app):
+                yield client
+
+
+async def run(args) -> int:
+    async with open_client(args.url, args.clients, args.timeout) as client:
+        return await execute(client, args)
+
+
+async def execute(client: httpx.AsyncClient, args) -> int:
+    if args.smoke:
+        return 0 if await smoke(client, args) else 1
+
+    result = await benchmark(client, args)
+    status = 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        comparable = True
+        for key in ("target", "clients", "mix", "machine"):
+            if baseline["meta"].get(key) != result["meta"][key]:
+                print(f"warning: baseline was recorded with a different {key}", file=sys.stderr)
+                comparable = False
+        regressions = compare(result, baseline, args.threshold)
+        result["regressions"] = regressions
+        if regressions and comparable:
+            status = 1
+        elif regressions:
+            print("warning: baseline is not comparable; regressions do not fail the run", file=sys.stderr)
+    print_report(result)
+    for line in result.get("regressions", []):
+        print(f"REGRESSION {line}", file=sys.stderr)
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    return status
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="SalaryHelper API load test and benchmark")
+    parser.add_argument("--url", help="server to test, e.g. http://localhost:8000 (default: boot the app in-process)")
+    parser.add_argument("--clients", type=int, default=20, help="concurrent clients (default 20)")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds (default 10)")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds before measuring (default 2)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(None),
+                        help=f"scenario weights, e.g. post_message=3,order=1; scenarios: {', '.join(SCENARIOS)}")
+    parser.add_argument("--timeout", type=float, default=30.0, help="per-request timeout in seconds")
+    parser.add_argument("--phone-prefix", default="139000",
+                        help="phone numbers of the test users are this plus five digits")
+    parser.add_argument("--seed", type=int, help="random seed for the scenario choice")
+    parser.add_argument("--output", help="write the JSON result here instead of stdout")
+    parser.add_argument("--baseline", help="compare against this result file and fail on regressions")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed relative regression against the baseline (default 0.25)")
+    parser.add_argument("--save-baseline", metavar="PATH", help="also write the result here as the new baseline")
+    parser.add_argument("--smoke", action="store_true", help="run every scenario once and check it succeeds")
+    args = parser.parse_args(argv)
+    if args.clients < 1 or args.duration <= 0 or args.warmup < 0:
+        parser.error("--clients and --duration must be positive")
+    if len(args.phone_prefix) + 5 != 11:
+        parser.error("--phone-prefix must have 6 digits")
+    if args.seed is not None:
+        random.seed(args.seed)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -139,8 +139,8 @@ health_check() {
 smoke_test() {
     echo "运行烟雾测试..."
     
-    if [ -f "test_api.py" ]; then
-        python test_api.py --env=production || echo "警告: 烟雾测试失败"
+    if [ -f "scripts/benchmark.py" ]; then
+        python scripts/benchmark.py --smoke --url https://api.salaryhelper.com || echo "警告: 烟雾测试失败"
     fi
     
     echo "✓ 烟雾测试完成"
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""Local payment provider stub that replays notification storms.
+
+Creates ``--orders`` orders (each request sent twice with the same
+Idempotency-Key, as a retrying client would), then delivers every order's
+payment notification ``--duplicates`` times, shuffled, from
+``--concurrency`` concurrent senders, alternating WeChat Pay and Alipay
+bodies signed with the shared secret. It then checks that every order was
+paid exactly once, with the notified transaction id, and that the paid
+order counter grew by exactly the number of orders. Acknowledgement
+latency percentiles are printed as JSON; the exit status is 1 if any check
+failed.
+
+    python scripts/payment_notify_stub.py --orders 500 --duplicates 5
+    python scripts/payment_notify_stub.py --url http://localhost:8000 --secret "$PAYMENT_NOTIFY_SECRET"
+
+Without ``--url`` the app is booted in-process (see benchmark.py). Against
+a shared server, other traffic paying orders at the same time makes the
+counter check fail.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from typing import Any, Dict, List, Tuple
+from urllib.parse import urlencode
+
+from benchmark import API_PREFIX, SMS_CODE, open_client, percentile
+
+PROVIDERS = ("wechat", "alipay")
+
+
+def notification(provider: str, order: Dict[str, Any], transaction_id: str) -> Tuple[bytes, str]:
+    """(body, content type) of a successful-payment notification."""
+    if provider == "wechat":
+        body = json.dumps({
+            "transaction_id": transaction_id,
+            "out_trade_no": order["order_id"],
+            "trade_state": "SUCCESS",
+            "amount": {"total": round(order["amount"] * 100), "currency": "CNY"},
+        })
+        return body.encode("utf-8"), "application/json"
+    body = urlencode({
+        "trade_no": transaction_id,
+        "out_trade_no": order["order_id"],
+        "trade_status": "TRADE_SUCCESS",
+        "total_amount": f"{order['amount']:.2f}",
+    })
+    return body.encode("utf-8"), "application/x-www-form-urlencoded"
+
+
+def acknowledged(provider: str, response) -> bool:
+    if response.status_code != 200:
+        return False
+    if provider == "wechat":
+        return response.json().get("code") == "SUCCESS"
+    return response.text == "success"
+
+
+async def storm(client, args) -> Dict[str, Any]:
+    login = await client.post(f"{API_PREFIX}/auth/login", json={"phone": args.phone, "code": SMS_CODE})
+    login.raise_for_status()
+    headers = {"Authorization": f"Bearer {login.json()['data']['token']}"}
+
+    async def paid_orders() -> int:
+        response = await client.get(f"{API_PREFIX}/admin/stats", headers=headers)
+        response.raise_for_status()
+        return response.json()["data"]["paid_orders"]
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    problems: List[str] = []
+
+    async def create_order(i: int) -> Dict[str, Any]:
+        body = {"product_type": "consultation", "amount": round(9.9 + i % 90, 2), "payment_method": "wechat"}
+        key = {**headers, "Idempotency-Key": uuid.uuid4().hex}
+        async with semaphore:
+            first = await client.post(f"{API_PREFIX}/orders/create", json=body, headers=key)
+            retry = await client.post(f"{API_PREFIX}/orders/create", json=body, headers=key)
+        first.raise_for_status()
+        retry.raise_for_status()
+        order = first.json()["data"]
+        if retry.json()["data"]["order_id"] != order["order_id"]:
+            problems.append(f"idempotent retry created a second order for {order['order_id']}")
+        return order
+
+    before = await paid_orders()
+    orders = await asyncio.gather(*(create_order(i) for i in range(args.orders)))
+
+    expected = {}
+    deliveries = []
+    for i, order in enumerate(orders):
+        provider = PROVIDERS[i % len(PROVIDERS)]
+        transaction_id = f"{provider.upper()}-{uuid.uuid4().hex[:20]}"
+        expected[order["order_id"]] = transaction_id
+        deliveries += [(provider, *notification(provider, order, transaction_id))] * args.duplicates
+    random.shuffle(deliveries)
+
+    latencies: List[float] = []
+    failed = 0
+
+    async def deliver(provider: str, body: bytes, content_type: str) -> None:
+        nonlocal failed
+        signature = hmac.new(args.secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post(
+                f"{API_PREFIX}/payments/notify/{provider}", content=body,
+                headers={"Content-Type": content_type, "X-Notify-Signature": signature},
+            )
+            latencies.append(time.perf_counter() - started)
+        if not acknowledged(provider, response):
+            failed += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(deliver(*delivery) for delivery in deliveries))
+    elapsed = time.perf_counter() - started
+
+    async def check(order_id: str) -> None:
+        async with semaphore:
+            response = await client.get(f"{API_PREFIX}/orders/{order_id}", headers=headers)
+        order = response.json()["data"]
+        if order["status"] != "paid" or order["transaction_id"] != expected[order_id]:
+            problems.append(f"order {order_id}: {order['status']} {order['transaction_id']}")
+
+    await asyncio.gather(*(check(order_id) for order_id in expected))
+    delta = await paid_orders() - before
+    if delta != len(orders):
+        problems.append(f"paid_orders grew by {delta}, expected {len(orders)}")
+    if failed:
+        problems.append(f"{failed} notifications were not acknowledged")
+
+    ordered = sorted(latencies)
+    return {
+        "orders": len(orders),
+        "notifications": len(deliveries),
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(deliveries) / elapsed, 2),
+        "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+        "not_acknowledged": failed,
+        "paid_orders_delta": delta,
+        "problems": problems[:20],
+    }
+
+
+async def run(args) -> int:
+    async with open_client(args.url, args.concurrency, args.timeout) as client:
+        result = await storm(client, args)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 1 if result["problems"] else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Replay payment notification storms against the API")
+    parser.add_argument("--url", help="server to test (default: boot the app in-process)")
+    parser.add_argument("--secret", default=os.getenv("PAYMENT_NOTIFY_SECRET"),
+                        help="notification signing secret (default: $PAYMENT_NOTIFY_SECRET)")
+    parser.add_argument("--orders", type=int, default=200, help="orders to pay (default 200)")
+    parser.add_argument("--duplicates", type=int, default=3, help="deliveries of each notification (default 3)")
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent requests (default 50)")
+    parser.add_argument("--timeout", type=float, default=30.0, help="per-request timeout in seconds")
+    parser.add_argument("--phone", default="13900099999", help="phone number of the ordering user")
+    args = parser.parse_args(argv)
+    if args.orders < 1 or args.duplicates < 1 or args.concurrency < 1:
+        parser.error("--orders, --duplicates and --concurrency must be positive")
+    if not args.secret:
+        if args.url:
+            parser.error("--secret (or PAYMENT_NOTIFY_SECRET) is required with --url")
+        # The in-process app reads it at import
+        args.secret = os.environ["PAYMENT_NOTIFY_SECRET"] = uuid.uuid4().hex
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
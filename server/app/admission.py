@@ -0,0 +1,298 @@
+"""Admission control: decides, before the app sees a request, whether to
+handle it now, queue it or shed it.
+
+Every request except those on critical routes (health, metrics, payments)
+takes a slot of a global concurrency limit; a :class:`Rule` can add a
+concurrency limit of its own for a group of routes and a token bucket per
+user or per client IP. Users are told apart by the controller's
+``identify`` callable, which maps a bearer token to the user id if the
+token is valid; anonymous requests and invalid tokens share their client
+address's bucket, so made-up tokens cannot open fresh buckets. Requests over a concurrency limit wait in a FIFO
+queue for up to ``queue_timeout`` seconds; once ``max_queue`` are waiting,
+further ones are shed at once, so an overload turns into fast 503s instead
+of every endpoint's latency growing without bound. A request over its rate
+gets a 429. Both carry ``Retry-After``.
+
+Critical routes skip all of it, so a burst on other endpoints cannot make
+the health check time out or hold back payment notifications. Limits and
+buckets are per worker process; buckets are kept for the ``max_keys``
+most recently seen users or addresses.
+"""
+import asyncio
+import math
+import re
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+from starlette.responses import JSONResponse
+
+from . import metrics
+
+# What a Rule's token buckets are keyed by: the verified user (the client
+# address for anonymous requests) or the client address
+BY_USER = "user"
+BY_IP = "ip"
+
+# Why a request was shed
+RATE_LIMITED = "rate_limited"
+QUEUE_FULL = "queue_full"
+QUEUE_TIMEOUT = "queue_timeout"
+
+_PARAM = re.compile(r"\{[^}]+\}")
+
+
+class _Route(NamedTuple):
+    # Stands in for the matched route in the scope, for the latency histograms
+    path: str
+
+
+def _path_pattern(template: str):
+    parts = _PARAM.split(template)
+    return re.compile("^" + "[^/]+".join(re.escape(part) for part in parts) + "$")
+
+
+class ConcurrencyLimit:
+    """At most ``limit`` requests at once; up to ``max_queue`` more wait their turn."""
+
+    def __init__(self, name: str, limit: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._wait_histogram = metrics.ADMISSION_QUEUE_WAIT.labels(name)
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = {QUEUE_FULL: 0, QUEUE_TIMEOUT: 0}
+
+    async def acquire(self) -> Optional[str]:
+        """None once a slot is held (release it), otherwise why the request was shed."""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return None
+        if len(self._waiters) >= self.max_queue:
+            return self._reject(QUEUE_FULL)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait((waiter,), timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if waiter.done():
+                # The slot was handed over just as the request was cancelled
+                self.release()
+            else:
+                self._waiters.remove(waiter)
+                waiter.cancel()
+            raise
+        self._wait_histogram.observe(time.perf_counter() - started)
+        if not waiter.done():
+            self._waiters.remove(waiter)
+            waiter.cancel()
+            return self._reject(QUEUE_TIMEOUT)
+        self.admitted += 1
+        return None
+
+    def release(self) -> None:
+        # Hand the slot straight to the next waiter, so a newcomer cannot overtake the queue
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def _reject(self, reason: str) -> str:
+        self.rejected[reason] += 1
+        metrics.ADMISSION_REJECTED.labels(self.name, reason).inc()
+        return reason
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "max_queue": self.max_queue,
+            "queue_timeout_ms": round(self.queue_timeout * 1000, 3),
+            "active": self.active,
+            "waiting": len(self._waiters),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": dict(self.rejected),
+        }
+
+
+class TokenBuckets:
+    """A token bucket of ``burst`` tokens refilled at ``rate`` per second, per key."""
+
+    def __init__(self, name: str, rate: float, burst: int, max_keys: int = 100000):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> (tokens, updated); insertion order is recency of use
+        self._buckets: Dict[Any, Tuple[float, float]] = {}
+        self.limited = 0
+
+    def take(self, key) -> float:
+        """Take a token for ``key``: 0 if there was one, otherwise seconds until there is."""
+        now = time.monotonic()
+        bucket = self._buckets.pop(key, None)
+        tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+            self.limited += 1
+            metrics.ADMISSION_REJECTED.labels(self.name, RATE_LIMITED).inc()
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            # Least recently used; a bucket idle for burst / rate seconds is full anyway
+            del self._buckets[next(iter(self._buckets))]
+        return wait
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rate_per_second": self.rate,
+            "burst": self.burst,
+            "keys": len(self._buckets),
+            "rate_limited": self.limited,
+        }
+
+
+class Rule:
+    """Limits shared by a group of routes, given as ``(method, path template)``.
+
+    ``critical`` routes are always admitted straight away. ``rate`` is in
+    requests per second; 0 disables the bucket, as ``concurrency=0`` does
+    the concurrency limit (``queue`` defaults to twice the limit).
+    """
+
+    def __init__(
+        self, name: str, routes: List[Tuple[str, str]], *, critical: bool = False,
+        concurrency: int = 0, queue: Optional[int] = None, queue_timeout: float = 2.0,
+        rate: float = 0.0, burst: int = 1, key: str = BY_USER,
+    ):
+        self.name = name
+        self.routes = routes
+        self.critical = critical
+        self.key = key
+        self.limit = None
+        if concurrency > 0:
+            self.limit = ConcurrencyLimit(
+                name, concurrency, concurrency * 2 if queue is None else queue, queue_timeout,
+            )
+        self.buckets = TokenBuckets(name, rate, max(1, burst)) if rate > 0 else None
+        self.critical_requests = 0
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {"routes": [f"{method} {path}" for method, path in self.routes]}
+        if self.critical:
+            stats["critical_requests"] = self.critical_requests
+        if self.limit is not None:
+            stats["concurrency"] = self.limit.stats()
+        if self.buckets is not None:
+            stats["rate"] = self.buckets.stats()
+        return stats
+
+
+class AdmissionController:
+    def __init__(
+        self, rules: List[Rule], max_concurrency: int, max_queue: int, queue_timeout: float,
+        retry_after: int = 1, identify: Optional[Callable[[str], Optional[str]]] = None,
+    ):
+        self.rules = rules
+        self.limit = ConcurrencyLimit("global", max_concurrency, max_queue, queue_timeout)
+        self.retry_after = retry_after
+        # Bearer token -> user id, or None if it does not verify
+        self.identify = identify
+        self._exact: Dict[Tuple[str, str], Tuple[Rule, _Route]] = {}
+        self._patterns: List[Tuple[str, Any, Rule, _Route]] = []
+        for rule in rules:
+            for method, path in rule.routes:
+                if "{" in path:
+                    self._patterns.append((method, _path_pattern(path), rule, _Route(path)))
+                else:
+                    self._exact[(method, path)] = (rule, _Route(path))
+
+    def match(self, method: str, path: str) -> Optional[Tuple[Rule, _Route]]:
+        found = self._exact.get((method, path))
+        if found is not None:
+            return found
+        for rule_method, pattern, rule, route in self._patterns:
+            if rule_method == method and pattern.match(path):
+                return rule, route
+        return None
+
+    def client_key(self, scope, by: str):
+        if by == BY_USER and self.identify is not None:
+            for name, value in scope["headers"]:
+                if name == b"authorization":
+                    scheme, _, token = value.decode("latin-1").partition(" ")
+                    if scheme.lower() == "bearer" and token:
+                        user_id = self.identify(token)
+                        if user_id is not None:
+                            return (BY_USER, user_id)
+                    break
+        client = scope.get("client")
+        return client[0] if client else None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "global": self.limit.stats(),
+            "rules": {rule.name: rule.stats() for rule in self.rules},
+        }
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        controller = self.controller
+        matched = controller.match(scope["method"], scope["path"])
+        rule = None
+        if matched is not None:
+            rule, route = matched
+            if rule.critical:
+                rule.critical_requests += 1
+                await self.app(scope, receive, send)
+                return
+            # Requests shed here never reach the router
+            scope["route"] = route
+            if rule.buckets is not None:
+                wait = rule.buckets.take(controller.client_key(scope, rule.key))
+                if wait:
+                    await self._reject(scope, receive, send, 429, "请求过于频繁，请稍后重试", math.ceil(wait))
+                    return
+
+        route_limit = rule.limit if rule is not None else None
+        if route_limit is not None and await route_limit.acquire() is not None:
+            await self._reject(scope, receive, send, 503, "服务繁忙，请稍后重试", controller.retry_after)
+            return
+        try:
+            if await controller.limit.acquire() is not None:
+                await self._reject(scope, receive, send, 503, "服务繁忙，请稍后重试", controller.retry_after)
+                return
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                controller.limit.release()
+        finally:
+            if route_limit is not None:
+                route_limit.release()
+
+    async def _reject(self, scope, receive, send, status_code: int, detail: str, retry_after: int):
+        response = JSONResponse(
+            {"detail": detail}, status_code=status_code, headers={"Retry-After": str(retry_after)},
+        )
+        await response(scope, receive, send)
@@ -0,0 +1,65 @@
+"""Pluggable AI reply backends.
+
+Select one with ``AI_BACKEND``: a registered name (``stub``) or a
+``package.module:ClassName`` path to any :class:`AIBackend` subclass.
+"""
+import asyncio
+import importlib
+from typing import AsyncIterator, Dict, List, Sequence
+
+
+class AIBackend:
+    """Generates the assistant's reply to a user message, chunk by chunk."""
+
+    # How many recent messages of the conversation to pass as ``history``
+    history_size = 0
+
+    async def stream_reply(self, prompt: str, history: Sequence[Dict]) -> AsyncIterator[str]:
+        raise NotImplementedError
+        yield  # pragma: no cover - makes this an async generator
+
+    async def reply(self, prompt: str, history: Sequence[Dict]) -> str:
+        return "".join([chunk async for chunk in self.stream_reply(prompt, history)])
+
+
+class StubBackend(AIBackend):
+    """Deterministic local backend that echoes the message back, for demos and tests."""
+
+    def __init__(self, chunk_size: int = 4, delay: float = 0.0):
+        self.chunk_size = chunk_size
+        self.delay = delay
+
+    async def stream_reply(self, prompt: str, history: Sequence[Dict]) -> AsyncIterator[str]:
+        text = f"（模拟回复）已收到您的消息：{prompt}"
+        for start in range(0, len(text), self.chunk_size):
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            yield text[start:start + self.chunk_size]
+
+
+BACKENDS = {
+    "stub": StubBackend,
+}
+
+
+def create_backend(name: str) -> AIBackend:
+    if ":" in name:
+        module_name, attr = name.split(":", 1)
+        backend_cls = getattr(importlib.import_module(module_name), attr)
+    elif name in BACKENDS:
+        backend_cls = BACKENDS[name]
+    else:
+        raise ValueError(f"unknown AI backend {name!r}; expected one of {sorted(BACKENDS)} or module:Class")
+    return backend_cls()
+
+
+async def load_history(db, conversation_id: str, size: int) -> List[Dict]:
+    """The ``size`` most recent messages of a conversation, oldest first."""
+    if size <= 0:
+        return []
+    rows = await db.fetch_all(
+        "SELECT sender, content, created_at FROM messages WHERE conversation_id = ? "
+        "ORDER BY created_at DESC, id DESC LIMIT ?",
+        (conversation_id, size),
+    )
+    return rows[::-1]
@@ -0,0 +1,111 @@
+import asyncio
+import csv
+import io
+import json
+import uuid
+from itertools import islice
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from . import search
+from .template_engine import CompiledTemplate, TemplateError
+
+BULK_CHUNK_SIZE = 500
+
+_INSERT = (
+    "INSERT INTO documents (id, user_id, template_id, title, content, status) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+
+def render_chunk(
+    compiled: CompiledTemplate, rows: List[Dict[str, Any]]
+) -> List[Tuple[Optional[str], Optional[str]]]:
+    """(content, error) per row; runs on a render thread, off the event loop."""
+    results = []
+    for data in rows:
+        try:
+            results.append((compiled.render(data), None))
+        except TemplateError as e:
+            results.append((None, "; ".join(e.errors)))
+    return results
+
+
+def read_csv_rows(binary_file, max_rows: int) -> List[Dict[str, str]]:
+    """Parse an uploaded CSV (header row = field names) into row dicts; blocking."""
+    text = io.TextIOWrapper(binary_file, encoding="utf-8-sig", newline="")
+    try:
+        rows = []
+        for record in csv.DictReader(text):
+            if len(rows) >= max_rows:
+                raise ValueError(f"单次最多生成 {max_rows} 份文档")
+            # Short rows give None values; leave those fields out so they are reported missing
+            rows.append({k: v for k, v in record.items() if k is not None and v is not None})
+        return rows
+    except UnicodeDecodeError:
+        raise ValueError("CSV 文件必须是 UTF-8 编码")
+    finally:
+        text.detach()
+
+
+def _chunks(rows: Iterable[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    iterator = iter(rows)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+async def generate_documents(
+    db,
+    executor,
+    compiled: CompiledTemplate,
+    template_id: str,
+    title: str,
+    user_id: str,
+    rows: Iterable[Dict[str, Any]],
+    chunk_size: int = BULK_CHUNK_SIZE,
+) -> AsyncIterator[bytes]:
+    """Render and insert ``rows`` chunk by chunk, yielding NDJSON results as they commit.
+
+    Rendering of the next chunk overlaps with the insert of the current one
+    (SQLite releases the GIL while it writes); the render threads themselves
+    share the GIL, so they keep the event loop free rather than adding CPU.
+    Each chunk is inserted with one executemany in its own transaction, so
+    rows already reported as created stay created if the client goes away.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = _chunks(rows, chunk_size)
+    created = failed = 0
+    row_number = 0
+
+    chunk = next(chunks, None)
+    pending = loop.run_in_executor(executor, render_chunk, compiled, chunk) if chunk else None
+    while pending is not None:
+        rendered = await pending
+        chunk = next(chunks, None)
+        pending = loop.run_in_executor(executor, render_chunk, compiled, chunk) if chunk else None
+
+        lines, documents = [], []
+        for content, error in rendered:
+            row_number += 1
+            if error is not None:
+                failed += 1
+                lines.append({"row": row_number, "error": error})
+                continue
+            doc_id = str(uuid.uuid4())
+            documents.append((doc_id, user_id, template_id, title, content, "completed"))
+            lines.append({"row": row_number, "id": doc_id})
+
+        if documents:
+            async with db.transaction(immediate=True) as tx:
+                await tx.execute_many(_INSERT, documents)
+                await search.index(tx, "document", [
+                    (doc_id, user_id, search.document_text(title, content))
+                    for doc_id, _, _, title, content, _ in documents
+                ])
+            created += len(documents)
+        yield "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines).encode("utf-8")
+
+    summary = {"done": True, "created": created, "failed": failed}
+    yield (json.dumps(summary) + "\n").encode("utf-8")
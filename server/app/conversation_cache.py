@@ -0,0 +1,200 @@
+"""In-process cache of recent conversation tails for get_conversation.
+
+Each entry holds the conversation row (for the ownership check) and its
+last ``tail_size`` messages, oldest first. Messages are appended
+write-through once they are committed, so polling an active conversation
+with a cursor inside the tail, and opening it on its latest page, are
+served without touching the database.
+Entries are evicted least-recently-used once their estimated size exceeds
+``max_bytes``, and dropped ``ttl`` seconds after they were loaded if given
+(appends made through other processes are only seen on the next load).
+"""
+import bisect
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+MESSAGE_COLUMNS = ("id", "conversation_id", "sender", "sender_id", "content", "created_at")
+
+
+def _key(message: Dict[str, Any]) -> Tuple[str, str]:
+    return (str(message["created_at"]), message["id"])
+
+
+def _row_bytes(row: Dict[str, Any]) -> int:
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values())
+
+
+class ConversationTail:
+    __slots__ = ("conversation", "messages", "keys", "complete", "nbytes", "loaded_at")
+
+    def __init__(self, conversation: Dict[str, Any], messages: List[Dict[str, Any]], complete: bool):
+        self.conversation = conversation
+        self.messages = messages
+        self.keys = [_key(message) for message in messages]
+        # True when ``messages`` is the whole conversation, not just its tail
+        self.complete = complete
+        self.nbytes = _row_bytes(conversation) + sum(_row_bytes(message) for message in messages)
+        self.loaded_at = time.monotonic()
+
+    def page(self, after: Optional[Tuple[str, str]], limit: int) -> Optional[List[Dict[str, Any]]]:
+        """Up to ``limit`` messages after the cursor key, or None if the tail cannot tell."""
+        if after is None:
+            if not self.complete:
+                return None
+            return self.messages[:limit]
+        if not self.complete and (not self.keys or after < self.keys[0]):
+            return None
+        start = bisect.bisect_right(self.keys, after)
+        return self.messages[start:start + limit]
+
+    def before(self, key: Optional[Tuple[str, str]], limit: int) -> Optional[List[Dict[str, Any]]]:
+        """Up to ``limit`` messages just before the cursor key (the latest ones if None), oldest first."""
+        end = len(self.keys) if key is None else bisect.bisect_left(self.keys, key)
+        if end < limit and not self.complete:
+            return None
+        return self.messages[max(0, end - limit):end]
+
+    def recent(self, size: int) -> Optional[List[Dict[str, Any]]]:
+        """The ``size`` most recent messages, oldest first, if the tail has them."""
+        if size > len(self.messages) and not self.complete:
+            return None
+        return self.messages[-size:] if size else []
+
+
+# Loads (conversation or None, newest messages oldest first, complete) from the database
+Loader = Callable[[], Awaitable[Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]], bool]]]
+
+
+class ConversationCache:
+    def __init__(self, max_bytes: int, tail_size: int, ttl: Optional[float] = None):
+        self.max_bytes = max_bytes
+        self.tail_size = tail_size
+        self.ttl = ttl
+        self._data: "OrderedDict[str, ConversationTail]" = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        # Conversations being loaded, and those written to meanwhile
+        self._loading: Dict[str, int] = {}
+        self._stale = set()
+        self.hits = 0
+        self.misses = 0
+        # Hits whose request reached past the tail and went to the database anyway
+        self.fallbacks = 0
+        self.evictions = 0
+
+    def get(self, conversation_id: str) -> Optional[ConversationTail]:
+        with self._lock:
+            tail = self._data.get(conversation_id)
+            if tail is not None and self.ttl is not None and time.monotonic() - tail.loaded_at >= self.ttl:
+                del self._data[conversation_id]
+                self._nbytes -= tail.nbytes
+                tail = None
+            if tail is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(conversation_id)
+            self.hits += 1
+            return tail
+
+    async def load(self, conversation_id: str, loader: Loader) -> Optional[ConversationTail]:
+        """Read a tail with ``loader`` and cache it unless messages were appended meanwhile."""
+        with self._lock:
+            self._loading[conversation_id] = self._loading.get(conversation_id, 0) + 1
+        try:
+            conversation, messages, complete = await loader()
+        finally:
+            with self._lock:
+                stale = conversation_id in self._stale
+                remaining = self._loading[conversation_id] - 1
+                if remaining:
+                    self._loading[conversation_id] = remaining
+                else:
+                    del self._loading[conversation_id]
+                    self._stale.discard(conversation_id)
+        if conversation is None:
+            return None
+        tail = ConversationTail(conversation, messages, complete)
+        if not stale:
+            with self._lock:
+                self._store(conversation_id, tail)
+        return tail
+
+    def append(self, conversation_id: str, rows: Sequence[Sequence[Any]]) -> None:
+        """Write-through for committed message rows (``MESSAGE_COLUMNS`` order)."""
+        with self._lock:
+            if conversation_id in self._loading:
+                self._stale.add(conversation_id)
+            tail = self._data.get(conversation_id)
+            if tail is None:
+                return
+            for row in rows:
+                message = dict(zip(MESSAGE_COLUMNS, row))
+                key = _key(message)
+                # Concurrent requests may commit slightly out of timestamp order
+                index = bisect.bisect_right(tail.keys, key)
+                tail.keys.insert(index, key)
+                tail.messages.insert(index, message)
+                size = _row_bytes(message)
+                tail.nbytes += size
+                self._nbytes += size
+            while len(tail.messages) > self.tail_size:
+                size = _row_bytes(tail.messages.pop(0))
+                tail.keys.pop(0)
+                tail.complete = False
+                tail.nbytes -= size
+                self._nbytes -= size
+            self._evict()
+
+    def record_fallback(self) -> None:
+        with self._lock:
+            self.fallbacks += 1
+
+    def invalidate(self, conversation_id: str) -> None:
+        with self._lock:
+            if conversation_id in self._loading:
+                self._stale.add(conversation_id)
+            tail = self._data.pop(conversation_id, None)
+            if tail is not None:
+                self._nbytes -= tail.nbytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._nbytes = 0
+
+    def _store(self, conversation_id: str, tail: ConversationTail) -> None:
+        old = self._data.pop(conversation_id, None)
+        if old is not None:
+            self._nbytes -= old.nbytes
+        if tail.nbytes > self.max_bytes:
+            return
+        self._data[conversation_id] = tail
+        self._nbytes += tail.nbytes
+        self._evict()
+
+    def _evict(self) -> None:
+        while self._nbytes > self.max_bytes and self._data:
+            _, tail = self._data.popitem(last=False)
+            self._nbytes -= tail.nbytes
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "bytes": self._nbytes,
+            "max_bytes": self.max_bytes,
+            "tail_size": self.tail_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "fallbacks": self.fallbacks,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+        }
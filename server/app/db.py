@@ -0,0 +1,302 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+# Applied to every pooled connection when it is opened. synchronous=NORMAL is
+# durable across application crashes once the file is in WAL mode (see migrations).
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+)
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became free within the wait timeout."""
+
+
+def _dict_factory(cursor, row):
+    return {col[0]: value for col, value in zip(cursor.description, row)}
+
+
+class Transaction:
+    """Statements bound to one pooled connection, committed together."""
+
+    dialect = "sqlite"
+    for_update = ""
+
+    def __init__(self, database: "Database", conn: sqlite3.Connection):
+        self._db = database
+        self._conn = conn
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        return await self._db._query(_execute, self._conn, sql, params)
+
+    async def execute_many(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> int:
+        return await self._db._query(_execute_many, self._conn, sql, list(seq_of_params))
+
+    async def fetch_one(self, sql: str, params: Sequence[Any] = ()) -> Optional[Dict[str, Any]]:
+        return await self._db._query(_fetch_one, self._conn, sql, params)
+
+    async def fetch_all(self, sql: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        return await self._db._query(_fetch_all, self._conn, sql, params)
+
+    async def fetch_val(self, sql: str, params: Sequence[Any] = ()) -> Any:
+        return await self._db._query(_fetch_val, self._conn, sql, params)
+
+
+def _execute(conn, sql, params):
+    return conn.execute(sql, params).rowcount
+
+
+def _execute_many(conn, sql, seq_of_params):
+    return conn.executemany(sql, seq_of_params).rowcount
+
+
+def _fetch_one(conn, sql, params):
+    return conn.execute(sql, params).fetchone()
+
+
+def _fetch_all(conn, sql, params):
+    return conn.execute(sql, params).fetchall()
+
+
+def _fetch_val(conn, sql, params):
+    row = conn.execute(sql, params).fetchone()
+    return next(iter(row.values())) if row else None
+
+
+def _execute_commit(conn, sql, params):
+    try:
+        rowcount = conn.execute(sql, params).rowcount
+        conn.commit()
+        return rowcount
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+class Database:
+    """Bounded pool of SQLite connections whose queries run off the event loop.
+
+    Connections are opened lazily up to ``size`` and reused; each one keeps its
+    own prepared-statement cache. Statements execute on a thread pool with one
+    thread per connection, so waiting for a connection never blocks a thread
+    that a connection holder needs.
+    """
+
+    dialect = "sqlite"
+    # Appended to SELECTs that read a row before updating it; BEGIN IMMEDIATE
+    # already serializes SQLite writers
+    for_update = ""
+
+    def __init__(self, path: str, size: int = 8, timeout: float = 10.0, statement_cache: int = 256):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.statement_cache = statement_cache
+
+        self._lock = threading.Lock()
+        self._idle: List[sqlite3.Connection] = []
+        self._waiters: deque = deque()
+        self._open = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+        self._acquires = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+        # Optional observers (see metrics.py): on_query(sql, seconds), on_commit(seconds)
+        self.on_query: Optional[Callable[[str, float], None]] = None
+        self.on_commit: Optional[Callable[[float], None]] = None
+
+    def connect(self) -> sqlite3.Connection:
+        """Open a configured connection outside the pool (migrations, scripts)."""
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=self.statement_cache,
+        )
+        conn.row_factory = _dict_factory
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    async def _call(self, fn, *args):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.size, thread_name_prefix="db"
+                    )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def _query(self, fn, conn, sql, params):
+        if self.on_query is None:
+            return await self._call(fn, conn, sql, params)
+        started = time.perf_counter()
+        try:
+            return await self._call(fn, conn, sql, params)
+        finally:
+            self.on_query(sql, time.perf_counter() - started)
+
+    async def _acquire(self) -> sqlite3.Connection:
+        started = time.perf_counter()
+        with self._lock:
+            self._acquires += 1
+            if self._idle:
+                return self._idle.pop()
+            reserve = self._open < self.size
+            if reserve:
+                self._open += 1
+            else:
+                waiter = asyncio.get_running_loop().create_future()
+                self._waiters.append(waiter)
+
+        if reserve:
+            try:
+                return await self._call(self.connect)
+            except BaseException:
+                with self._lock:
+                    self._open -= 1
+                raise
+
+        try:
+            conn = await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._timeouts += 1
+            raise PoolTimeout(f"no database connection available within {self.timeout}s")
+        except asyncio.CancelledError:
+            # The connection may have been handed over just before cancellation
+            if waiter.done() and not waiter.cancelled():
+                self._release(waiter.result())
+            raise
+
+        waited = time.perf_counter() - started
+        with self._lock:
+            self._waits += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def _release(self, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if waiter.done():
+                    continue
+                waiter.get_loop().call_soon_threadsafe(_hand_over, waiter, conn, self)
+                return
+            self._idle.append(conn)
+
+    @asynccontextmanager
+    async def transaction(self, immediate: bool = False):
+        """Run statements on one connection and commit them together.
+
+        ``immediate`` takes the write lock up front (BEGIN IMMEDIATE) so a
+        write batch waits for the lock once instead of failing half-way.
+        """
+        conn = await self._acquire()
+        try:
+            if immediate:
+                await self._call(conn.execute, "BEGIN IMMEDIATE")
+            yield Transaction(self, conn)
+            started = time.perf_counter()
+            await self._call(conn.commit)
+            if self.on_commit is not None:
+                self.on_commit(time.perf_counter() - started)
+        except BaseException:
+            await self._call(conn.rollback)
+            raise
+        finally:
+            self._release(conn)
+
+    @asynccontextmanager
+    async def snapshot(self):
+        """Run reads on one connection against a single consistent snapshot.
+
+        In WAL mode the read transaction takes no lock that writers wait
+        for, however long the reads take.
+        """
+        conn = await self._acquire()
+        try:
+            await self._call(conn.execute, "BEGIN")
+            yield Transaction(self, conn)
+        finally:
+            try:
+                await self._call(conn.rollback)
+            finally:
+                self._release(conn)
+
+    async def _run(self, fn, sql, params):
+        conn = await self._acquire()
+        try:
+            return await self._query(fn, conn, sql, params)
+        finally:
+            self._release(conn)
+
+    async def fetch_one(self, sql: str, params: Sequence[Any] = ()) -> Optional[Dict[str, Any]]:
+        return await self._run(_fetch_one, sql, params)
+
+    async def fetch_all(self, sql: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        return await self._run(_fetch_all, sql, params)
+
+    async def fetch_val(self, sql: str, params: Sequence[Any] = ()) -> Any:
+        return await self._run(_fetch_val, sql, params)
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        return await self._run(_execute_commit, sql, params)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self._open,
+                "idle": len(self._idle),
+                "in_use": self._open - len(self._idle),
+                "waiting": sum(1 for w in self._waiters if not w.done()),
+                "acquires": self._acquires,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "wait_time_total_ms": round(self._wait_total * 1000, 3),
+                "wait_time_max_ms": round(self._wait_max * 1000, 3),
+            }
+
+    async def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            executor, self._executor = self._executor, None
+        for conn in idle:
+            conn.close()
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+def _hand_over(waiter, conn, database):
+    if waiter.done():
+        # Waiter timed out or was cancelled after being picked; pass it on
+        database._release(conn)
+    else:
+        waiter.set_result(conn)
+
+
+def create_database(url: str, **kwargs):
+    """Database for ``url``: ``postgresql://...`` or a SQLite path / ``sqlite:///path``."""
+    if url.startswith(("postgres://", "postgresql://")):
+        from .db_postgres import PostgresDatabase
+        return PostgresDatabase(url, **kwargs)
+    if url.startswith("sqlite:///"):
+        url = url[len("sqlite:///"):]
+    return Database(url, **kwargs)
@@ -0,0 +1,215 @@
+"""PostgreSQL backend with the same async interface as :class:`app.db.Database`.
+
+Queries keep SQLite's ``?`` placeholders and are rewritten to ``$n`` once per
+distinct statement. Connections come from an asyncpg pool, so statements run
+on the event loop without a thread hop.
+"""
+import asyncio
+import re
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+import asyncpg
+
+from .db import PoolTimeout
+
+
+# What a ``?`` may appear in without being a placeholder: string literals, quoted
+# identifiers and dollar-quoted strings ($$...$$ or $tag$...$tag$)
+_QUOTED = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|\$((?:[A-Za-z_]\w*)?)\$.*?\$\1\$|\?""", re.DOTALL)
+
+
+@lru_cache(maxsize=2048)
+def translate(sql: str) -> str:
+    """Rewrite ``?`` placeholders (outside quoted text) to ``$1, $2, ...``."""
+    n = 0
+
+    def number(match):
+        nonlocal n
+        if match.group() != "?":
+            return match.group()
+        n += 1
+        return f"${n}"
+
+    return _QUOTED.sub(number, sql)
+
+
+def _rowcount(status: str) -> int:
+    # asyncpg returns the command tag, e.g. "UPDATE 3" or "INSERT 0 1"
+    count = status.rsplit(" ", 1)[-1]
+    return int(count) if count.isdigit() else -1
+
+
+class PostgresTransaction:
+    """Statements bound to one pooled connection inside a transaction."""
+
+    dialect = "postgres"
+    for_update = " FOR UPDATE"
+
+    def __init__(self, conn: asyncpg.Connection, database: "PostgresDatabase"):
+        self._conn = conn
+        self._db = database
+
+    async def _query(self, fn, sql: str, *args):
+        on_query = self._db.on_query
+        if on_query is None:
+            return await fn(translate(sql), *args)
+        started = time.perf_counter()
+        try:
+            return await fn(translate(sql), *args)
+        finally:
+            on_query(sql, time.perf_counter() - started)
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        return _rowcount(await self._query(self._conn.execute, sql, *params))
+
+    async def execute_many(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> int:
+        seq_of_params = list(seq_of_params)
+        if seq_of_params:
+            await self._query(self._conn.executemany, sql, seq_of_params)
+        return len(seq_of_params)
+
+    async def fetch_one(self, sql: str, params: Sequence[Any] = ()) -> Optional[Dict[str, Any]]:
+        row = await self._query(self._conn.fetchrow, sql, *params)
+        return dict(row) if row is not None else None
+
+    async def fetch_all(self, sql: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        return [dict(row) for row in await self._query(self._conn.fetch, sql, *params)]
+
+    async def fetch_val(self, sql: str, params: Sequence[Any] = ()) -> Any:
+        return await self._query(self._conn.fetchval, sql, *params)
+
+
+class PostgresDatabase:
+    """asyncpg connection pool behind the :class:`app.db.Database` interface.
+
+    ``transaction(immediate=True)`` is a plain transaction here; statements
+    that read a row before updating it add ``db.for_update`` to lock it.
+    """
+
+    dialect = "postgres"
+    for_update = " FOR UPDATE"
+
+    def __init__(self, url: str, size: int = 8, timeout: float = 10.0, statement_cache: int = 256):
+        self.url = url
+        self.size = size
+        self.timeout = timeout
+        self.statement_cache = statement_cache
+
+        self._pool: Optional[asyncpg.Pool] = None
+        self._pool_lock = asyncio.Lock()
+
+        self._acquires = 0
+        self._waiting = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+        # Optional observers (see metrics.py): on_query(sql, seconds), on_commit(seconds)
+        self.on_query: Optional[Callable[[str, float], None]] = None
+        self.on_commit: Optional[Callable[[float], None]] = None
+
+    async def connect(self) -> asyncpg.Connection:
+        """Open a connection outside the pool (migrations, scripts)."""
+        return await asyncpg.connect(self.url, timeout=self.timeout)
+
+    async def _get_pool(self) -> asyncpg.Pool:
+        if self._pool is None:
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(
+                        self.url,
+                        min_size=1,
+                        max_size=self.size,
+                        statement_cache_size=self.statement_cache,
+                        timeout=self.timeout,
+                    )
+        return self._pool
+
+    @asynccontextmanager
+    async def _connection(self):
+        pool = await self._get_pool()
+        started = time.perf_counter()
+        self._acquires += 1
+        self._waiting += 1
+        try:
+            conn = await pool.acquire(timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            raise PoolTimeout(f"no database connection available within {self.timeout}s")
+        finally:
+            self._waiting -= 1
+        waited = time.perf_counter() - started
+        # Handing over an idle connection takes microseconds; anything slower waited
+        if waited > 0.001:
+            self._waits += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        try:
+            yield conn
+        finally:
+            await pool.release(conn)
+
+    @asynccontextmanager
+    async def transaction(self, immediate: bool = False):
+        """Run statements on one connection and commit them together."""
+        async with self._connection() as conn:
+            transaction = conn.transaction()
+            await transaction.start()
+            try:
+                yield PostgresTransaction(conn, self)
+            except BaseException:
+                await transaction.rollback()
+                raise
+            started = time.perf_counter()
+            await transaction.commit()
+            if self.on_commit is not None:
+                self.on_commit(time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def snapshot(self):
+        """Run reads on one connection against a single consistent snapshot."""
+        async with self._connection() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                yield PostgresTransaction(conn, self)
+
+    async def fetch_one(self, sql: str, params: Sequence[Any] = ()) -> Optional[Dict[str, Any]]:
+        async with self._connection() as conn:
+            return await PostgresTransaction(conn, self).fetch_one(sql, params)
+
+    async def fetch_all(self, sql: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        async with self._connection() as conn:
+            return await PostgresTransaction(conn, self).fetch_all(sql, params)
+
+    async def fetch_val(self, sql: str, params: Sequence[Any] = ()) -> Any:
+        async with self._connection() as conn:
+            return await PostgresTransaction(conn, self).fetch_val(sql, params)
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        async with self._connection() as conn:
+            return await PostgresTransaction(conn, self).execute(sql, params)
+
+    def stats(self) -> Dict[str, Any]:
+        pool = self._pool
+        open_ = pool.get_size() if pool else 0
+        idle = pool.get_idle_size() if pool else 0
+        return {
+            "size": self.size,
+            "open": open_,
+            "idle": idle,
+            "in_use": open_ - idle,
+            "waiting": self._waiting,
+            "acquires": self._acquires,
+            "waits": self._waits,
+            "timeouts": self._timeouts,
+            "wait_time_total_ms": round(self._wait_total * 1000, 3),
+            "wait_time_max_ms": round(self._wait_max * 1000, 3),
+        }
+
+    async def close(self) -> None:
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            await pool.close()
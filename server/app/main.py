@@ -1,15 +1,155 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, status
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
-import uuid, os, shutil, sqlite3, json
-from datetime import datetime, timedelta
-from jose import JWTError, jwt
-from passlib.context import CryptContext
+# First, so the time of the imports below is recorded (see startup.py)
+from .startup import StartupReport
+startup_report = StartupReport.begin(__package__)
+
+with startup_report.timing_imports():
+    from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Header, Query, Request, status
+    from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+    from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+    from fastapi.middleware.cors import CORSMiddleware
+    from starlette.requests import ClientDisconnect
+    from pydantic import BaseModel, Field
+    from typing import Optional, List, Dict, Any
+    import asyncio, hashlib, logging, time, uuid, os, json
+    from concurrent.futures import ThreadPoolExecutor
+    from datetime import datetime, timedelta
+    
+    from . import admission, metrics, migrations, payments, profiling, queries, search, stats, versions
+    from .ai import create_backend, load_history
+    from .bulk_documents import generate_documents, read_csv_rows
+    from .cache import TTLCache
+    from .config import DATABASE_URL, DB_POOL_SIZE, DB_POOL_TIMEOUT
+    from .conversation_cache import ConversationCache
+    from .db import PoolTimeout, create_database
+    from .export import EXPORTS, MEDIA_TYPES, STATUS_EXPORTS, stream_export
+    from .http_cache import is_not_modified, quote_etag
+    from .orders import STATUSES as ORDER_STATUSES, ExpirySweeper, refund as refund_order
+    from .pagination import (
+        DEFAULT_LIMIT, MAX_LIMIT, decode_cursor, decode_offset_cursor, encode_cursor, encode_offset_cursor, keyset_clause,
+        paginate,
+    )
+    from .shared_cache import CacheBus, TwoTierCache, connect as connect_redis
+    from .template_engine import CompiledTemplate, TemplateError, compile_template
+    from .uploads import (
+        UploadStore, UploadTooLarge, add_ref as add_blob_ref, lock_blob, release_ref as release_blob_ref,
+        remove_unreferenced as remove_unreferenced_blob,
+    )
+    from .writer import GroupCommitWriter
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="SalaryHelper API", version="1.0.0")
 
+# Configuration
+UPLOAD_DIR = "/tmp/salaryhelper_uploads"
+SECRET_KEY = "your-secret-key-change-in-production"
+ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# 1: apply pending migrations (only a version read once the schema is current);
+# check: refuse to start on an outdated schema; 0: skip. Use check or 0 when
+# migrations are run out-of-band (python -m app.migrations)
+DB_MIGRATE_ON_STARTUP = os.getenv("DB_MIGRATE_ON_STARTUP", "1")
+STATS_RECONCILE_INTERVAL = float(os.getenv("STATS_RECONCILE_INTERVAL", "600"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "50000"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+MESSAGE_WRITER_MAX_BATCH = int(os.getenv("MESSAGE_WRITER_MAX_BATCH", "256"))
+MESSAGE_WRITER_MAX_DELAY_MS = float(os.getenv("MESSAGE_WRITER_MAX_DELAY_MS", "2"))
+AI_BACKEND = os.getenv("AI_BACKEND", "stub")
+TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "1024"))
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "10000"))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(500 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(4 * 1024 * 1024)))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(256 * 1024)))
+DOWNLOAD_MAX_AGE = int(os.getenv("DOWNLOAD_MAX_AGE", "86400"))
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "1000"))
+CONVERSATION_CACHE_MB = float(os.getenv("CONVERSATION_CACHE_MB", "64"))
+CONVERSATION_TAIL_SIZE = int(os.getenv("CONVERSATION_TAIL_SIZE", "200"))
+# Shares cached users/templates and cache invalidations between replicas; unset = in-process only
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "0.5"))
+# Caps the TTL of every in-process cache; the launcher sets it when several
+# workers run without REDIS_URL, since nothing tells them of each other's changes
+LOCAL_CACHE_TTL = float(os.getenv("LOCAL_CACHE_TTL", "0"))
+# Upper bound on how long a lost cross-replica invalidation can keep an ETag current
+TABLE_VERSION_TTL = float(os.getenv("TABLE_VERSION_TTL", "60"))
+# Read-mostly responses may be stored by the browser but are revalidated on every use
+READ_MOSTLY_CACHE_CONTROL = "private, no-cache"
+# Request profiling: requests sending X-Profile: <PROFILE_TOKEN>, plus a random share of the rest
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "0") == "1"
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "1"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/salaryhelper_profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+# Shared with the payment providers; notifications are rejected until it is set
+PAYMENT_NOTIFY_SECRET = os.getenv("PAYMENT_NOTIFY_SECRET")
+PAYMENT_WRITER_MAX_BATCH = int(os.getenv("PAYMENT_WRITER_MAX_BATCH", "256"))
+PAYMENT_WRITER_MAX_DELAY_MS = float(os.getenv("PAYMENT_WRITER_MAX_DELAY_MS", "5"))
+# Orders still pending this long are expired by a background sweep every ORDER_SWEEP_INTERVAL seconds
+ORDER_EXPIRE_MINUTES = float(os.getenv("ORDER_EXPIRE_MINUTES", "30"))
+ORDER_SWEEP_INTERVAL = float(os.getenv("ORDER_SWEEP_INTERVAL", "60"))
+ORDER_SWEEP_BATCH = int(os.getenv("ORDER_SWEEP_BATCH", "500"))
+# Admission control, per worker: requests handled at once (health, metrics and
+# payments not counted), how many may wait for a slot and for how long
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "128"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "256"))
+ADMISSION_QUEUE_TIMEOUT_MS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_MS", "2000"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+# Posting messages: concurrent requests and per-user rate (0 = unlimited)
+MESSAGE_MAX_CONCURRENCY = int(os.getenv("MESSAGE_MAX_CONCURRENCY", "32"))
+MESSAGE_RATE_PER_MINUTE = float(os.getenv("MESSAGE_RATE_PER_MINUTE", "30"))
+MESSAGE_RATE_BURST = int(os.getenv("MESSAGE_RATE_BURST", "10"))
+# Verification codes requested per client IP
+SMS_RATE_PER_MINUTE = float(os.getenv("SMS_RATE_PER_MINUTE", "10"))
+SMS_RATE_BURST = int(os.getenv("SMS_RATE_BURST", "5"))
+# Bulk document generation and admin exports run at once
+BULK_MAX_CONCURRENCY = int(os.getenv("BULK_MAX_CONCURRENCY", "4"))
+EXPORT_MAX_CONCURRENCY = int(os.getenv("EXPORT_MAX_CONCURRENCY", "2"))
+
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+# Per-route limits and load shedding (see admission.py), read through /api/v1/admin/admission
+admission_queue_timeout = ADMISSION_QUEUE_TIMEOUT_MS / 1000
+admission_control = admission.AdmissionController(
+    [
+        admission.Rule("health", [("GET", "/api/v1/health"), ("GET", "/metrics")], critical=True),
+        admission.Rule(
+            "payments", [("POST", "/api/v1/payments/notify/{provider}"), ("POST", "/api/v1/orders/{order_id}/pay")],
+            critical=True,
+        ),
+        admission.Rule(
+            "messages",
+            [("POST", "/api/v1/conversations/{convId}/messages"),
+             ("POST", "/api/v1/conversations/{convId}/messages/stream")],
+            concurrency=MESSAGE_MAX_CONCURRENCY, queue_timeout=admission_queue_timeout,
+            rate=MESSAGE_RATE_PER_MINUTE / 60, burst=MESSAGE_RATE_BURST,
+        ),
+        admission.Rule(
+            "sms", [("POST", "/api/v1/auth/send-sms")],
+            rate=SMS_RATE_PER_MINUTE / 60, burst=SMS_RATE_BURST, key=admission.BY_IP,
+        ),
+        admission.Rule(
+            "bulk_documents", [("POST", "/api/v1/documents/batch"), ("POST", "/api/v1/documents/batch/csv")],
+            concurrency=BULK_MAX_CONCURRENCY, queue_timeout=admission_queue_timeout,
+        ),
+        admission.Rule(
+            "exports", [("GET", "/api/v1/admin/export/{kind}")],
+            concurrency=EXPORT_MAX_CONCURRENCY, queue_timeout=admission_queue_timeout,
+        ),
+    ],
+    max_concurrency=ADMISSION_MAX_CONCURRENCY, max_queue=ADMISSION_MAX_QUEUE,
+    queue_timeout=admission_queue_timeout, retry_after=ADMISSION_RETRY_AFTER,
+    # Defined with verify_token below
+    identify=lambda token: token_user(token),
+)
+metrics.instrument_admission(admission_control)
+if ADMISSION_ENABLED:
+    # Inside CORS, so browsers can read the 429/503 responses it sends
+    app.add_middleware(admission.AdmissionMiddleware, controller=admission_control)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -18,222 +158,32 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Outside CORS, so the latency histograms include it
+app.add_middleware(metrics.MetricsMiddleware)
 
-# Configuration
-UPLOAD_DIR = "/tmp/salaryhelper_uploads"
-DATABASE_URL = "/tmp/salaryhelper.db"
-SECRET_KEY = "your-secret-key-change-in-production"
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
-
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+# Per-request profiles (see profiling.py), read back through /api/v1/admin/profiles
+profile_store = profiling.ProfileStore(PROFILE_DIR, PROFILE_MAX_FILES)
+if PROFILE_ENABLED:
+    # Outermost: profiles are written after the response, outside the latency histograms
+    app.add_middleware(
+        profiling.ProfilingMiddleware, store=profile_store, sample_rate=PROFILE_SAMPLE_RATE,
+        token=PROFILE_TOKEN, interval=PROFILE_INTERVAL_MS / 1000,
+    )
 
 # Security
 security = HTTPBearer()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # Database setup
-def init_db():
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    
-    # Users table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id TEXT PRIMARY KEY,
-        phone TEXT UNIQUE NOT NULL,
-        name TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-    
-    # Conversations table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS conversations (
-        id TEXT PRIMARY KEY,
-        user_id TEXT NOT NULL,
-        title TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )
-    """)
-    
-    # Messages table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS messages (
-        id TEXT PRIMARY KEY,
-        conversation_id TEXT NOT NULL,
-        sender TEXT NOT NULL,
-        sender_id TEXT,
-        content TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (conversation_id) REFERENCES conversations (id)
-    )
-    """)
-    
-    # Attachments table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS attachments (
-        id TEXT PRIMARY KEY,
-        file_name TEXT NOT NULL,
-        content_type TEXT,
-        size_bytes INTEGER,
-        storage_url TEXT,
-        preview_url TEXT,
-        metadata TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-    
-    # Templates table for document generation
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS templates (
-        id TEXT PRIMARY KEY,
-        name TEXT NOT NULL,
-        description TEXT,
-        category TEXT,
-        content TEXT NOT NULL,
-        fields TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-    
-    # Documents table for generated documents
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS documents (
-        id TEXT PRIMARY KEY,
-        user_id TEXT NOT NULL,
-        template_id TEXT,
-        title TEXT NOT NULL,
-        content TEXT NOT NULL,
-        status TEXT DEFAULT 'draft',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id),
-        FOREIGN KEY (template_id) REFERENCES templates (id)
-    )
-    """)
-    
-    # Orders table for payment system
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS orders (
-        id TEXT PRIMARY KEY,
-        user_id TEXT NOT NULL,
-        product_type TEXT NOT NULL,
-        product_id TEXT,
-        amount REAL NOT NULL,
-        status TEXT DEFAULT 'pending',
-        payment_method TEXT,
-        transaction_id TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        paid_at TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )
-    """)
-    
-    # Insert default templates
-    cursor.execute("SELECT COUNT(*) FROM templates")
-    count = cursor.fetchone()[0]
-    if count == 0:
-        default_templates = [
-            (
-                "tpl-001",
-                "劳动仲裁申请书",
-                "用于提交劳动仲裁申请的标准模板",
-                "仲裁",
-                """劳动仲裁申请书
-
-申请人：{applicant_name}
-性别：{applicant_gender}
-身份证号：{applicant_id}
-联系电话：{applicant_phone}
-住址：{applicant_address}
-
-被申请人：{respondent_name}
-法定代表人：{respondent_legal_rep}
-地址：{respondent_address}
-联系电话：{respondent_phone}
-
-仲裁请求：
-{arbitration_requests}
-
-事实与理由：
-{facts_and_reasons}
-
-证据材料清单：
-{evidence_list}
-
-此致
-{arbitration_committee}
-
-申请人：{applicant_name}
-日期：{application_date}""",
-                '["applicant_name","applicant_gender","applicant_id","applicant_phone","applicant_address","respondent_name","respondent_legal_rep","respondent_address","respondent_phone","arbitration_requests","facts_and_reasons","evidence_list","arbitration_committee","application_date"]'
-            ),
-            (
-                "tpl-002",
-                "工资支付申诉书",
-                "用于申诉拖欠工资问题",
-                "工资",
-                """工资支付申诉书
-
-申诉人：{complainant_name}
-身份证号：{complainant_id}
-联系方式：{complainant_contact}
-
-被申诉人：{company_name}
-统一社会信用代码：{company_code}
-联系地址：{company_address}
-
-申诉事项：
-本人于{employment_start}至{employment_end}期间在被申诉人处工作，岗位为{position}。
-被申诉人拖欠本人工资共计人民币{amount}元，具体如下：
-{wage_details}
-
-证据：
-{evidence_list}
-
-请求：
-{requests}
-
-申诉人：{complainant_name}
-日期：{date}""",
-                '["complainant_name","complainant_id","complainant_contact","company_name","company_code","company_address","employment_start","employment_end","position","amount","wage_details","evidence_list","requests","date"]'
-            ),
-            (
-                "tpl-003",
-                "劳动合同解除通知书",
-                "用于通知解除劳动合同",
-                "合同",
-                """劳动合同解除通知书
-
-{employee_name}：
-
-根据《劳动合同法》第{article_number}条规定，因{termination_reason}，公司决定于{termination_date}与您解除劳动合同。
-
-解除理由详述：
-{detailed_reason}
-
-补偿说明：
-{compensation_details}
-
-请您于{handover_date}前办理工作交接手续。
-
-特此通知。
-
-{company_name}
-日期：{notice_date}""",
-                '["employee_name","article_number","termination_reason","termination_date","detailed_reason","compensation_details","handover_date","company_name","notice_date"]'
+async def init_db():
+    if DB_MIGRATE_ON_STARTUP == "check":
+        version = await migrations.schema_version(db)
+        if version < migrations.LATEST_VERSION:
+            raise RuntimeError(
+                f"database schema is at version {version}, expected {migrations.LATEST_VERSION}; "
+                "run python -m app.migrations"
             )
-        ]
-        
-        for template_data in default_templates:
-            cursor.execute(
-                "INSERT INTO templates (id, name, description, category, content, fields) VALUES (?, ?, ?, ?, ?, ?)",
-                template_data
-            )
-    
-    conn.commit()
-    conn.close()
+        return
+    await migrations.migrate_database(db)
 
 # Pydantic models
 class LoginRequest(BaseModel):
@@ -249,6 +199,9 @@ class User(BaseModel):
     phone: str
     name: Optional[str] = None
 
+class UserUpdate(BaseModel):
+    name: str = Field(..., max_length=50)
+
 class ConversationCreate(BaseModel):
     title: Optional[str] = None
 
@@ -268,13 +221,24 @@ class DocumentCreate(BaseModel):
     title: Optional[str] = None
     data: Dict[str, str]
 
+class DocumentBatchCreate(BaseModel):
+    template_id: str
+    title: Optional[str] = None
+    rows: List[Dict[str, str]]
+
+class UploadCreate(BaseModel):
+    file_name: str
+    content_type: Optional[str] = None
+    size_bytes: Optional[int] = None
+
 class OrderCreate(BaseModel):
     product_type: str
     product_id: Optional[str] = None
     amount: float
     payment_method: Optional[str] = "wechat"
 
-# JWT functions
+# JWT functions. python-jose loads its cryptography backends on import, which
+# is most of a worker's import time, so it is imported on first use instead.
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -282,37 +246,224 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    from jose import jwt
+    with profiling.span("jwt"):
+        encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def decode_access_token(token: str) -> Optional[Dict[str, Any]]:
+    """Verified claims, or None if the token is invalid or expired."""
+    from jose import JWTError, jwt
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Could not validate credentials",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        return user_id
+        with profiling.span("jwt"):
+            return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
+        return None
+
+# Redis connection shared by the caches and the cross-replica invalidation listener
+cache_bus = CacheBus(connect_redis(REDIS_URL, REDIS_TIMEOUT))
+
+def local_ttl(ttl: float) -> float:
+    return min(ttl, LOCAL_CACHE_TTL) if LOCAL_CACHE_TTL > 0 else ttl
+
+# Verified tokens (sha256 hex digest -> user_id), each kept no longer than its exp.
+# Verifying a JWT is cheaper than a Redis round trip, so only invalidations are shared.
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=local_ttl(ACCESS_TOKEN_EXPIRE_MINUTES * 60))
+cache_bus.register("tokens", token_cache)
+# Resolved user rows by id
+user_cache = TwoTierCache("users", cache_bus, TTLCache(maxsize=USER_CACHE_SIZE, ttl=local_ttl(USER_CACHE_TTL)))
+
+def _token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+def token_user(token: str) -> Optional[str]:
+    """User id of a validly signed token, or None; for admission control's per-user limits.
+
+    Unlike verify_token it does not check whether the token was logged out.
+    """
+    user_id = token_cache.get(_token_digest(token))
+    if user_id is None:
+        payload = decode_access_token(token)
+        user_id = payload.get("sub") if payload is not None else None
+    return user_id
+
+async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    digest = _token_digest(credentials.credentials)
+    user_id = token_cache.get(digest)
+    if user_id is not None:
+        return user_id
+    
+    payload = decode_access_token(credentials.credentials)
+    user_id: Optional[str] = payload.get("sub") if payload is not None else None
+    # Logged-out tokens are only cached as valid until the logout invalidates them
+    if user_id is None or await db.fetch_val("SELECT 1 FROM revoked_tokens WHERE digest = ?", (digest,)):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if payload.get("exp"):
+        token_cache.set(digest, user_id, ttl=payload["exp"] - time.time())
+    return user_id
+
+async def invalidate_token(token: str):
+    digest = _token_digest(token)
+    token_cache.invalidate(digest)
+    await cache_bus.publish("tokens", digest)
+
+async def invalidate_user(user_id: str):
+    await user_cache.invalidate(user_id)
+
+async def load_user(user_id: str) -> Optional[Dict[str, Any]]:
+    user = await user_cache.get(user_id)
+    if user is None:
+        user = await db.fetch_one("SELECT * FROM users WHERE id = ?", (user_id,))
+        if user:
+            await user_cache.set(user_id, user)
+    return user
+
+# Database access
+db = create_database(DATABASE_URL, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT)
+metrics.instrument_database(db)
+if PROFILE_ENABLED:
+    profiling.instrument_database(db)
+
+@app.exception_handler(PoolTimeout)
+async def pool_timeout_handler(request: Request, exc: PoolTimeout):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "服务繁忙，请稍后重试"},
+        headers={"Retry-After": "1"},
+    )
+
+def message_timestamp() -> str:
+    # Same clock as CURRENT_TIMESTAMP but with microseconds, so a reply always
+    # sorts after the message it answers even within the same second
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+async def _flush_messages(tx, items):
+    # items: one list of message rows per submit() call
+    rows = [row for item in items for row in item]
+    await tx.execute_many(
+        "INSERT INTO messages (id, conversation_id, sender, sender_id, content, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    await stats.record(tx, messages=len(rows))
+    conv_ids = list({row[1] for row in rows})
+    owners = await tx.fetch_all(
+        f"SELECT id, user_id FROM conversations WHERE id IN ({', '.join('?' * len(conv_ids))})",
+        conv_ids
+    )
+    owners = {owner["id"]: owner["user_id"] for owner in owners}
+    await search.index(tx, "message", [(row[0], owners.get(row[1]), row[4]) for row in rows])
+
+message_writer = GroupCommitWriter(
+    db, _flush_messages, name="messages",
+    max_batch=MESSAGE_WRITER_MAX_BATCH, max_delay=MESSAGE_WRITER_MAX_DELAY_MS / 1000,
+)
+
+# Applies provider payment notifications in batches (see payments.py)
+payment_writer = GroupCommitWriter(
+    db, payments.apply_notifications, name="payments",
+    max_batch=PAYMENT_WRITER_MAX_BATCH, max_delay=PAYMENT_WRITER_MAX_DELAY_MS / 1000,
+)
+# (provider, provider transaction id) of committed notifications; retries are acknowledged from here
+applied_notifications = TTLCache(maxsize=100000, ttl=3600)
+
+# Expires abandoned pending orders (see orders.py)
+order_sweeper = ExpirySweeper(
+    db, ttl=ORDER_EXPIRE_MINUTES * 60, interval=ORDER_SWEEP_INTERVAL, batch_size=ORDER_SWEEP_BATCH,
+)
+
+ai_backend = create_backend(AI_BACKEND)
+
+# Ownership and last CONVERSATION_TAIL_SIZE messages of recently used conversations
+conversation_cache = ConversationCache(
+    max_bytes=int(CONVERSATION_CACHE_MB * 1024 * 1024), tail_size=CONVERSATION_TAIL_SIZE,
+    ttl=LOCAL_CACHE_TTL if LOCAL_CACHE_TTL > 0 else None,
+)
+# Other replicas drop their copy of a tail when this one appends to it
+cache_bus.register("conversations", conversation_cache)
+
+def _encode_template(cached):
+    name, compiled = cached
+    return {"name": name, "segments": compiled.segments, "slots": compiled.slots, "fields": compiled.fields}
+
+def _decode_template(data):
+    return data["name"], CompiledTemplate(data["segments"], data["slots"], data["fields"])
+
+# Compiled document templates by id: (name, CompiledTemplate)
+template_cache = TwoTierCache(
+    "templates", cache_bus, TTLCache(maxsize=TEMPLATE_CACHE_SIZE, ttl=local_ttl(3600)),
+    encode=_encode_template, decode=_decode_template,
+)
+
+# Serialized template list/detail responses by (version of the templates table, id or None)
+template_bodies = TTLCache(maxsize=TEMPLATE_CACHE_SIZE, ttl=local_ttl(3600))
+
+# Versions of the tables behind ETag'd endpoints (see versions.py)
+table_versions = versions.VersionCache(ttl=local_ttl(TABLE_VERSION_TTL))
+cache_bus.register("versions", table_versions)
+
+async def table_changed(name: str):
+    # Call after the transaction that ran versions.bump() has committed
+    table_versions.invalidate(name)
+    await cache_bus.publish("versions", name)
+
+def not_modified_or_headers(request: Request, etag: str):
+    """(304 response or None, headers to send with the full response)."""
+    headers = {"ETag": etag, "Cache-Control": READ_MOSTLY_CACHE_CONTROL}
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=headers), headers
+    return None, headers
 
-# Database helpers
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE_URL)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Keeps CSV parsing and bulk rendering off the event loop. Not sized by configuration:
+# the threads share the GIL, so more of them would not render any faster. Rendering
+# only overlaps the previous chunk's insert, which releases the GIL while SQLite writes.
+render_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="render")
+
+# Content-addressed attachment files and partial resumable uploads
+upload_store = UploadStore(UPLOAD_DIR, MAX_UPLOAD_BYTES)
+
+# Strong references to fire-and-forget tasks until they finish
+background_tasks = set()
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 # Initialize database on startup
 @app.on_event("startup")
 async def startup_event():
-    init_db()
+    if DB_MIGRATE_ON_STARTUP != "0":
+        with startup_report.phase("migrations"):
+            await init_db()
+    # One reconciler per host is enough: its scans are the expensive part (see stats.py)
+    app.state.stats_task = None
+    if os.getenv("APP_WORKER_INDEX", "0") == "0":
+        app.state.stats_task = asyncio.create_task(
+            stats.reconcile_forever(db, STATS_RECONCILE_INTERVAL)
+        )
+    message_writer.start()
+    payment_writer.start()
+    order_sweeper.start()
+    with startup_report.phase("cache_bus"):
+        await cache_bus.start()
+    ready = startup_report.ready()
+    metrics.TIME_TO_READY.set(ready)
+    logger.info("worker %d ready in %.0f ms", os.getpid(), ready * 1000)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if app.state.stats_task is not None:
+        app.state.stats_task.cancel()
+    await order_sweeper.stop()
+    await message_writer.stop()
+    await payment_writer.stop()
+    await cache_bus.stop()
+    await db.close()
 
 # Auth endpoints
 @app.post("/api/v1/auth/send-sms")
@@ -327,30 +478,30 @@ async def login(request: LoginRequest):
     if request.code != "123456":
         raise HTTPException(status_code=400, detail="验证码错误")
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Get or create user
-    cursor.execute("SELECT * FROM users WHERE phone = ?", (request.phone,))
-    user = cursor.fetchone()
-    
-    if not user:
-        user_id = str(uuid.uuid4())
-        cursor.execute(
-            "INSERT INTO users (id, phone, name) VALUES (?, ?, ?)",
-            (user_id, request.phone, f"User-{request.phone}")
-        )
-        user_data = {"id": user_id, "phone": request.phone, "name": f"User-{request.phone}"}
-    else:
-        user_data = dict(user)
-    
-    conn.commit()
-    conn.close()
+    async with db.transaction() as tx:
+        # Get or create user
+        user = await tx.fetch_one("SELECT * FROM users WHERE phone = ?", (request.phone,))
+        
+        if not user:
+            user_id = str(uuid.uuid4())
+            # Another replica may register the same phone concurrently
+            created = await tx.execute(
+                "INSERT INTO users (id, phone, name) VALUES (?, ?, ?) ON CONFLICT(phone) DO NOTHING",
+                (user_id, request.phone, f"User-{request.phone}")
+            )
+            if created:
+                await stats.record(tx, users=1)
+                user_data = {"id": user_id, "phone": request.phone, "name": f"User-{request.phone}"}
+            else:
+                user_data = await tx.fetch_one("SELECT * FROM users WHERE phone = ?", (request.phone,))
+        else:
+            user_data = user
     
     # Create access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user_data["id"]}, expires_delta=access_token_expires
+        # jti: two logins in the same second get different tokens, so logging out one keeps the other
+        data={"sub": user_data["id"], "jti": uuid.uuid4().hex}, expires_delta=access_token_expires
     )
     
     return {
@@ -361,116 +512,176 @@ async def login(request: LoginRequest):
         }
     }
 
+@app.post("/api/v1/auth/logout")
+async def logout(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    user_id: str = Depends(verify_token),
+):
+    token = credentials.credentials
+    expires_at = datetime.utcfromtimestamp(decode_access_token(token)["exp"]).strftime("%Y-%m-%d %H:%M:%S")
+    async with db.transaction() as tx:
+        # Revocations of tokens that have expired anyway are no longer needed
+        await tx.execute(
+            "DELETE FROM revoked_tokens WHERE expires_at < ?", (datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),)
+        )
+        await tx.execute(
+            "INSERT INTO revoked_tokens (digest, expires_at) VALUES (?, ?) ON CONFLICT(digest) DO NOTHING",
+            (_token_digest(token), expires_at)
+        )
+    await invalidate_token(token)
+    
+    return {"code": 0, "message": "已退出登录"}
+
 @app.get("/api/v1/auth/me")
 async def get_current_user(user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    user = cursor.fetchone()
-    conn.close()
+    user = await load_user(user_id)
     
     if not user:
         raise HTTPException(status_code=404, detail="用户不存在")
     
-    return {"code": 0, "data": dict(user)}
+    return {"code": 0, "data": user}
+
+@app.put("/api/v1/auth/me")
+async def update_current_user(update: UserUpdate, user_id: str = Depends(verify_token)):
+    name = update.name.strip()
+    if not name:
+        raise HTTPException(status_code=400, detail="用户名不能为空")
+    
+    if not await db.execute("UPDATE users SET name = ? WHERE id = ?", (name, user_id)):
+        raise HTTPException(status_code=404, detail="用户不存在")
+    await invalidate_user(user_id)
+    
+    return {"code": 0, "data": await load_user(user_id)}
 
 # Conversation endpoints
 @app.post("/api/v1/conversations")
 async def create_conversation(conversation: ConversationCreate, user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     conv_id = str(uuid.uuid4())
     title = conversation.title or f"会话-{datetime.now().strftime('%m%d %H%M')}"
     
-    cursor.execute(
-        "INSERT INTO conversations (id, user_id, title) VALUES (?, ?, ?)",
-        (conv_id, user_id, title)
-    )
-    
-    conn.commit()
-    conn.close()
+    async with db.transaction() as tx:
+        await tx.execute(
+            "INSERT INTO conversations (id, user_id, title) VALUES (?, ?, ?)",
+            (conv_id, user_id, title)
+        )
+        await stats.record(tx, conversations=1)
     
     return {"code": 0, "data": {"id": conv_id, "title": title}}
 
 @app.get("/api/v1/conversations")
-async def list_conversations(user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        "SELECT * FROM conversations WHERE user_id = ? ORDER BY created_at DESC",
-        (user_id,)
+async def list_conversations(
+    limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+    cursor: Optional[str] = None,
+    user_id: str = Depends(verify_token),
+):
+    after, after_params = keyset_clause(cursor)
+    conversations = await db.fetch_all(
+        queries.LIST_CONVERSATIONS.format(after=after),
+        (user_id, *after_params, limit + 1)
     )
-    conversations = cursor.fetchall()
-    conn.close()
+    conversations, next_cursor = paginate(conversations, limit)
     
-    return {"code": 0, "data": [dict(conv) for conv in conversations]}
+    return {"code": 0, "data": conversations, "next_cursor": next_cursor}
 
-@app.get("/api/v1/conversations/{convId}")
-async def get_conversation(convId: str, user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+async def _load_conversation_tail(convId: str):
+    conversation = await db.fetch_one("SELECT * FROM conversations WHERE id = ?", (convId,))
+    if not conversation:
+        return None, [], False
+    messages = await db.fetch_all(
+        queries.CONVERSATION_LATEST.format(before=""),
+        (convId, CONVERSATION_TAIL_SIZE + 1)
+    )
+    complete = len(messages) <= CONVERSATION_TAIL_SIZE
+    return conversation, messages[:CONVERSATION_TAIL_SIZE][::-1], complete
+
+async def get_conversation_tail(convId: str, user_id: str):
+    """Conversation row and recent messages, from the tail cache when possible."""
+    tail = conversation_cache.get(convId)
+    if tail is None:
+        tail = await conversation_cache.load(convId, lambda: _load_conversation_tail(convId))
     
     # Verify conversation belongs to user
-    cursor.execute("SELECT * FROM conversations WHERE id = ? AND user_id = ?", (convId, user_id))
-    conversation = cursor.fetchone()
-    
-    if not conversation:
-        conn.close()
+    if tail is None or tail.conversation["user_id"] != user_id:
         raise HTTPException(status_code=404, detail="会话不存在")
-    
-    # Get messages
-    cursor.execute(
-        "SELECT * FROM messages WHERE conversation_id = ? ORDER BY created_at ASC",
-        (convId,)
-    )
-    messages = cursor.fetchall()
-    conn.close()
+    return tail
+
+async def save_messages(convId: str, rows: List[tuple]):
+    # Committed together with other requests' messages, then appended to the cached tail
+    await message_writer.submit(rows)
+    conversation_cache.append(convId, rows)
+    await cache_bus.publish("conversations", convId)
+
+@app.get("/api/v1/conversations/{convId}")
+async def get_conversation(
+    convId: str,
+    limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+    cursor: Optional[str] = None,
+    before: Optional[str] = None,
+    user_id: str = Depends(verify_token),
+):
+    # Without a cursor: the latest page. before: the page preceding it; cursor: messages after it
+    if cursor and before:
+        raise HTTPException(status_code=400, detail="cursor 与 before 不能同时使用")
+    tail = await get_conversation_tail(convId, user_id)
+    
+    # Messages oldest first either way
+    next_cursor = before_cursor = None
+    if cursor:
+        messages = tail.page(decode_cursor(cursor), limit + 1)
+        if messages is None:
+            conversation_cache.record_fallback()
+            after, after_params = keyset_clause(cursor, descending=False)
+            messages = await db.fetch_all(
+                queries.CONVERSATION_MESSAGES.format(after=after),
+                (convId, *after_params, limit + 1)
+            )
+        messages, next_cursor = paginate(messages, limit)
+    else:
+        messages = tail.before(decode_cursor(before) if before else None, limit + 1)
+        if messages is None:
+            conversation_cache.record_fallback()
+            seek, seek_params = keyset_clause(before)
+            messages = await db.fetch_all(
+                queries.CONVERSATION_LATEST.format(before=seek),
+                (convId, *seek_params, limit + 1)
+            )
+            messages.reverse()
+        if len(messages) > limit:
+            messages = messages[1:]
+            before_cursor = encode_cursor(messages[0])
     
     return {
         "code": 0,
         "data": {
-            "conversation": dict(conversation),
-            "messages": [dict(msg) for msg in messages]
-        }
+            "conversation": tail.conversation,
+            "messages": messages
+        },
+        "next_cursor": next_cursor,
+        "before_cursor": before_cursor
     }
 
 @app.post("/api/v1/conversations/{convId}/messages")
 async def post_message(convId: str, message: MessageCreate, user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Verify conversation belongs to user
-    cursor.execute("SELECT * FROM conversations WHERE id = ? AND user_id = ?", (convId, user_id))
-    conversation = cursor.fetchone()
-    
-    if not conversation:
-        conn.close()
-        raise HTTPException(status_code=404, detail="会话不存在")
+    tail = await get_conversation_tail(convId, user_id)
     
     # Create user message
     message_id = str(uuid.uuid4())
     content = message.text or message.content or ""
     
-    cursor.execute(
-        "INSERT INTO messages (id, conversation_id, sender, sender_id, content) VALUES (?, ?, ?, ?, ?)",
-        (message_id, convId, "user", user_id, content)
-    )
-    
-    conn.commit()
-    
-    # Mock AI response (simplified - in real app, this would call AI service)
     ai_message_id = str(uuid.uuid4())
-    ai_response = f"（模拟回复）已收到您的消息：{content}"
-    
-    cursor.execute(
-        "INSERT INTO messages (id, conversation_id, sender, content) VALUES (?, ?, ?, ?)",
-        (ai_message_id, convId, "ai", ai_response)
-    )
+    history = await conversation_history(convId, tail)
+    # Stored while the reply is generated, and kept if the AI backend fails
+    user_saved = spawn(save_messages(convId, [
+        (message_id, convId, "user", user_id, content, message_timestamp())
+    ]))
+    try:
+        ai_response = await ai_backend.reply(content, history)
+    finally:
+        await asyncio.shield(user_saved)
     
-    conn.commit()
-    conn.close()
+    await save_messages(convId, [
+        (ai_message_id, convId, "ai", None, ai_response, message_timestamp())
+    ])
     
     return {
         "code": 0,
@@ -484,132 +695,431 @@ async def post_message(convId: str, message: MessageCreate, user_id: str = Depen
         }
     }
 
+async def conversation_history(convId: str, tail):
+    history = tail.recent(ai_backend.history_size)
+    if history is None:
+        history = await load_history(db, convId, ai_backend.history_size)
+    return history
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/api/v1/conversations/{convId}/messages/stream")
+async def stream_message(convId: str, message: MessageCreate, user_id: str = Depends(verify_token)):
+    tail = await get_conversation_tail(convId, user_id)
+    
+    message_id = str(uuid.uuid4())
+    ai_message_id = str(uuid.uuid4())
+    content = message.text or message.content or ""
+    history = await conversation_history(convId, tail)
+    
+    # Store the user's message without holding back the first token
+    user_saved = spawn(save_messages(convId, [
+        (message_id, convId, "user", user_id, content, message_timestamp())
+    ]))
+    chunks = asyncio.Queue()
+    parts = []
+    
+    async def generate():
+        # Runs apart from the response so the reply is stored even if the client disconnects
+        try:
+            async for chunk in ai_backend.stream_reply(content, history):
+                parts.append(chunk)
+                chunks.put_nowait(chunk)
+            await user_saved
+            await save_messages(convId, [
+                (ai_message_id, convId, "ai", None, "".join(parts), message_timestamp())
+            ])
+            chunks.put_nowait(None)
+        except Exception as exc:
+            logger.exception("AI reply for conversation %s failed", convId)
+            chunks.put_nowait(exc)
+    
+    spawn(generate())
+    
+    async def events():
+        yield _sse("start", {"message_id": message_id, "ai_message_id": ai_message_id})
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                yield _sse("done", {"message_id": ai_message_id, "content": "".join(parts)})
+                return
+            if isinstance(chunk, Exception):
+                yield _sse("error", {"detail": "AI回复生成失败"})
+                return
+            yield _sse("delta", {"content": chunk})
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def _upload_file_chunks(file: UploadFile):
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+async def _request_chunks(request: Request):
+    # Keep whatever arrived before a dropped connection; the client resumes from there
+    try:
+        async for chunk in request.stream():
+            yield chunk
+    except ClientDisconnect:
+        return
+
+async def create_attachment(upload_id: str, user_id: str, file_name: str, content_type: Optional[str],
+                            content_hash: str, size: int, session: bool = False):
+    file_id = str(uuid.uuid4())
+    created = False
+    try:
+        async with db.transaction(immediate=True) as tx:
+            await lock_blob(tx, content_hash)
+            path, created = await upload_store.place(upload_id, content_hash)
+            await add_blob_ref(tx, content_hash, size, path)
+            await tx.execute(
+                """INSERT INTO attachments 
+                   (id, user_id, file_name, content_type, size_bytes, storage_url, content_hash) 
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (file_id, user_id, file_name, content_type, size, path, content_hash)
+            )
+            if session:
+                await tx.execute("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+    except BaseException:
+        # The reference rolled back with the rest; don't leave the file this call placed
+        # behind, unless an upload of the same content has referenced it since
+        if created:
+            await remove_unreferenced_blob(db, upload_store, content_hash, path)
+        raise
+    
+    return {
+        "file_id": file_id,
+        "file_name": file_name,
+        "url": f"/api/v1/attachments/{file_id}/content",
+        "size_bytes": size,
+        "content_hash": content_hash
+    }
+
 @app.post("/api/v1/upload")
 async def upload(file: UploadFile = File(...), user_id: str = Depends(verify_token)):
-    file_id = str(uuid.uuid4())
-    dest = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
+    upload_id = str(uuid.uuid4())
+    try:
+        content_hash, size = await upload_store.store(upload_id, _upload_file_chunks(file))
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="文件过大")
+    metrics.UPLOAD_BYTES.inc(size)
+    
+    try:
+        data = await create_attachment(upload_id, user_id, file.filename, file.content_type, content_hash, size)
+    except BaseException:
+        await upload_store.discard(upload_id)
+        raise
+    return {"code": 0, "data": data}
+
+# Resumable uploads: create a session, PUT bytes at the offset the server
+# reports, then complete; a dropped PUT resumes from GET's offset.
+async def get_upload_session(upload_id: str, user_id: str):
+    session = await db.fetch_one(
+        "SELECT * FROM upload_sessions WHERE id = ? AND user_id = ?",
+        (upload_id, user_id)
+    )
+    if not session:
+        raise HTTPException(status_code=404, detail="上传任务不存在")
+    return session
+
+def _upload_status(session: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "upload_id": session["id"],
+        "file_name": session["file_name"],
+        "size_bytes": session["size_bytes"],
+        "offset": session["received_bytes"],
+        "chunk_size": UPLOAD_CHUNK_SIZE
+    }
+
+@app.post("/api/v1/uploads")
+async def create_upload(upload: UploadCreate, user_id: str = Depends(verify_token)):
+    if upload.size_bytes is not None and not 0 <= upload.size_bytes <= MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="文件过大")
+    
+    upload_id = str(uuid.uuid4())
+    await db.execute(
+        "INSERT INTO upload_sessions (id, user_id, file_name, content_type, size_bytes) VALUES (?, ?, ?, ?, ?)",
+        (upload_id, user_id, upload.file_name, upload.content_type, upload.size_bytes)
+    )
+    session = await get_upload_session(upload_id, user_id)
     
-    # Save file
-    with open(dest, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+    return {"code": 0, "data": _upload_status(session)}
+
+@app.get("/api/v1/uploads/{upload_id}")
+async def get_upload(upload_id: str, user_id: str = Depends(verify_token)):
+    session = await get_upload_session(upload_id, user_id)
     
-    # Save to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    return {"code": 0, "data": _upload_status(session)}
+
+@app.put("/api/v1/uploads/{upload_id}")
+async def put_upload_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0),
+    user_id: str = Depends(verify_token),
+):
+    session = await get_upload_session(upload_id, user_id)
+    if offset != session["received_bytes"]:
+        raise HTTPException(
+            status_code=409,
+            detail=f"上传偏移不匹配，应从 {session['received_bytes']} 继续",
+            headers={"Upload-Offset": str(session["received_bytes"])},
+        )
     
-    cursor.execute(
-        """INSERT INTO attachments 
-           (id, file_name, content_type, size_bytes, storage_url) 
-           VALUES (?, ?, ?, ?, ?)""",
-        (file_id, file.filename, file.content_type, os.path.getsize(dest), dest)
+    try:
+        received = await upload_store.append(
+            upload_id, offset, _request_chunks(request), limit=session["size_bytes"]
+        )
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="超出声明的文件大小")
+    except ValueError:
+        raise HTTPException(status_code=409, detail="上传数据不完整，请查询进度后重试")
+    metrics.UPLOAD_BYTES.inc(received - offset)
+    await db.execute(
+        "UPDATE upload_sessions SET received_bytes = ?, updated_at = ? WHERE id = ?",
+        (received, message_timestamp(), upload_id)
     )
+    session["received_bytes"] = received
     
-    conn.commit()
-    conn.close()
-    
-    return {
-        "code": 0,
-        "data": {
-            "file_id": file_id,
-            "file_name": file.filename,
-            "url": f"/tmp/{file_id}_{file.filename}",
-            "size_bytes": os.path.getsize(dest)
-        }
-    }
+    return {"code": 0, "data": _upload_status(session)}
 
-@app.get("/api/v1/attachments")
-async def list_attachments(user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+@app.post("/api/v1/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, user_id: str = Depends(verify_token)):
+    session = await get_upload_session(upload_id, user_id)
+    size = session["received_bytes"]
+    if session["size_bytes"] is not None and size != session["size_bytes"]:
+        raise HTTPException(status_code=409, detail=f"文件尚未上传完成（{size}/{session['size_bytes']}）")
     
-    cursor.execute("SELECT * FROM attachments ORDER BY created_at DESC")
-    attachments = cursor.fetchall()
-    conn.close()
+    try:
+        content_hash = await upload_store.finalize(upload_id, size)
+    except (OSError, ValueError):
+        raise HTTPException(status_code=409, detail="上传数据不完整，请查询进度后重试")
+    data = await create_attachment(
+        upload_id, user_id, session["file_name"], session["content_type"], content_hash, size, session=True
+    )
     
-    return {"code": 0, "data": [dict(att) for att in attachments]}
+    return {"code": 0, "data": data}
 
-# Template endpoints
-@app.get("/api/v1/templates")
-async def list_templates(user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+@app.delete("/api/v1/uploads/{upload_id}")
+async def cancel_upload(upload_id: str, user_id: str = Depends(verify_token)):
+    await get_upload_session(upload_id, user_id)
+    await db.execute("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+    await upload_store.discard(upload_id)
     
-    cursor.execute("SELECT * FROM templates ORDER BY created_at DESC")
-    templates = cursor.fetchall()
-    conn.close()
+    return {"code": 0, "data": {"upload_id": upload_id}}
+
+@app.get("/api/v1/attachments")
+async def list_attachments(
+    limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+    cursor: Optional[str] = None,
+    user_id: str = Depends(verify_token),
+):
+    after, after_params = keyset_clause(cursor)
+    attachments = await db.fetch_all(
+        queries.LIST_ATTACHMENTS.format(after=after),
+        (user_id, *after_params, limit + 1)
+    )
+    attachments, next_cursor = paginate(attachments, limit)
     
-    return {"code": 0, "data": [dict(tpl) for tpl in templates]}
+    return {"code": 0, "data": attachments, "next_cursor": next_cursor}
 
-@app.get("/api/v1/templates/{template_id}")
-async def get_template(template_id: str, user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+@app.api_route("/api/v1/attachments/{file_id}/content", methods=["GET", "HEAD"])
+async def download_attachment(file_id: str, request: Request, user_id: str = Depends(verify_token)):
+    # Attachments uploaded before ownership was recorded have no user_id and
+    # belong to nobody who could be checked, so they are not served
+    attachment = await db.fetch_one(
+        "SELECT * FROM attachments WHERE id = ? AND user_id = ?",
+        (file_id, user_id)
+    )
+    if not attachment:
+        raise HTTPException(status_code=404, detail="附件不存在")
     
-    cursor.execute("SELECT * FROM templates WHERE id = ?", (template_id,))
-    template = cursor.fetchone()
-    conn.close()
+    try:
+        stat_result = await asyncio.get_running_loop().run_in_executor(None, os.stat, attachment["storage_url"])
+    except OSError:
+        raise HTTPException(status_code=404, detail="附件文件不存在")
+    headers = {"Cache-Control": f"private, max-age={DOWNLOAD_MAX_AGE}"}
+    if attachment["content_hash"]:
+        # Attachment content never changes, so its hash is a strong validator
+        headers["ETag"] = quote_etag(attachment["content_hash"])
+    
+    response = FileResponse(
+        attachment["storage_url"],
+        headers=headers,
+        media_type=attachment["content_type"] or None,
+        filename=attachment["file_name"],
+        stat_result=stat_result,
+        content_disposition_type="inline",
+    )
+    response.chunk_size = DOWNLOAD_CHUNK_SIZE
+    if is_not_modified(request, response.headers["etag"], stat_result.st_mtime):
+        return Response(status_code=304, headers={
+            key: response.headers[key] for key in ("etag", "last-modified", "cache-control")
+        })
+    # Range / If-Range are handled by FileResponse; full responses are sent
+    # with http.response.pathsend when the server supports it
+    return response
+
+@app.delete("/api/v1/attachments/{file_id}")
+async def delete_attachment(file_id: str, user_id: str = Depends(verify_token)):
+    async with db.transaction(immediate=True) as tx:
+        attachment = await tx.fetch_one(
+            "SELECT content_hash FROM attachments WHERE id = ? AND user_id = ?" + db.for_update,
+            (file_id, user_id)
+        )
+        if not attachment:
+            raise HTTPException(status_code=404, detail="附件不存在")
+        await lock_blob(tx, attachment["content_hash"])
+        await tx.execute("DELETE FROM attachments WHERE id = ?", (file_id,))
+        path = await release_blob_ref(tx, attachment["content_hash"])
     
-    if not template:
-        raise HTTPException(status_code=404, detail="模板不存在")
+    # Only once the release has committed
+    if path:
+        await remove_unreferenced_blob(db, upload_store, attachment["content_hash"], path)
     
-    template_dict = dict(template)
-    if template_dict.get("fields"):
-        template_dict["fields"] = json.loads(template_dict["fields"])
+    return {"code": 0, "data": {"file_id": file_id}}
+
+# Template endpoints
+# Template reads are answered from the templates table version: a matching
+# If-None-Match costs no database work, and bodies are cached per version.
+# The version is read before the rows, so a body is never older than its ETag.
+@app.get("/api/v1/templates")
+async def list_templates(request: Request, user_id: str = Depends(verify_token)):
+    version = await table_versions.get(db, "templates")
+    not_modified, headers = not_modified_or_headers(request, quote_etag(f"templates-{version}"))
+    if not_modified:
+        return not_modified
+    
+    body = template_bodies.get((version, None))
+    if body is None:
+        templates = await db.fetch_all(queries.LIST_TEMPLATES)
+        body = JSONResponse({"code": 0, "data": templates}).body
+        template_bodies.set((version, None), body)
+    
+    return Response(body, media_type="application/json", headers=headers)
+
+@app.get("/api/v1/templates/{template_id}")
+async def get_template(template_id: str, request: Request, user_id: str = Depends(verify_token)):
+    version = await table_versions.get(db, "templates")
+    not_modified, headers = not_modified_or_headers(request, quote_etag(f"templates-{version}-{template_id}"))
+    if not_modified:
+        return not_modified
+    
+    body = template_bodies.get((version, template_id))
+    if body is None:
+        template_dict = await db.fetch_one("SELECT * FROM templates WHERE id = ?", (template_id,))
+        
+        if not template_dict:
+            raise HTTPException(status_code=404, detail="模板不存在")
+        
+        if template_dict.get("fields"):
+            template_dict["fields"] = json.loads(template_dict["fields"])
+        body = JSONResponse({"code": 0, "data": template_dict}).body
+        template_bodies.set((version, template_id), body)
     
-    return {"code": 0, "data": template_dict}
+    return Response(body, media_type="application/json", headers=headers)
+
+def compile_or_400(template: TemplateCreate):
+    try:
+        return compile_template(template.content, template.fields)
+    except TemplateError as e:
+        raise HTTPException(status_code=400, detail="; ".join(e.errors))
 
 @app.post("/api/v1/templates")
 async def create_template(template: TemplateCreate, user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+    compiled = compile_or_400(template)
     template_id = str(uuid.uuid4())
-    fields_json = json.dumps(template.fields) if template.fields else None
+    fields_json = json.dumps(template.fields or compiled.fields, ensure_ascii=False)
     
-    cursor.execute(
-        "INSERT INTO templates (id, name, description, category, content, fields) VALUES (?, ?, ?, ?, ?, ?)",
-        (template_id, template.name, template.description, template.category, template.content, fields_json)
-    )
+    async with db.transaction() as tx:
+        await tx.execute(
+            "INSERT INTO templates (id, name, description, category, content, fields) VALUES (?, ?, ?, ?, ?, ?)",
+            (template_id, template.name, template.description, template.category, template.content, fields_json)
+        )
+        await search.index(tx, "template", [
+            (template_id, None, search.template_text(template.name, template.description, template.content))
+        ])
+        await versions.bump(tx, "templates")
+    await table_changed("templates")
+    await template_cache.set(template_id, (template.name, compiled))
     
-    conn.commit()
-    conn.close()
+    return {"code": 0, "data": {"id": template_id, "name": template.name}}
+
+@app.put("/api/v1/templates/{template_id}")
+async def update_template(template_id: str, template: TemplateCreate, user_id: str = Depends(verify_token)):
+    compiled = compile_or_400(template)
+    fields_json = json.dumps(template.fields or compiled.fields, ensure_ascii=False)
+    
+    async with db.transaction() as tx:
+        updated = await tx.execute(
+            "UPDATE templates SET name = ?, description = ?, category = ?, content = ?, fields = ? WHERE id = ?",
+            (template.name, template.description, template.category, template.content, fields_json, template_id)
+        )
+        if updated:
+            await search.index(tx, "template", [
+                (template_id, None, search.template_text(template.name, template.description, template.content))
+            ], replace=True)
+            await versions.bump(tx, "templates")
+    # Drop rather than overwrite: a concurrent reader may be caching the old row
+    await template_cache.invalidate(template_id)
+    if updated:
+        await table_changed("templates")
+    
+    if not updated:
+        raise HTTPException(status_code=404, detail="模板不存在")
     
     return {"code": 0, "data": {"id": template_id, "name": template.name}}
 
 # Document generation endpoints
-@app.post("/api/v1/documents")
-async def create_document(doc: DocumentCreate, user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Get template
-    cursor.execute("SELECT * FROM templates WHERE id = ?", (doc.template_id,))
-    template = cursor.fetchone()
-    
-    if not template:
-        conn.close()
+async def get_compiled_template(template_id: str):
+    """(name, CompiledTemplate) for a template, compiled at most once per cache lifetime."""
+    cached = await template_cache.get(template_id)
+    if cached is not None:
+        return cached
+    
+    template_dict = await db.fetch_one(
+        "SELECT name, content, fields FROM templates WHERE id = ?", (template_id,)
+    )
+    if not template_dict:
         raise HTTPException(status_code=404, detail="模板不存在")
     
-    template_dict = dict(template)
+    fields = json.loads(template_dict["fields"]) if template_dict["fields"] else None
+    try:
+        compiled = compile_template(template_dict["content"], fields)
+    except TemplateError as e:
+        raise HTTPException(status_code=400, detail="模板内容无效: " + "; ".join(e.errors))
     
-    # Fill template with data
+    cached = (template_dict["name"], compiled)
+    await template_cache.set(template_id, cached)
+    return cached
+
+@app.post("/api/v1/documents")
+async def create_document(doc: DocumentCreate, user_id: str = Depends(verify_token)):
+    template_name, compiled = await get_compiled_template(doc.template_id)
+    
+    # Fill template with data; reports every missing field at once
     try:
-        content = template_dict["content"].format(**doc.data)
-    except KeyError as e:
-        conn.close()
-        raise HTTPException(status_code=400, detail=f"缺少必填字段: {str(e)}")
+        content = compiled.render(doc.data)
+    except TemplateError as e:
+        raise HTTPException(status_code=400, detail="; ".join(e.errors))
     
     # Create document
     doc_id = str(uuid.uuid4())
-    title = doc.title or template_dict["name"]
-    
-    cursor.execute(
-        "INSERT INTO documents (id, user_id, template_id, title, content, status) VALUES (?, ?, ?, ?, ?, ?)",
-        (doc_id, user_id, doc.template_id, title, content, "completed")
-    )
+    title = doc.title or template_name
     
-    conn.commit()
-    conn.close()
+    async with db.transaction() as tx:
+        await tx.execute(
+            "INSERT INTO documents (id, user_id, template_id, title, content, status) VALUES (?, ?, ?, ?, ?, ?)",
+            (doc_id, user_id, doc.template_id, title, content, "completed")
+        )
+        await search.index(tx, "document", [(doc_id, user_id, search.document_text(title, content))])
     
     return {
         "code": 0,
@@ -621,87 +1131,170 @@ async def create_document(doc: DocumentCreate, user_id: str = Depends(verify_tok
         }
     }
 
-@app.get("/api/v1/documents")
-async def list_documents(user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def _bulk_response(rows, template_id: str, title: str, compiled, user_id: str):
+    return StreamingResponse(
+        generate_documents(db, render_pool, compiled, template_id, title, user_id, rows),
+        media_type="application/x-ndjson",
+    )
+
+@app.post("/api/v1/documents/batch")
+async def create_documents_batch(batch: DocumentBatchCreate, user_id: str = Depends(verify_token)):
+    if len(batch.rows) > BULK_MAX_ROWS:
+        raise HTTPException(status_code=400, detail=f"单次最多生成 {BULK_MAX_ROWS} 份文档")
+    template_name, compiled = await get_compiled_template(batch.template_id)
     
-    cursor.execute(
-        "SELECT * FROM documents WHERE user_id = ? ORDER BY created_at DESC",
-        (user_id,)
+    return _bulk_response(batch.rows, batch.template_id, batch.title or template_name, compiled, user_id)
+
+@app.post("/api/v1/documents/batch/csv")
+async def create_documents_batch_csv(
+    template_id: str = Form(...),
+    title: Optional[str] = Form(None),
+    file: UploadFile = File(...),
+    user_id: str = Depends(verify_token),
+):
+    template_name, compiled = await get_compiled_template(template_id)
+    try:
+        rows = await asyncio.get_running_loop().run_in_executor(
+            render_pool, read_csv_rows, file.file, BULK_MAX_ROWS
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return _bulk_response(rows, template_id, title or template_name, compiled, user_id)
+
+@app.get("/api/v1/documents")
+async def list_documents(
+    limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+    cursor: Optional[str] = None,
+    user_id: str = Depends(verify_token),
+):
+    after, after_params = keyset_clause(cursor)
+    documents = await db.fetch_all(
+        queries.LIST_DOCUMENTS.format(after=after),
+        (user_id, *after_params, limit + 1)
     )
-    documents = cursor.fetchall()
-    conn.close()
+    documents, next_cursor = paginate(documents, limit)
     
-    return {"code": 0, "data": [dict(doc) for doc in documents]}
+    return {"code": 0, "data": documents, "next_cursor": next_cursor}
 
 @app.get("/api/v1/documents/{doc_id}")
-async def get_document(doc_id: str, user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT * FROM documents WHERE id = ? AND user_id = ?", (doc_id, user_id))
-    document = cursor.fetchone()
-    conn.close()
+async def get_document(doc_id: str, request: Request, user_id: str = Depends(verify_token)):
+    # Documents are write-once; the documents version only moves if one is changed.
+    # The ETag is bound to the user, so a 304 never vouches for someone else's document.
+    version = await table_versions.get(db, "documents")
+    tag = hashlib.blake2b(f"{user_id}:{doc_id}:{version}".encode("utf-8"), digest_size=12).hexdigest()
+    not_modified, headers = not_modified_or_headers(request, quote_etag(tag))
+    if not_modified:
+        return not_modified
+    
+    document = await db.fetch_one(
+        "SELECT * FROM documents WHERE id = ? AND user_id = ?", (doc_id, user_id)
+    )
     
     if not document:
         raise HTTPException(status_code=404, detail="文档不存在")
     
-    return {"code": 0, "data": dict(document)}
+    return JSONResponse({"code": 0, "data": document}, headers=headers)
+
+# Search endpoint
+@app.get("/api/v1/search")
+async def search_content(
+    q: str = Query(..., min_length=1, max_length=200),
+    types: Optional[str] = None,
+    limit: int = Query(SEARCH_DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+    cursor: Optional[str] = None,
+    user_id: str = Depends(verify_token),
+):
+    # types: comma-separated subset of message,document,template
+    kinds = [kind.strip() for kind in types.split(",") if kind.strip()] if types else list(search.KINDS)
+    if not kinds or any(kind not in search.KINDS for kind in kinds):
+        raise HTTPException(status_code=400, detail=f"无效的搜索类型，可选: {', '.join(search.KINDS)}")
+    offset = decode_offset_cursor(cursor)
+    if offset + limit > SEARCH_MAX_RESULTS:
+        raise HTTPException(status_code=400, detail=f"最多返回前 {SEARCH_MAX_RESULTS} 条结果，请缩小搜索范围")
+    
+    results, has_more = await search.search(db, user_id, q, kinds, limit, offset)
+    more = has_more and offset + limit < SEARCH_MAX_RESULTS
+    next_cursor = encode_offset_cursor(offset + limit) if more else None
+    
+    return {"code": 0, "data": results, "next_cursor": next_cursor}
 
 # Order and Payment endpoints
-@app.post("/api/v1/orders/create")
-async def create_order(order: OrderCreate, user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    order_id = str(uuid.uuid4())
-    
-    cursor.execute(
-        "INSERT INTO orders (id, user_id, product_type, product_id, amount, status, payment_method) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (order_id, user_id, order.product_type, order.product_id, order.amount, "pending", order.payment_method)
-    )
-    
-    conn.commit()
-    conn.close()
-    
+def _order_created(order_id: str, amount: float, status: str):
     # Mock payment URL/QR code
-    payment_url = f"https://mock-payment.example.com/pay?order_id={order_id}&amount={order.amount}"
+    payment_url = f"https://mock-payment.example.com/pay?order_id={order_id}&amount={amount}"
     
     return {
         "code": 0,
         "data": {
             "order_id": order_id,
-            "amount": order.amount,
-            "status": "pending",
+            "amount": amount,
+            "status": status,
             "payment_url": payment_url,
             "qr_code": f"data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
         }
     }
 
-@app.post("/api/v1/orders/{order_id}/pay")
-async def simulate_payment(order_id: str, user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Verify order belongs to user
-    cursor.execute("SELECT * FROM orders WHERE id = ? AND user_id = ?", (order_id, user_id))
-    order = cursor.fetchone()
-    
-    if not order:
-        conn.close()
-        raise HTTPException(status_code=404, detail="订单不存在")
+@app.post("/api/v1/orders/create")
+async def create_order(
+    order: OrderCreate,
+    response: Response,
+    user_id: str = Depends(verify_token),
+    idempotency_key: Optional[str] = Header(None, max_length=128),
+):
+    order_id = str(uuid.uuid4())
     
-    # Simulate successful payment
-    transaction_id = f"TXN-{uuid.uuid4().hex[:16].upper()}"
+    # A retry with the same Idempotency-Key conflicts on (user_id, idempotency_key)
+    created = await db.execute(
+        "INSERT INTO orders (id, user_id, product_type, product_id, amount, status, payment_method, idempotency_key) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(user_id, idempotency_key) DO NOTHING",
+        (order_id, user_id, order.product_type, order.product_id, order.amount, "pending", order.payment_method,
+         idempotency_key)
+    )
+    if created:
+        return _order_created(order_id, order.amount, "pending")
     
-    cursor.execute(
-        "UPDATE orders SET status = ?, transaction_id = ?, paid_at = ? WHERE id = ?",
-        ("paid", transaction_id, datetime.now(), order_id)
+    existing = await db.fetch_one(
+        queries.ORDER_BY_IDEMPOTENCY_KEY, (user_id, idempotency_key)
     )
+    if (existing["product_type"], existing["product_id"], existing["amount"], existing["payment_method"]) != (
+        order.product_type, order.product_id, order.amount, order.payment_method
+    ):
+        raise HTTPException(status_code=409, detail="该幂等键已用于其他订单请求")
     
-    conn.commit()
-    conn.close()
+    response.headers["Idempotent-Replayed"] = "true"
+    return _order_created(existing["id"], existing["amount"], existing["status"])
+
+@app.post("/api/v1/orders/{order_id}/pay")
+async def simulate_payment(order_id: str, user_id: str = Depends(verify_token)):
+    async with db.transaction(immediate=True) as tx:
+        # Verify order belongs to user
+        order = await tx.fetch_one(
+            "SELECT status, amount, transaction_id, paid_at FROM orders WHERE id = ? AND user_id = ?" + db.for_update,
+            (order_id, user_id)
+        )
+        
+        if not order:
+            raise HTTPException(status_code=404, detail="订单不存在")
+        
+        if order["status"] == "paid":
+            # Repeated pay calls return the original payment
+            return {
+                "code": 0,
+                "data": {
+                    "order_id": order_id,
+                    "status": "paid",
+                    "transaction_id": order["transaction_id"],
+                    "paid_at": datetime.fromisoformat(order["paid_at"]).isoformat()
+                }
+            }
+        
+        # Simulate successful payment
+        transaction_id = f"TXN-{uuid.uuid4().hex[:16].upper()}"
+        paid_at = datetime.utcnow()
+        
+        if not await payments.mark_paid(tx, order_id, order["amount"], transaction_id, paid_at):
+            raise HTTPException(status_code=409, detail="订单状态不允许支付")
     
     return {
         "code": 0,
@@ -709,121 +1302,253 @@ async def simulate_payment(order_id: str, user_id: str = Depends(verify_token)):
             "order_id": order_id,
             "status": "paid",
             "transaction_id": transaction_id,
-            "paid_at": datetime.now().isoformat()
+            "paid_at": paid_at.isoformat()
         }
     }
 
-@app.get("/api/v1/orders")
-async def list_orders(user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+@app.post("/api/v1/orders/{order_id}/refund")
+async def simulate_refund(order_id: str, user_id: str = Depends(verify_token)):
+    async with db.transaction(immediate=True) as tx:
+        order = await tx.fetch_one(
+            "SELECT id, status, amount, paid_at, closed_at FROM orders WHERE id = ? AND user_id = ?" + db.for_update,
+            (order_id, user_id)
+        )
+        
+        if not order:
+            raise HTTPException(status_code=404, detail="订单不存在")
+        
+        if order["status"] == "refunded":
+            # Repeated refund calls return the original refund
+            return {"code": 0, "data": {"order_id": order_id, "status": "refunded", "closed_at": order["closed_at"]}}
+        
+        # Simulate successful refund; only paid orders can be refunded
+        refunded_at = datetime.utcnow()
+        if not await refund_order(tx, order, refunded_at):
+            raise HTTPException(status_code=409, detail="订单状态不允许退款")
+    
+    return {
+        "code": 0,
+        "data": {
+            "order_id": order_id,
+            "status": "refunded",
+            "closed_at": refunded_at.strftime("%Y-%m-%d %H:%M:%S")
+        }
+    }
+
+@app.post("/api/v1/payments/notify/{provider}")
+async def payment_notify(provider: str, request: Request):
+    if provider not in payments.PROVIDERS:
+        raise HTTPException(status_code=404, detail="不支持的支付渠道")
+    if not PAYMENT_NOTIFY_SECRET:
+        raise HTTPException(status_code=503, detail="支付回调未配置")
+    
+    body = await request.body()
+    if not payments.verify(PAYMENT_NOTIFY_SECRET, body, request.headers.get(payments.SIGNATURE_HEADER)):
+        return Response(status_code=401, **payments.acknowledgement(provider, False, "签名错误"))
+    try:
+        notification = payments.parse(provider, body, message_timestamp())
+    except payments.InvalidNotification as e:
+        return Response(status_code=400, **payments.acknowledgement(provider, False, str(e)))
+    
+    key = (provider, notification.transaction_id)
+    if notification.success and applied_notifications.get(key) is None:
+        # Acknowledged only once the batch holding it has committed, so a crash means a provider retry
+        await payment_writer.submit(notification)
+        applied_notifications.set(key, True)
     
-    cursor.execute(
-        "SELECT * FROM orders WHERE user_id = ? ORDER BY created_at DESC",
-        (user_id,)
+    return Response(**payments.acknowledgement(provider, True))
+
+@app.get("/api/v1/orders")
+async def list_orders(
+    limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+    cursor: Optional[str] = None,
+    user_id: str = Depends(verify_token),
+):
+    after, after_params = keyset_clause(cursor)
+    orders = await db.fetch_all(
+        queries.LIST_ORDERS.format(after=after),
+        (user_id, *after_params, limit + 1)
     )
-    orders = cursor.fetchall()
-    conn.close()
+    orders, next_cursor = paginate(orders, limit)
     
-    return {"code": 0, "data": [dict(order) for order in orders]}
+    return {"code": 0, "data": orders, "next_cursor": next_cursor}
 
 @app.get("/api/v1/orders/{order_id}")
 async def get_order(order_id: str, user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT * FROM orders WHERE id = ? AND user_id = ?", (order_id, user_id))
-    order = cursor.fetchone()
-    conn.close()
+    order = await db.fetch_one(
+        "SELECT * FROM orders WHERE id = ? AND user_id = ?", (order_id, user_id)
+    )
     
     if not order:
         raise HTTPException(status_code=404, detail="订单不存在")
     
-    return {"code": 0, "data": dict(order)}
+    return {"code": 0, "data": order}
 
 # Admin endpoints
 @app.get("/api/v1/admin/users")
-async def admin_list_users(user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT * FROM users ORDER BY created_at DESC")
-    users = cursor.fetchall()
-    conn.close()
+async def admin_list_users(
+    limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+    cursor: Optional[str] = None,
+    user_id: str = Depends(verify_token),
+):
+    after, after_params = keyset_clause(cursor, prefix="WHERE")
+    users = await db.fetch_all(
+        queries.ADMIN_LIST_USERS.format(after=after),
+        (*after_params, limit + 1)
+    )
+    users, next_cursor = paginate(users, limit)
     
-    return {"code": 0, "data": [dict(user) for user in users]}
+    return {"code": 0, "data": users, "next_cursor": next_cursor}
 
 @app.get("/api/v1/admin/conversations")
-async def admin_list_conversations(user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT c.*, u.phone, u.name as user_name
-        FROM conversations c
-        LEFT JOIN users u ON c.user_id = u.id
-        ORDER BY c.created_at DESC
-    """)
-    conversations = cursor.fetchall()
-    conn.close()
+async def admin_list_conversations(
+    limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+    cursor: Optional[str] = None,
+    user_id: str = Depends(verify_token),
+):
+    after, after_params = keyset_clause(cursor, prefix="WHERE", alias="c")
+    conversations = await db.fetch_all(
+        queries.ADMIN_LIST_CONVERSATIONS.format(after=after), (*after_params, limit + 1)
+    )
+    conversations, next_cursor = paginate(conversations, limit)
     
-    return {"code": 0, "data": [dict(conv) for conv in conversations]}
+    return {"code": 0, "data": conversations, "next_cursor": next_cursor}
 
 @app.get("/api/v1/admin/orders")
-async def admin_list_orders(user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT o.*, u.phone, u.name as user_name
-        FROM orders o
-        LEFT JOIN users u ON o.user_id = u.id
-        ORDER BY o.created_at DESC
-    """)
-    orders = cursor.fetchall()
-    conn.close()
+async def admin_list_orders(
+    limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+    cursor: Optional[str] = None,
+    status: Optional[str] = Query(None, pattern=f"^({'|'.join(ORDER_STATUSES)})$"),
+    user_id: str = Depends(verify_token),
+):
+    where, where_params = ("WHERE o.status = ?", (status,)) if status else ("", ())
+    after, after_params = keyset_clause(cursor, prefix="AND" if status else "WHERE", alias="o")
+    orders = await db.fetch_all(
+        queries.ADMIN_LIST_ORDERS.format(where=where, after=after), (*where_params, *after_params, limit + 1)
+    )
+    orders, next_cursor = paginate(orders, limit)
     
-    return {"code": 0, "data": [dict(order) for order in orders]}
+    return {"code": 0, "data": orders, "next_cursor": next_cursor}
+
+@app.get("/api/v1/admin/export/{kind}")
+async def admin_export(
+    kind: str,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    status: Optional[str] = None,
+    user_id: str = Depends(verify_token),
+):
+    if kind not in EXPORTS:
+        raise HTTPException(status_code=404, detail="不支持的导出类型")
+    if status and kind not in STATUS_EXPORTS:
+        raise HTTPException(status_code=400, detail="该导出类型不支持按状态筛选")
+    
+    filename = f"{kind}-{datetime.now().strftime('%Y%m%d%H%M%S')}.{format}"
+    return StreamingResponse(
+        stream_export(db, kind, format, start=start, end=end, status=status),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 @app.get("/api/v1/admin/stats")
 async def admin_get_stats(user_id: str = Depends(verify_token)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Get various statistics
-    cursor.execute("SELECT COUNT(*) FROM users")
-    total_users = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM conversations")
-    total_conversations = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM messages")
-    total_messages = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM orders WHERE status = 'paid'")
-    paid_orders = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT SUM(amount) FROM orders WHERE status = 'paid'")
-    total_revenue = cursor.fetchone()[0] or 0
-    
-    conn.close()
+    # Counters are maintained on write (see stats.py), so this is a single small read
+    totals = await stats.totals(db)
     
     return {
         "code": 0,
         "data": {
-            "total_users": total_users,
-            "total_conversations": total_conversations,
-            "total_messages": total_messages,
-            "paid_orders": paid_orders,
-            "total_revenue": total_revenue
+            "total_users": int(totals["users"]),
+            "total_conversations": int(totals["conversations"]),
+            "total_messages": int(totals["messages"]),
+            "paid_orders": int(totals["paid_orders"]),
+            "total_revenue": totals["revenue"]
+        }
+    }
+
+@app.get("/api/v1/admin/stats/rollups")
+async def admin_get_stats_rollups(
+    granularity: str = Query("day", pattern="^(day|hour)$"),
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    user_id: str = Depends(verify_token),
+):
+    buckets = await stats.rollups(db, granularity, start, end)
+    
+    return {"code": 0, "data": buckets}
+
+@app.get("/api/v1/admin/db-pool")
+async def admin_get_db_pool(user_id: str = Depends(verify_token)):
+    return {"code": 0, "data": db.stats()}
+
+@app.get("/api/v1/admin/caches")
+async def admin_get_caches(user_id: str = Depends(verify_token)):
+    return {
+        "code": 0,
+        "data": {
+            "tokens": token_cache.stats(),
+            "users": user_cache.stats(),
+            "templates": template_cache.stats(),
+            "conversations": conversation_cache.stats(),
+            "versions": table_versions.stats(),
+            "bus": cache_bus.stats()
         }
     }
 
+@app.get("/api/v1/admin/profiles")
+async def admin_list_profiles(
+    limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+    user_id: str = Depends(verify_token)
+):
+    profiles = await asyncio.get_running_loop().run_in_executor(None, profile_store.list, limit)
+    return {"code": 0, "data": profiles}
+
+@app.get("/api/v1/admin/profiles/{profile_id}")
+async def admin_get_profile(
+    profile_id: str,
+    format: str = Query("json", pattern="^(json|folded)$"),
+    user_id: str = Depends(verify_token)
+):
+    profile = await asyncio.get_running_loop().run_in_executor(None, profile_store.get, profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="性能剖析记录不存在")
+    
+    if format == "folded":
+        # Input for flamegraph.pl or speedscope
+        return Response(profiling.folded(profile), media_type="text/plain; charset=utf-8")
+    return {"code": 0, "data": profile}
+
+@app.get("/api/v1/admin/startup")
+async def admin_get_startup(user_id: str = Depends(verify_token)):
+    # Of the worker that answered
+    return {"code": 0, "data": startup_report.to_dict()}
+
+@app.get("/api/v1/admin/writers")
+async def admin_get_writers(user_id: str = Depends(verify_token)):
+    return {"code": 0, "data": {"messages": message_writer.stats(), "payments": payment_writer.stats()}}
+
+@app.get("/api/v1/admin/order-sweeper")
+async def admin_get_order_sweeper(user_id: str = Depends(verify_token)):
+    return {"code": 0, "data": order_sweeper.stats()}
+
+@app.get("/api/v1/admin/admission")
+async def admin_get_admission(user_id: str = Depends(verify_token)):
+    # Of the worker that answered
+    return {"code": 0, "data": {"enabled": ADMISSION_ENABLED, **admission_control.stats()}}
+
+# Prometheus scrape endpoint
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 # Health check endpoint
 @app.get("/api/v1/health")
 async def health_check():
     return {"code": 0, "message": "SalaryHelper API is running"}
 
+startup_report.imports_done()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,189 @@
+"""Prometheus metrics, served at ``/metrics``.
+
+Requests are timed per route template (``/api/v1/conversations/{convId}``,
+not the concrete path) and status by a plain ASGI middleware. Database
+statements are timed per ``<VERB> <table>``, the label being derived once
+per distinct SQL string. Pool gauges are read from ``db.stats()`` at scrape
+time, so they add nothing to the request path, as are the admission
+control gauges (see admission.py).
+
+With several worker processes, set ``PROMETHEUS_MULTIPROC_DIR`` to an
+empty directory shared by the workers so a scrape sees all of them; the
+pool gauges then describe the worker that answered the scrape.
+"""
+import os
+import re
+import time
+from functools import lru_cache
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template",
+    ["method", "route", "status"], buckets=REQUEST_BUCKETS,
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "HTTP requests being handled", multiprocess_mode="livesum",
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Database statement latency, including waiting for a pool thread",
+    ["statement"], buckets=DB_BUCKETS,
+)
+DB_COMMIT_DURATION = Histogram(
+    "db_commit_duration_seconds", "Database transaction commit latency", buckets=DB_BUCKETS,
+)
+TIME_TO_READY = Gauge(
+    "app_time_to_ready_seconds", "Seconds from process start until the worker was ready to serve",
+    multiprocess_mode="max",
+)
+UPLOAD_BYTES = Counter("upload_bytes", "Attachment bytes received from clients")
+ORDERS_EXPIRED = Counter("orders_expired", "Pending orders expired by the sweeper")
+ORDER_SWEEP_DURATION = Histogram(
+    "order_sweep_duration_seconds", "Duration of a full pending-order expiry sweep", buckets=REQUEST_BUCKETS,
+)
+ORDER_SWEEP_LAG = Gauge(
+    "order_sweep_lag_seconds", "How far past its expiry the oldest pending order is", multiprocess_mode="max",
+)
+ORDER_SWEEP_LAST_SUCCESS = Gauge(
+    "order_sweep_last_success_timestamp_seconds", "Unix time of the last completed expiry sweep",
+    multiprocess_mode="max",
+)
+ADMISSION_REJECTED = Counter(
+    "admission_rejected", "Requests shed by admission control", ["limiter", "reason"],
+)
+ADMISSION_QUEUE_WAIT = Histogram(
+    "admission_queue_wait_seconds", "Time queued requests waited for a concurrency slot",
+    ["limiter"], buckets=REQUEST_BUCKETS,
+)
+
+_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", re.IGNORECASE)
+
+
+def statement_name(sql: str) -> str:
+    """``SELECT messages``, ``INSERT stats_counters``...: bounded label cardinality."""
+    words = sql.split(None, 1)
+    verb = words[0].upper() if words else "?"
+    table = _TABLE.search(sql)
+    return f"{verb} {table.group(1).lower()}" if table else verb
+
+
+@lru_cache(maxsize=4096)
+def _query_histogram(sql: str):
+    return DB_QUERY_DURATION.labels(statement_name(sql))
+
+
+@lru_cache(maxsize=4096)
+def _request_histogram(method: str, route: str, status: int):
+    return REQUEST_DURATION.labels(method, route, str(status))
+
+
+def observe_query(sql: str, seconds: float) -> None:
+    _query_histogram(sql).observe(seconds)
+
+
+class PoolCollector:
+    def __init__(self, db):
+        self.db = db
+
+    def collect(self):
+        stats = self.db.stats()
+        connections = GaugeMetricFamily(
+            "db_pool_connections", "Database pool connections by state", labels=["state"],
+        )
+        for state in ("open", "idle", "in_use", "waiting"):
+            connections.add_metric([state], stats[state])
+        yield connections
+        yield GaugeMetricFamily("db_pool_size", "Database pool size limit", value=stats["size"])
+        yield CounterMetricFamily("db_pool_acquires", "Connections handed out", value=stats["acquires"])
+        yield CounterMetricFamily(
+            "db_pool_timeouts", "Requests that gave up waiting for a connection", value=stats["timeouts"],
+        )
+        yield CounterMetricFamily(
+            "db_pool_wait_seconds", "Time spent waiting for a connection",
+            value=stats["wait_time_total_ms"] / 1000,
+        )
+
+
+class AdmissionCollector:
+    def __init__(self, controller):
+        self.controller = controller
+
+    def collect(self):
+        requests = GaugeMetricFamily(
+            "admission_requests", "Requests holding or waiting for a concurrency slot", labels=["limiter", "state"],
+        )
+        limits = [self.controller.limit] + [rule.limit for rule in self.controller.rules if rule.limit is not None]
+        for limit in limits:
+            stats = limit.stats()
+            requests.add_metric([limit.name, "active"], stats["active"])
+            requests.add_metric([limit.name, "waiting"], stats["waiting"])
+        yield requests
+
+
+# Read at scrape time, so in multiprocess mode they describe the worker that answered
+_collectors = []
+
+
+def _register(collector) -> None:
+    REGISTRY.register(collector)
+    _collectors.append(collector)
+
+
+def instrument_database(db) -> None:
+    db.on_query = observe_query
+    db.on_commit = DB_COMMIT_DURATION.observe
+    _register(PoolCollector(db))
+
+
+def instrument_admission(controller) -> None:
+    _register(AdmissionCollector(controller))
+
+
+def render() -> bytes:
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return generate_latest(REGISTRY)
+    from prometheus_client import multiprocess
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    for collector in _collectors:
+        registry.register(collector)
+    return generate_latest(registry)
+
+
+class MetricsMiddleware:
+    """Times each HTTP request; streaming responses are timed until their last chunk."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        REQUESTS_IN_PROGRESS.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUESTS_IN_PROGRESS.dec()
+            # FastAPI records the matched route in the scope
+            route = scope.get("route")
+            _request_histogram(
+                scope["method"], route.path if route is not None else "unmatched", status,
+            ).observe(time.perf_counter() - started)
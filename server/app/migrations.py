@@ -0,0 +1,638 @@
+"""Versioned schema migrations.
+
+Workers apply pending migrations on startup unless ``DB_MIGRATE_ON_STARTUP=0``;
+in that case run them once out-of-band before rolling out::
+
+    python -m app.migrations            # apply pending migrations
+    python -m app.migrations --check    # also verify hot queries use indexes
+
+PostgreSQL databases are created from :data:`POSTGRES_MIGRATIONS`, which
+starts from the schema SQLite had at version 7; later migrations are added
+to both lists under the same version.
+"""
+import argparse
+import asyncio
+import sys
+from typing import Dict, List
+
+from . import export, orders, payments, queries, search, stats, uploads, versions
+
+SCHEMA_TABLE = "schema_version"
+
+
+# (id, name, description, category, content, fields)
+DEFAULT_TEMPLATES = [
+    (
+        "tpl-001",
+        "劳动仲裁申请书",
+        "用于提交劳动仲裁申请的标准模板",
+        "仲裁",
+        """劳动仲裁申请书
+
+申请人：{applicant_name}
+性别：{applicant_gender}
+身份证号：{applicant_id}
+联系电话：{applicant_phone}
+住址：{applicant_address}
+
+被申请人：{respondent_name}
+法定代表人：{respondent_legal_rep}
+地址：{respondent_address}
+联系电话：{respondent_phone}
+
+仲裁请求：
+{arbitration_requests}
+
+事实与理由：
+{facts_and_reasons}
+
+证据材料清单：
+{evidence_list}
+
+此致
+{arbitration_committee}
+
+申请人：{applicant_name}
+日期：{application_date}""",
+        '["applicant_name","applicant_gender","applicant_id","applicant_phone","applicant_address","respondent_name","respondent_legal_rep","respondent_address","respondent_phone","arbitration_requests","facts_and_reasons","evidence_list","arbitration_committee","application_date"]'
+    ),
+    (
+        "tpl-002",
+        "工资支付申诉书",
+        "用于申诉拖欠工资问题",
+        "工资",
+        """工资支付申诉书
+
+申诉人：{complainant_name}
+身份证号：{complainant_id}
+联系方式：{complainant_contact}
+
+被申诉人：{company_name}
+统一社会信用代码：{company_code}
+联系地址：{company_address}
+
+申诉事项：
+本人于{employment_start}至{employment_end}期间在被申诉人处工作，岗位为{position}。
+被申诉人拖欠本人工资共计人民币{amount}元，具体如下：
+{wage_details}
+
+证据：
+{evidence_list}
+
+请求：
+{requests}
+
+申诉人：{complainant_name}
+日期：{date}""",
+        '["complainant_name","complainant_id","complainant_contact","company_name","company_code","company_address","employment_start","employment_end","position","amount","wage_details","evidence_list","requests","date"]'
+    ),
+    (
+        "tpl-003",
+        "劳动合同解除通知书",
+        "用于通知解除劳动合同",
+        "合同",
+        """劳动合同解除通知书
+
+{employee_name}：
+
+根据《劳动合同法》第{article_number}条规定，因{termination_reason}，公司决定于{termination_date}与您解除劳动合同。
+
+解除理由详述：
+{detailed_reason}
+
+补偿说明：
+{compensation_details}
+
+请您于{handover_date}前办理工作交接手续。
+
+特此通知。
+
+{company_name}
+日期：{notice_date}""",
+        '["employee_name","article_number","termination_reason","termination_date","detailed_reason","compensation_details","handover_date","company_name","notice_date"]'
+    )
+]
+
+_INSERT_TEMPLATE = "INSERT INTO templates (id, name, description, category, content, fields) VALUES (?, ?, ?, ?, ?, ?)"
+
+
+def _baseline(conn):
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    
+    # Users table
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id TEXT PRIMARY KEY,
+        phone TEXT UNIQUE NOT NULL,
+        name TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    
+    # Conversations table
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS conversations (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        title TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    """)
+    
+    # Messages table
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS messages (
+        id TEXT PRIMARY KEY,
+        conversation_id TEXT NOT NULL,
+        sender TEXT NOT NULL,
+        sender_id TEXT,
+        content TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+    )
+    """)
+    
+    # Attachments table
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS attachments (
+        id TEXT PRIMARY KEY,
+        file_name TEXT NOT NULL,
+        content_type TEXT,
+        size_bytes INTEGER,
+        storage_url TEXT,
+        preview_url TEXT,
+        metadata TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    
+    # Templates table for document generation
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS templates (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        description TEXT,
+        category TEXT,
+        content TEXT NOT NULL,
+        fields TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    
+    # Documents table for generated documents
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS documents (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        template_id TEXT,
+        title TEXT NOT NULL,
+        content TEXT NOT NULL,
+        status TEXT DEFAULT 'draft',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (template_id) REFERENCES templates (id)
+    )
+    """)
+    
+    # Orders table for payment system
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS orders (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        product_type TEXT NOT NULL,
+        product_id TEXT,
+        amount REAL NOT NULL,
+        status TEXT DEFAULT 'pending',
+        payment_method TEXT,
+        transaction_id TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        paid_at TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    """)
+    
+    # Insert default templates
+    cursor.execute("SELECT COUNT(*) FROM templates")
+    count = cursor.fetchone()[0]
+    if count == 0:
+        cursor.executemany(_INSERT_TEMPLATE, DEFAULT_TEMPLATES)
+
+
+# Composite indexes matching the WHERE + ORDER BY of the list endpoints, plus
+# a covering index for the paid-orders stats aggregates.
+HOT_PATH_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_conversations_user_created ON conversations (user_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_conversations_created ON conversations (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_messages_conversation_created ON messages (conversation_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_documents_user_created ON documents (user_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders (user_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_status_amount ON orders (status, amount)",
+    "CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_attachments_created ON attachments (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_templates_created ON templates (created_at)",
+]
+
+# Keyset pagination orders by (created_at, id); rebuild the list indexes with
+# id as the trailing column so seeks and ordering need no temp b-tree.
+KEYSET_INDEXES = [
+    "DROP INDEX IF EXISTS idx_conversations_user_created",
+    "CREATE INDEX idx_conversations_user_created ON conversations (user_id, created_at, id)",
+    "DROP INDEX IF EXISTS idx_conversations_created",
+    "CREATE INDEX idx_conversations_created ON conversations (created_at, id)",
+    "DROP INDEX IF EXISTS idx_messages_conversation_created",
+    "CREATE INDEX idx_messages_conversation_created ON messages (conversation_id, created_at, id)",
+    "DROP INDEX IF EXISTS idx_documents_user_created",
+    "CREATE INDEX idx_documents_user_created ON documents (user_id, created_at, id)",
+    "DROP INDEX IF EXISTS idx_orders_user_created",
+    "CREATE INDEX idx_orders_user_created ON orders (user_id, created_at, id)",
+    "DROP INDEX IF EXISTS idx_orders_created",
+    "CREATE INDEX idx_orders_created ON orders (created_at, id)",
+    "DROP INDEX IF EXISTS idx_users_created",
+    "CREATE INDEX idx_users_created ON users (created_at, id)",
+    "DROP INDEX IF EXISTS idx_attachments_created",
+    "CREATE INDEX idx_attachments_created ON attachments (created_at, id)",
+]
+
+# Digests of logged-out tokens until they would have expired anyway
+REVOKED_TOKENS = [
+    """CREATE TABLE IF NOT EXISTS revoked_tokens (
+        digest TEXT PRIMARY KEY,
+        expires_at TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_revoked_tokens_expires ON revoked_tokens (expires_at)",
+]
+
+# Attachments are listed per owner; the old index only served listing everyone's
+ATTACHMENT_OWNER_INDEX = [
+    "DROP INDEX IF EXISTS idx_attachments_created",
+    "CREATE INDEX IF NOT EXISTS idx_attachments_user_created ON attachments (user_id, created_at, id)",
+]
+
+# (version, description, steps); a step is an SQL string or a callable taking the connection
+MIGRATIONS = [
+    (1, "baseline schema and default templates", [_baseline]),
+    (2, "hot-path indexes", HOT_PATH_INDEXES),
+    (3, "keyset pagination indexes", KEYSET_INDEXES),
+    (4, "order export by status index", [
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at, id)",
+    ]),
+    (5, "incremental stats counters and rollups", [
+        # Lets the reconciler recompute recent message rollups without a full scan
+        "CREATE INDEX IF NOT EXISTS idx_messages_created ON messages (created_at)",
+        stats.backfill,
+    ]),
+    (6, "content-addressed attachments and resumable uploads", uploads.SCHEMA),
+    (7, "full-text search index", [search.backfill]),
+    (8, "table version counters", versions.SCHEMA),
+    (9, "order idempotency keys and payment notifications", payments.SCHEMA),
+    (10, "order closing time", orders.SCHEMA),
+    (11, "logged-out tokens", REVOKED_TOKENS),
+    (12, "attachments by owner index", ATTACHMENT_OWNER_INDEX),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Timestamps stay TEXT in the SQLite CURRENT_TIMESTAMP format so keyset
+# cursors, rollup buckets and message timestamps compare the same way
+_PG_NOW = "TEXT DEFAULT to_char(timezone('UTC', now()), 'YYYY-MM-DD HH24:MI:SS')"
+
+POSTGRES_SCHEMA = [
+    f"""CREATE TABLE IF NOT EXISTS users (
+        id TEXT PRIMARY KEY,
+        phone TEXT UNIQUE NOT NULL,
+        name TEXT,
+        created_at {_PG_NOW}
+    )""",
+    f"""CREATE TABLE IF NOT EXISTS conversations (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL REFERENCES users (id),
+        title TEXT NOT NULL,
+        created_at {_PG_NOW}
+    )""",
+    f"""CREATE TABLE IF NOT EXISTS messages (
+        id TEXT PRIMARY KEY,
+        conversation_id TEXT NOT NULL REFERENCES conversations (id),
+        sender TEXT NOT NULL,
+        sender_id TEXT,
+        content TEXT NOT NULL,
+        created_at {_PG_NOW}
+    )""",
+    f"""CREATE TABLE IF NOT EXISTS attachments (
+        id TEXT PRIMARY KEY,
+        file_name TEXT NOT NULL,
+        content_type TEXT,
+        size_bytes BIGINT,
+        storage_url TEXT,
+        preview_url TEXT,
+        metadata TEXT,
+        created_at {_PG_NOW},
+        user_id TEXT,
+        content_hash TEXT
+    )""",
+    f"""CREATE TABLE IF NOT EXISTS templates (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        description TEXT,
+        category TEXT,
+        content TEXT NOT NULL,
+        fields TEXT,
+        created_at {_PG_NOW}
+    )""",
+    f"""CREATE TABLE IF NOT EXISTS documents (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL REFERENCES users (id),
+        template_id TEXT REFERENCES templates (id),
+        title TEXT NOT NULL,
+        content TEXT NOT NULL,
+        status TEXT DEFAULT 'draft',
+        created_at {_PG_NOW}
+    )""",
+    f"""CREATE TABLE IF NOT EXISTS orders (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL REFERENCES users (id),
+        product_type TEXT NOT NULL,
+        product_id TEXT,
+        amount DOUBLE PRECISION NOT NULL,
+        status TEXT DEFAULT 'pending',
+        payment_method TEXT,
+        transaction_id TEXT,
+        created_at {_PG_NOW},
+        paid_at TEXT
+    )""",
+    f"""CREATE TABLE IF NOT EXISTS blobs (
+        hash TEXT PRIMARY KEY,
+        size_bytes BIGINT NOT NULL,
+        storage_path TEXT NOT NULL,
+        ref_count INTEGER NOT NULL DEFAULT 0,
+        created_at {_PG_NOW}
+    )""",
+    f"""CREATE TABLE IF NOT EXISTS upload_sessions (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        file_name TEXT NOT NULL,
+        content_type TEXT,
+        size_bytes BIGINT,
+        received_bytes BIGINT NOT NULL DEFAULT 0,
+        created_at {_PG_NOW},
+        updated_at {_PG_NOW}
+    )""",
+    *stats.SCHEMA,
+    *search.POSTGRES_SCHEMA,
+    # Final state of the SQLite index migrations (2-6)
+    *[sql.replace("CREATE INDEX ", "CREATE INDEX IF NOT EXISTS ") for sql in KEYSET_INDEXES if sql.startswith("CREATE")],
+    "CREATE INDEX IF NOT EXISTS idx_orders_status_amount ON orders (status, amount)",
+    "CREATE INDEX IF NOT EXISTS idx_templates_created ON templates (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_messages_created ON messages (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_attachments_hash ON attachments (content_hash)",
+]
+
+
+async def _seed_postgres(tx):
+    if await tx.fetch_val("SELECT COUNT(*) FROM templates"):
+        return
+    await tx.execute_many(_INSERT_TEMPLATE, DEFAULT_TEMPLATES)
+    await search.index(tx, "template", [
+        (template_id, None, search.template_text(name, description, content))
+        for template_id, name, description, _, content, _ in DEFAULT_TEMPLATES
+    ])
+    for sql, params in stats.reconcile_statements():
+        await tx.execute(sql, params)
+
+
+# Same shape as MIGRATIONS; steps are SQL strings or async callables taking a transaction
+POSTGRES_MIGRATIONS = [
+    (7, "baseline schema and default templates", [*POSTGRES_SCHEMA, _seed_postgres]),
+    (8, "table version counters", versions.SCHEMA),
+    (9, "order idempotency keys and payment notifications", payments.SCHEMA),
+    (10, "order closing time", orders.SCHEMA),
+    (11, "logged-out tokens", REVOKED_TOKENS),
+    (12, "attachments by owner index", ATTACHMENT_OWNER_INDEX),
+]
+
+assert POSTGRES_MIGRATIONS[-1][0] == LATEST_VERSION, "PostgreSQL migrations are behind SQLite"
+
+# pg_advisory_xact_lock key serializing workers that migrate at the same time
+POSTGRES_LOCK_ID = 0x5A1A4E1
+
+# Endpoint queries that must be served by an index (checked with --check)
+HOT_QUERIES = {
+    "list_conversations": (
+        queries.LIST_CONVERSATIONS.format(after=queries.seek()), ("u", "t", "i", 51)),
+    "get_conversation.messages": (
+        queries.CONVERSATION_MESSAGES.format(after=queries.seek(descending=False)), ("c", "t", "i", 51)),
+    "get_conversation.tail": (queries.CONVERSATION_LATEST.format(before=""), ("c", 201)),
+    "get_conversation.before": (
+        queries.CONVERSATION_LATEST.format(before=queries.seek()), ("c", "t", "i", 51)),
+    "list_attachments": (
+        queries.LIST_ATTACHMENTS.format(after=queries.seek()), ("u", "t", "i", 51)),
+    "list_templates": (queries.LIST_TEMPLATES, ()),
+    "list_documents": (
+        queries.LIST_DOCUMENTS.format(after=queries.seek()), ("u", "t", "i", 51)),
+    "list_orders": (
+        queries.LIST_ORDERS.format(after=queries.seek()), ("u", "t", "i", 51)),
+    "admin_list_users": (
+        queries.ADMIN_LIST_USERS.format(after=queries.seek("WHERE")), ("t", "i", 51)),
+    "admin_list_conversations": (
+        queries.ADMIN_LIST_CONVERSATIONS.format(after=queries.seek("WHERE", "c")), ("t", "i", 51)),
+    "admin_list_orders": (
+        queries.ADMIN_LIST_ORDERS.format(where="", after=queries.seek("WHERE", "o")), ("t", "i", 51)),
+    "admin_list_orders.status": (
+        queries.ADMIN_LIST_ORDERS.format(where="WHERE o.status = ?", after=queries.seek("AND", "o")),
+        ("pending", "t", "i", 51)),
+    "admin_export.orders": (
+        export.chunk_query("orders", "s", "e", last=("t", "i"))[0], ("s", "e", "t", "i", 500)),
+    "admin_export.orders_by_status": (
+        export.chunk_query("orders", "s", "e", "paid", ("t", "i"))[0], ("s", "e", "paid", "t", "i", 500)),
+    "create_order.idempotency_key": (queries.ORDER_BY_IDEMPOTENCY_KEY, ("u", "k")),
+    "orders.expire_batch": (orders.EXPIRE_CANDIDATES, ("t", 500)),
+    "orders.oldest_pending": (orders.OLDEST_PENDING, ()),
+    "stats.reconcile.paid_orders": (stats.total_query("paid_orders"), ()),
+    "stats.reconcile.revenue": (stats.total_query("revenue"), ()),
+}
+
+
+def current_version(conn) -> int:
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SCHEMA_TABLE,)
+    ).fetchone()
+    if not exists:
+        return 0
+    row = conn.execute(f"SELECT MAX(version) FROM {SCHEMA_TABLE}").fetchone()
+    value = next(iter(row.values())) if isinstance(row, dict) else row[0]
+    return value or 0
+
+
+def enable_wal(conn) -> str:
+    """Switch the database file to WAL journaling (persistent across connections)."""
+    row = conn.execute("PRAGMA journal_mode = WAL").fetchone()
+    return next(iter(row.values())) if isinstance(row, dict) else row[0]
+
+
+def migrate(conn) -> List[int]:
+    """Apply pending migrations, each in its own transaction; returns applied versions."""
+    enable_wal(conn)
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    applied = []
+    try:
+        conn.execute(
+            f"""CREATE TABLE IF NOT EXISTS {SCHEMA_TABLE} (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )"""
+        )
+        for version, description, steps in MIGRATIONS:
+            # IMMEDIATE takes the write lock up front so concurrent workers
+            # serialize here and re-read the version once they get it
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if version <= current_version(conn):
+                    conn.execute("COMMIT")
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute(
+                    f"INSERT INTO {SCHEMA_TABLE} (version, description) VALUES (?, ?)",
+                    (version, description),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            applied.append(version)
+    finally:
+        conn.isolation_level = isolation_level
+    return applied
+
+
+async def migrate_postgres(db) -> List[int]:
+    """Apply pending :data:`POSTGRES_MIGRATIONS`, each in its own transaction."""
+    lock = "SELECT pg_advisory_xact_lock(?)"
+    async with db.transaction() as tx:
+        await tx.execute(lock, (POSTGRES_LOCK_ID,))
+        await tx.execute(
+            f"""CREATE TABLE IF NOT EXISTS {SCHEMA_TABLE} (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at {_PG_NOW}
+            )"""
+        )
+    applied = []
+    for version, description, steps in POSTGRES_MIGRATIONS:
+        async with db.transaction() as tx:
+            # Concurrent workers queue on the lock and re-read the version once they hold it
+            await tx.execute(lock, (POSTGRES_LOCK_ID,))
+            if version <= await tx.fetch_val(f"SELECT COALESCE(MAX(version), 0) FROM {SCHEMA_TABLE}"):
+                continue
+            for step in steps:
+                if callable(step):
+                    await step(tx)
+                else:
+                    await tx.execute(step)
+            await tx.execute(
+                f"INSERT INTO {SCHEMA_TABLE} (version, description) VALUES (?, ?)",
+                (version, description),
+            )
+        applied.append(version)
+    return applied
+
+
+def _migrate_sqlite(db) -> List[int]:
+    conn = db.connect()
+    try:
+        return migrate(conn)
+    finally:
+        conn.close()
+
+
+async def schema_version(db) -> int:
+    """Applied version of a :func:`app.db.create_database` database, read without taking any lock."""
+    if db.dialect == "postgres":
+        exists = await db.fetch_val("SELECT to_regclass(?) IS NOT NULL", (SCHEMA_TABLE,))
+    else:
+        exists = await db.fetch_val(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (SCHEMA_TABLE,)
+        )
+    if not exists:
+        return 0
+    return await db.fetch_val(f"SELECT COALESCE(MAX(version), 0) FROM {SCHEMA_TABLE}")
+
+
+async def migrate_database(db) -> List[int]:
+    """Apply pending migrations to a :func:`app.db.create_database` database."""
+    # Every worker start after the first: one read instead of a locked transaction per migration
+    if await schema_version(db) >= LATEST_VERSION:
+        return []
+    if db.dialect == "postgres":
+        return await migrate_postgres(db)
+    return await asyncio.get_running_loop().run_in_executor(None, _migrate_sqlite, db)
+
+
+def check_query_plans(conn) -> Dict[str, List[str]]:
+    """Return the plan lines of every hot query that scans a table or sorts."""
+    problems = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        details = [row["detail"] if isinstance(row, dict) else row[3] for row in rows]
+        bad = [
+            detail for detail in details
+            if (detail.startswith("SCAN") and "INDEX" not in detail)
+            or "TEMP B-TREE" in detail
+        ]
+        if bad:
+            problems[name] = bad
+    return problems
+
+
+def main(argv=None) -> int:
+    from .config import DATABASE_URL
+    from .db import create_database
+
+    parser = argparse.ArgumentParser(description="Apply SalaryHelper schema migrations")
+    parser.add_argument("--database", default=DATABASE_URL, help="SQLite path or postgresql:// URL")
+    parser.add_argument("--check", action="store_true", help="verify hot queries use indexes")
+    args = parser.parse_args(argv)
+
+    db = create_database(args.database)
+    if db.dialect == "postgres":
+        return asyncio.run(_main_postgres(db, args.check))
+
+    conn = db.connect()
+    try:
+        applied = migrate(conn)
+        print(f"schema version {current_version(conn)} (applied: {applied or 'none'})")
+        if args.check:
+            problems = check_query_plans(conn)
+            for name, details in problems.items():
+                print(f"{name}: {'; '.join(details)}")
+            if problems:
+                return 1
+            print(f"all {len(HOT_QUERIES)} hot queries use an index")
+    finally:
+        conn.close()
+    return 0
+
+
+async def _main_postgres(db, check: bool) -> int:
+    try:
+        applied = await migrate_postgres(db)
+        version = await db.fetch_val(f"SELECT MAX(version) FROM {SCHEMA_TABLE}")
+        print(f"schema version {version} (applied: {applied or 'none'})")
+        if check:
+            # The planner's choices depend on table statistics; use EXPLAIN on production data
+            print("query plan check skipped: only supported for SQLite")
+    finally:
+        await db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
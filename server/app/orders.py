@@ -0,0 +1,168 @@
+"""Order states and the sweeper that expires abandoned pending orders.
+
+An order starts ``pending`` and ends ``paid``, ``expired`` or, after being
+paid, ``refunded``; :data:`TRANSITIONS` lists the allowed moves. Every move
+is a conditional UPDATE on the expected source states, so a payment and the
+expiry of the same order, or two replicas doing either, cannot both win.
+
+:class:`ExpirySweeper` expires orders left pending longer than ``ttl``. It
+walks the (status, created_at, id) index in batches of ``batch_size``, each
+its own short transaction, and pauses between batches so request writes are
+never held behind the sweep. Its lag is how far past its deadline the oldest
+still-pending order is, so 0 while the sweeper keeps up.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from . import metrics, stats
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+PAID = "paid"
+EXPIRED = "expired"
+REFUNDED = "refunded"
+
+STATUSES = (PENDING, PAID, EXPIRED, REFUNDED)
+# status -> statuses it may move to; expired and refunded are final
+TRANSITIONS = {
+    PENDING: (PAID, EXPIRED),
+    PAID: (REFUNDED,),
+}
+
+SCHEMA = [
+    # When the order expired or was refunded
+    "ALTER TABLE orders ADD COLUMN closed_at TEXT",
+]
+
+_TIMESTAMP = "%Y-%m-%d %H:%M:%S"
+
+# The next batch of orders to expire (created before ?, at most ? of them)
+EXPIRE_CANDIDATES = "SELECT id FROM orders WHERE status = 'pending' AND created_at < ? ORDER BY created_at, id LIMIT ?"
+OLDEST_PENDING = "SELECT MIN(created_at) FROM orders WHERE status = 'pending'"
+
+_EXPIRE_BATCH = (
+    f"UPDATE orders SET status = 'expired', closed_at = ? WHERE id IN ({EXPIRE_CANDIDATES}) AND status = 'pending'"
+)
+
+
+def sources(status: str):
+    """Statuses an order may be in to move to ``status``."""
+    return tuple(source for source, targets in TRANSITIONS.items() if status in targets)
+
+
+async def transition(tx, order_id: str, status: str, **columns: Any) -> bool:
+    """Move an order to ``status`` and set ``columns``; False if its current status does not allow it."""
+    allowed = sources(status)
+    assignments = ", ".join(["status = ?", *(f"{column} = ?" for column in columns)])
+    changed = await tx.execute(
+        f"UPDATE orders SET {assignments} WHERE id = ? AND status IN ({', '.join('?' * len(allowed))})",
+        (status, *columns.values(), order_id, *allowed),
+    )
+    return bool(changed)
+
+
+async def refund(tx, order: Dict[str, Any], refunded_at: datetime) -> bool:
+    """Move a paid order to refunded and take it back out of the paid counters."""
+    if not await transition(tx, order["id"], REFUNDED, closed_at=refunded_at.strftime(_TIMESTAMP)):
+        return False
+    # The rollups count paid orders in the bucket of their paid_at
+    await stats.record(tx, at=order["paid_at"], paid_orders=-1, revenue=-order["amount"])
+    return True
+
+
+class ExpirySweeper:
+    def __init__(self, db, ttl: float, interval: float = 60.0, batch_size: int = 500, pause: float = 0.05):
+        self.db = db
+        self.ttl = ttl
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+
+        self._task: Optional[asyncio.Task] = None
+
+        self._sweeps = 0
+        self._batches = 0
+        self._expired = 0
+        self._failures = 0
+        self._lag = 0.0
+        self._last_sweep_at: Optional[str] = None
+        self._last_sweep_ms: Optional[float] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self) -> None:
+        while True:
+            # Not at startup: a freshly started worker has better things to do
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception:
+                self._failures += 1
+                logger.exception("order expiry sweep failed")
+
+    async def sweep(self) -> int:
+        """Expire every order pending for longer than ``ttl``; returns how many."""
+        started = time.perf_counter()
+        now = datetime.utcnow()
+        # created_at is UTC text, so the cutoff compares as a string
+        cutoff = (now - timedelta(seconds=self.ttl)).strftime(_TIMESTAMP)
+        closed_at = now.strftime(_TIMESTAMP)
+        expired = 0
+        while True:
+            async with self.db.transaction(immediate=True) as tx:
+                changed = await tx.execute(_EXPIRE_BATCH, (closed_at, cutoff, self.batch_size))
+            self._batches += 1
+            expired += changed
+            metrics.ORDERS_EXPIRED.inc(changed)
+            if changed < self.batch_size:
+                break
+            await asyncio.sleep(self.pause)
+
+        await self._update_lag()
+        elapsed = time.perf_counter() - started
+        self._sweeps += 1
+        self._expired += expired
+        self._last_sweep_at = closed_at
+        self._last_sweep_ms = round(elapsed * 1000, 3)
+        metrics.ORDER_SWEEP_DURATION.observe(elapsed)
+        metrics.ORDER_SWEEP_LAST_SUCCESS.set(time.time())
+        return expired
+
+    async def _update_lag(self) -> None:
+        oldest = await self.db.fetch_val(OLDEST_PENDING)
+        lag = 0.0
+        if oldest is not None:
+            created_at = datetime.strptime(str(oldest)[:19], _TIMESTAMP)
+            lag = max(0.0, (datetime.utcnow() - created_at).total_seconds() - self.ttl)
+        self._lag = lag
+        metrics.ORDER_SWEEP_LAG.set(lag)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._task is not None,
+            "ttl_seconds": self.ttl,
+            "interval_seconds": self.interval,
+            "batch_size": self.batch_size,
+            "sweeps": self._sweeps,
+            "batches": self._batches,
+            "expired": self._expired,
+            "failures": self._failures,
+            "lag_seconds": round(self._lag, 3),
+            "last_sweep_at": self._last_sweep_at,
+            "last_sweep_ms": self._last_sweep_ms,
+        }
@@ -0,0 +1,64 @@
+import base64
+import json
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+
+from .queries import seek
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+def encode_cursor(row: Dict[str, Any]) -> str:
+    """Opaque cursor pointing just past ``row`` in (created_at, id) order."""
+    raw = json.dumps([str(row["created_at"]), row["id"]], ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded).decode("utf-8"))
+        return str(created_at), str(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="无效的分页游标") from None
+
+
+def encode_offset_cursor(offset: int) -> str:
+    """Cursor for results that have no stable sort key (e.g. ranked search)."""
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_offset_cursor(cursor: Optional[str]) -> int:
+    if not cursor:
+        return 0
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        offset = json.loads(base64.urlsafe_b64decode(padded).decode("utf-8"))["offset"]
+        if not isinstance(offset, int) or offset < 0:
+            raise ValueError
+        return offset
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="无效的分页游标") from None
+
+
+def keyset_clause(
+    cursor: Optional[str], prefix: str = "AND", alias: str = "", descending: bool = True
+) -> Tuple[str, Sequence[Any]]:
+    """SQL fragment and params restricting rows to those after ``cursor``.
+
+    Pair it with ``ORDER BY created_at, id`` in the same direction so the
+    (…, created_at, id) indexes serve both the seek and the ordering.
+    """
+    if not cursor:
+        return "", ()
+    return seek(prefix, alias, descending), decode_cursor(cursor)
+
+
+def paginate(rows: List[Dict[str, Any]], limit: int) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Trim a ``LIMIT limit + 1`` result to one page and compute ``next_cursor``."""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1])
@@ -0,0 +1,172 @@
+"""Idempotent order creation and payment notification ingestion.
+
+Orders created with an ``Idempotency-Key`` header store the key; a unique
+(user_id, idempotency_key) index turns a retried request into a lookup of
+the order it already created.
+
+Provider notifications (``POST /api/v1/payments/notify/{provider}``) come in
+bursts and are retried until acknowledged. Each is queued on a
+:class:`~app.writer.GroupCommitWriter` whose flush is :func:`apply_notifications`:
+each batch records its notifications under (provider, provider transaction
+id) with one INSERT, so retries conflict and are skipped, and moves the
+orders still pending to paid. Replays, duplicates within a batch and concurrent
+replicas therefore all apply once. The provider is acknowledged once the
+batch holding its notification has committed.
+
+Provider signatures are stood in for by an HMAC-SHA256 of the raw body
+(``X-Notify-Signature``) with ``PAYMENT_NOTIFY_SECRET``; bodies are the
+decrypted WeChat Pay v3 resource (JSON) and the Alipay form parameters.
+"""
+import hashlib
+import hmac
+import json
+from datetime import datetime
+from typing import Any, Dict, List, NamedTuple, Optional
+from urllib.parse import parse_qsl
+
+from . import stats
+from .orders import transition
+
+SCHEMA = [
+    "ALTER TABLE orders ADD COLUMN idempotency_key TEXT",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idempotency ON orders (user_id, idempotency_key)",
+    """CREATE TABLE IF NOT EXISTS payment_notifications (
+        provider TEXT NOT NULL,
+        provider_transaction_id TEXT NOT NULL,
+        order_id TEXT NOT NULL,
+        amount DOUBLE PRECISION NOT NULL,
+        outcome TEXT NOT NULL,
+        received_at TEXT NOT NULL,
+        PRIMARY KEY (provider, provider_transaction_id)
+    )""",
+]
+
+PROVIDERS = ("wechat", "alipay")
+SIGNATURE_HEADER = "X-Notify-Signature"
+
+# Outcomes recorded per notification; only "paid" changes the order
+PAID = "paid"
+ALREADY_PAID = "already_paid"
+NOT_PENDING = "not_pending"
+UNKNOWN_ORDER = "unknown_order"
+AMOUNT_MISMATCH = "amount_mismatch"
+
+
+class InvalidNotification(Exception):
+    pass
+
+
+class Notification(NamedTuple):
+    provider: str
+    transaction_id: str
+    order_id: str
+    amount: float
+    # False for notifications about unpaid or closed trades, which are only acknowledged
+    success: bool
+    received_at: str
+
+
+def sign(secret: str, body: bytes) -> str:
+    return hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+def verify(secret: str, body: bytes, signature: Optional[str]) -> bool:
+    return signature is not None and hmac.compare_digest(sign(secret, body), signature)
+
+
+def parse(provider: str, body: bytes, received_at: str) -> Notification:
+    """Normalize a provider notification body; raises InvalidNotification."""
+    try:
+        if provider == "wechat":
+            data = json.loads(body)
+            return Notification(
+                provider, str(data["transaction_id"]), str(data["out_trade_no"]),
+                int(data["amount"]["total"]) / 100, data.get("trade_state") == "SUCCESS", received_at,
+            )
+        data = dict(parse_qsl(body.decode("utf-8"), keep_blank_values=True))
+        return Notification(
+            provider, data["trade_no"], data["out_trade_no"], float(data["total_amount"]),
+            data.get("trade_status") in ("TRADE_SUCCESS", "TRADE_FINISHED"), received_at,
+        )
+    except (KeyError, TypeError, ValueError, UnicodeDecodeError) as e:
+        raise InvalidNotification(f"malformed {provider} notification: {e}") from None
+
+
+async def mark_paid(tx, order_id: str, amount: float, transaction_id: str, paid_at: datetime) -> bool:
+    """Move a pending order to paid; False if it was no longer pending."""
+    changed = await transition(tx, order_id, "paid", transaction_id=transaction_id, paid_at=str(paid_at))
+    if changed:
+        await stats.record(tx, at=paid_at, paid_orders=1, revenue=amount)
+    return changed
+
+
+async def apply_notifications(tx, items: List[Notification]) -> None:
+    """GroupCommitWriter flush: record the new notifications and apply them to their orders.
+
+    Keys and orders are taken in sorted order so concurrent batches on other
+    replicas cannot deadlock on them.
+    """
+    batch = {(n.provider, n.transaction_id): n for n in items}
+    claimed = await tx.fetch_all(
+        "INSERT INTO payment_notifications "
+        "(provider, provider_transaction_id, order_id, amount, outcome, received_at) VALUES "
+        + ", ".join(["(?, ?, ?, ?, ?, ?)"] * len(batch))
+        + " ON CONFLICT(provider, provider_transaction_id) DO NOTHING RETURNING provider, provider_transaction_id",
+        [value for key in sorted(batch) for value in (*key, batch[key].order_id, batch[key].amount,
+                                                      "received", batch[key].received_at)],
+    )
+    # Retries of notifications applied by an earlier batch are not returned
+    notifications = [batch[(row["provider"], row["provider_transaction_id"])] for row in claimed]
+    if not notifications:
+        return
+    order_ids = sorted({n.order_id for n in notifications})
+    orders = await tx.fetch_all(
+        f"SELECT id, status, amount FROM orders WHERE id IN ({', '.join('?' * len(order_ids))}) ORDER BY id"
+        + tx.for_update,
+        order_ids,
+    )
+    orders = {order["id"]: dict(order) for order in orders}
+
+    paid_at = datetime.utcnow()
+    paid, outcomes = [], []
+    for notification in notifications:
+        order = orders.get(notification.order_id)
+        if order is None:
+            outcome = UNKNOWN_ORDER
+        elif round(order["amount"] * 100) != round(notification.amount * 100):
+            outcome = AMOUNT_MISMATCH
+        elif order["status"] == "paid":
+            outcome = ALREADY_PAID
+        elif order["status"] != "pending":
+            outcome = NOT_PENDING
+        else:
+            outcome = PAID
+            # A second transaction for the same order in this batch finds it paid
+            order["status"] = "paid"
+            paid.append((notification.transaction_id, str(paid_at), notification.order_id))
+        outcomes.append((outcome, notification.provider, notification.transaction_id))
+
+    if paid:
+        # The rows are locked (BEGIN IMMEDIATE / FOR UPDATE), so every one of these applies
+        await tx.execute_many(
+            "UPDATE orders SET status = 'paid', transaction_id = ?, paid_at = ? WHERE id = ? AND status = 'pending'",
+            paid,
+        )
+        await stats.record(
+            tx, at=paid_at, paid_orders=len(paid), revenue=sum(orders[order_id]["amount"] for _, _, order_id in paid),
+        )
+    await tx.execute_many(
+        "UPDATE payment_notifications SET outcome = ? WHERE provider = ? AND provider_transaction_id = ?",
+        outcomes,
+    )
+
+
+def acknowledgement(provider: str, ok: bool, message: str = "") -> Dict[str, Any]:
+    """Response body and media type the provider expects."""
+    if provider == "wechat":
+        return {
+            "content": json.dumps({"code": "SUCCESS" if ok else "FAIL", "message": message or "成功"},
+                                  ensure_ascii=False),
+            "media_type": "application/json",
+        }
+    return {"content": "success" if ok else "fail", "media_type": "text/plain"}
@@ -0,0 +1,333 @@
+"""Opt-in per-request profiles (``PROFILE_ENABLED``).
+
+A request is profiled when it sends ``X-Profile: <PROFILE_TOKEN>`` or is
+picked at ``PROFILE_SAMPLE_RATE``. While it runs, a sampler thread reads
+the event loop thread's stack every ``interval`` seconds and keeps the
+samples whose stack passes through this request's middleware frame, so
+requests running concurrently on the loop do not end up in each other's
+profile. The sampler needs the GIL, which a busy loop hands over only
+every switch interval; while requests are being profiled that interval
+is lowered to the sampling interval, and each sample is weighted by the
+time since the previous one rather than counted. Time spent off the loop is measured
+instead: database statements through ``db.on_query`` and JWT work inside
+:func:`span`. Serialization time is estimated from the samples taken
+inside the JSON encoders.
+
+Once the response has been sent, the profile is written as one JSON file
+to a directory that keeps the newest ``max_files``. Its ``stacks`` are
+collapsed stacks for flamegraph.pl or speedscope (see :func:`folded`),
+weighted in microseconds. Database time and the remaining off-loop time
+appear as ``[db] ...`` and ``[waiting]`` frames, so the graph adds up to
+the request's wall time.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from .metrics import statement_name
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b"x-profile"
+ID_HEADER = b"x-profile-id"
+
+_ID = re.compile(r"^\d+-[0-9a-f]{8}$")
+# Frames that count as response serialization: (file suffix, function or None for any)
+_SERIALIZATION = (
+    ("fastapi/encoders.py", None),
+    ("fastapi/routing.py", "serialize_response"),
+    ("starlette/responses.py", "render"),
+    ("json/encoder.py", None),
+    ("json/__init__.py", "dumps"),
+)
+
+_current: ContextVar[Optional["RequestProfile"]] = ContextVar("profile", default=None)
+
+
+def _label(code) -> str:
+    path = code.co_filename.replace(os.sep, "/")
+    short = "/".join(path.rsplit("/", 2)[-2:])
+    return f"{code.co_name} ({short}:{code.co_firstlineno})"
+
+
+def _is_serialization(code) -> bool:
+    path = code.co_filename.replace(os.sep, "/")
+    return any(
+        path.endswith(suffix) and (function is None or code.co_name == function)
+        for suffix, function in _SERIALIZATION
+    )
+
+
+class RequestProfile:
+    def __init__(self, anchor, method: str, path: str):
+        # Sortable by time, unique across workers
+        self.id = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+        self.anchor = anchor
+        self.method = method
+        self.path = path
+        self.route: Optional[str] = None
+        self.status: Optional[int] = None
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.wall = 0.0
+        # Sampled seconds by stack
+        self.stacks: Dict[str, float] = defaultdict(float)
+        self.samples = 0
+        self.on_loop = 0.0
+        self.serialization = 0.0
+        self.db_queries = 0
+        self.db_statements: Dict[str, float] = defaultdict(float)
+        self.spans: Dict[str, float] = defaultdict(float)
+
+    def add_sample(
+        self, codes: List[Any], weight: float, labels: Dict[Any, str], serializers: Dict[Any, bool],
+    ) -> None:
+        """``codes`` innermost first, up to (not including) the middleware frame."""
+        names = []
+        serialization = False
+        for code in reversed(codes):
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = _label(code)
+                serializers[code] = _is_serialization(code)
+            serialization = serialization or serializers[code]
+            names.append(label)
+        self.stacks[";".join(names)] += weight
+        self.samples += 1
+        self.on_loop += weight
+        if serialization:
+            self.serialization += weight
+
+    def add_query(self, sql: str, seconds: float) -> None:
+        self.db_queries += 1
+        self.db_statements[statement_name(sql)] += seconds
+
+    def to_dict(self, interval: float) -> Dict[str, Any]:
+        root = f"{self.method} {self.route or self.path}"
+        db_time = sum(self.db_statements.values())
+        stacks = Counter()
+        for stack, seconds in self.stacks.items():
+            stacks[f"{root};{stack}" if stack else root] += round(seconds * 1e6)
+        for statement, seconds in self.db_statements.items():
+            stacks[f"{root};[db] {statement}"] += round(seconds * 1e6)
+        stacks[f"{root};[waiting]"] += round(max(0.0, self.wall - db_time - self.on_loop) * 1e6)
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "started_at": self.started_at.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "wall_ms": round(self.wall * 1000, 3),
+            "db_ms": round(db_time * 1000, 3),
+            "db_queries": self.db_queries,
+            "jwt_ms": round(self.spans.get("jwt", 0.0) * 1000, 3),
+            "serialization_ms": round(self.serialization * 1000, 3),
+            "on_loop_ms": round(self.on_loop * 1000, 3),
+            "samples": self.samples,
+            "interval_ms": interval * 1000,
+            "db_statements": {name: round(seconds * 1000, 3) for name, seconds in self.db_statements.items()},
+            "stacks": {stack: micros for stack, micros in stacks.items() if micros > 0},
+        }
+
+
+@contextmanager
+def span(name: str):
+    """Time a block into the current request's profile, if it is being profiled."""
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.spans[name] += time.perf_counter() - started
+
+
+def instrument_database(db) -> None:
+    """Attribute statement time to the profiled request that ran the statement."""
+    observe = db.on_query
+
+    def on_query(sql: str, seconds: float) -> None:
+        if observe is not None:
+            observe(sql, seconds)
+        profile = _current.get()
+        if profile is not None:
+            profile.add_query(sql, seconds)
+
+    db.on_query = on_query
+
+
+class Sampler:
+    """Samples the event loop thread while at least one request is being profiled."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._profiles: Dict[int, RequestProfile] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._target: Optional[int] = None
+        self._switch_interval: Optional[float] = None
+        # Only touched by the sampler thread
+        self._labels: Dict[Any, str] = {}
+        self._serializers: Dict[Any, bool] = {}
+
+    def add(self, profile: RequestProfile) -> None:
+        with self._lock:
+            self._profiles[id(profile.anchor)] = profile
+            self._target = threading.get_ident()
+            if self._thread is None:
+                self._switch_interval = sys.getswitchinterval()
+                sys.setswitchinterval(min(self._switch_interval, self.interval))
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+
+    def remove(self, profile: RequestProfile) -> None:
+        # Holding the lock, so no sample of this profile is in progress afterwards
+        with self._lock:
+            self._profiles.pop(id(profile.anchor), None)
+
+    def _run(self) -> None:
+        last = time.perf_counter()
+        while True:
+            # Read the stack before taking the lock: while we wait for it the
+            # loop runs on, and its time would be charged to where it stops
+            now = time.perf_counter()
+            frame = sys._current_frames().get(self._target)
+            weight, last = now - last, now
+            with self._lock:
+                if not self._profiles:
+                    sys.setswitchinterval(self._switch_interval)
+                    self._thread = None
+                    return
+                stack = []
+                while frame is not None:
+                    profile = self._profiles.get(id(frame))
+                    if profile is not None:
+                        profile.add_sample(
+                            stack, max(0.0, min(weight, now - profile.started)), self._labels, self._serializers,
+                        )
+                        break
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                del frame
+            time.sleep(self.interval)
+
+
+class ProfileStore:
+    """The newest ``max_files`` profiles, one JSON file each, shared by the workers."""
+
+    def __init__(self, directory: str, max_files: int):
+        self.directory = directory
+        self.max_files = max_files
+
+    def _path(self, profile_id: str) -> str:
+        return os.path.join(self.directory, f"{profile_id}.json")
+
+    def _ids(self) -> List[str]:
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-5] for name in names if name.endswith(".json") and _ID.match(name[:-5]))
+
+    def save(self, profile: Dict[str, Any]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(profile["id"])
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(profile, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+        for profile_id in self._ids()[:-self.max_files]:
+            try:
+                os.remove(self._path(profile_id))
+            except FileNotFoundError:
+                pass
+
+    def get(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        if not _ID.match(profile_id):
+            return None
+        try:
+            with open(self._path(profile_id), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def list(self, limit: int) -> List[Dict[str, Any]]:
+        """Newest first, without the stacks."""
+        profiles = []
+        for profile_id in reversed(self._ids()):
+            profile = self.get(profile_id)
+            if profile is None:
+                continue
+            profile.pop("stacks", None)
+            profiles.append(profile)
+            if len(profiles) == limit:
+                break
+        return profiles
+
+
+def folded(profile: Dict[str, Any]) -> str:
+    """Collapsed stacks (``frame;frame;frame microseconds`` per line) of a stored profile."""
+    return "".join(f"{stack} {count}\n" for stack, count in profile["stacks"].items())
+
+
+class ProfilingMiddleware:
+    """Profiles selected requests; the response gets an ``X-Profile-Id`` header."""
+
+    def __init__(self, app, store: ProfileStore, sample_rate: float = 0.0,
+                 token: Optional[str] = None, interval: float = 0.001):
+        self.app = app
+        self.store = store
+        self.sample_rate = sample_rate
+        self.token = token.encode() if token else None
+        self.sampler = Sampler(interval)
+
+    def _wanted(self, scope) -> bool:
+        if self.token is not None:
+            for name, value in scope["headers"]:
+                if name == PROFILE_HEADER and hmac.compare_digest(value, self.token):
+                    return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._wanted(scope):
+            await self.app(scope, receive, send)
+            return
+        profile = RequestProfile(sys._getframe(), scope["method"], scope["path"])
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message = {**message, "headers": [*message.get("headers", []), (ID_HEADER, profile.id.encode())]}
+            await send(message)
+
+        token = _current.set(profile)
+        self.sampler.add(profile)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            self.sampler.remove(profile)
+            _current.reset(token)
+            profile.wall = time.perf_counter() - profile.started
+            route = scope.get("route")
+            profile.route = route.path if route is not None else None
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.store.save, profile.to_dict(self.sampler.interval),
+                )
+            except OSError as e:
+                logger.warning("could not save profile %s: %s", profile.id, e)
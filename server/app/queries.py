@@ -0,0 +1,47 @@
+"""SQL of the list and lookup endpoints.
+
+main.py runs these and ``python -m app.migrations --check`` explains them,
+so the index check sees exactly what the endpoints send. ``{after}`` takes
+the keyset condition from :func:`seek` (or nothing on the first page) and
+``{where}`` an optional filter.
+"""
+
+
+def seek(prefix: str = "AND", alias: str = "", descending: bool = True) -> str:
+    """Condition keeping the rows after a (created_at, id) cursor; takes its two values."""
+    column = f"{alias}." if alias else ""
+    op = "<" if descending else ">"
+    return f"{prefix} ({column}created_at, {column}id) {op} (?, ?)"
+
+
+LIST_CONVERSATIONS = (
+    "SELECT * FROM conversations WHERE user_id = ? {after} ORDER BY created_at DESC, id DESC LIMIT ?"
+)
+CONVERSATION_MESSAGES = (
+    "SELECT * FROM messages WHERE conversation_id = ? {after} ORDER BY created_at ASC, id ASC LIMIT ?"
+)
+# Newest first; {before} pages back from a cursor
+CONVERSATION_LATEST = (
+    "SELECT * FROM messages WHERE conversation_id = ? {before} ORDER BY created_at DESC, id DESC LIMIT ?"
+)
+LIST_ATTACHMENTS = (
+    "SELECT * FROM attachments WHERE user_id = ? {after} ORDER BY created_at DESC, id DESC LIMIT ?"
+)
+LIST_TEMPLATES = "SELECT * FROM templates ORDER BY created_at DESC"
+LIST_DOCUMENTS = (
+    "SELECT * FROM documents WHERE user_id = ? {after} ORDER BY created_at DESC, id DESC LIMIT ?"
+)
+LIST_ORDERS = "SELECT * FROM orders WHERE user_id = ? {after} ORDER BY created_at DESC, id DESC LIMIT ?"
+ORDER_BY_IDEMPOTENCY_KEY = "SELECT * FROM orders WHERE user_id = ? AND idempotency_key = ?"
+ADMIN_LIST_USERS = "SELECT * FROM users {after} ORDER BY created_at DESC, id DESC LIMIT ?"
+ADMIN_LIST_CONVERSATIONS = (
+    "SELECT c.*, u.phone, u.name as user_name FROM conversations c "
+    "LEFT JOIN users u ON c.user_id = u.id {after} "
+    "ORDER BY c.created_at DESC, c.id DESC LIMIT ?"
+)
+# {where}: "WHERE o.status = ?" for a filtered listing, which seeks the (status, created_at, id) index
+ADMIN_LIST_ORDERS = (
+    "SELECT o.*, u.phone, u.name as user_name FROM orders o "
+    "LEFT JOIN users u ON o.user_id = u.id {where} {after} "
+    "ORDER BY o.created_at DESC, o.id DESC LIMIT ?"
+)
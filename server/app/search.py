@@ -0,0 +1,297 @@
+"""Full-text search over messages, documents and templates.
+
+FTS5's built-in tokenizers cannot segment Chinese, so text is tokenized here
+before it reaches the index: runs of CJK characters become overlapping
+bigrams followed by the run's last character, and other words are kept
+whole. Every token is prefixed with its row's partition (kind initial plus
+an owner digest; templates are ``public``), so a user's search only walks
+that user's posting lists no matter how large the whole index grows.
+
+On PostgreSQL the same tokens are stored as a ``tsvector`` with a GIN index
+and queried with ``tsquery`` phrases, so both backends match identically.
+
+Writers call :func:`index` inside the transaction that inserts the rows, so
+the index is exact at commit.
+"""
+import hashlib
+import html
+import re
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+KINDS = ("message", "document", "template")
+
+SNIPPET_CHARS = 80
+BACKFILL_BATCH = 5000
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS search_docs (
+        rowid INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        source_id TEXT NOT NULL,
+        UNIQUE (kind, source_id)
+    )""",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(terms)",
+]
+
+POSTGRES_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS search_index (
+        kind TEXT NOT NULL,
+        source_id TEXT NOT NULL,
+        terms TSVECTOR NOT NULL,
+        PRIMARY KEY (kind, source_id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_search_terms ON search_index USING GIN (terms)",
+]
+
+# tsvector limits: positions are 1..16383 and a lexeme keeps at most 256 of them
+_MAX_POSITION = 16383
+_MAX_POSITIONS = 256
+
+# Kana, CJK ideographs (incl. extension A and compatibility) and Hangul
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_TOKEN = re.compile(f"([{_CJK}]+)|([^\\W_{_CJK}]+)")
+
+# (source_id, owner user_id or None for public rows, text)
+Doc = Tuple[str, Optional[str], str]
+
+
+def _runs(text: str) -> Iterable[Tuple[bool, str]]:
+    for match in _TOKEN.finditer(text.lower()):
+        cjk, word = match.groups()
+        yield (True, cjk) if cjk else (False, word)
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for cjk, run in _runs(text):
+        if cjk:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            tokens.append(run[-1])
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def partition(kind: str, user_id: Optional[str]) -> str:
+    if user_id is None:
+        return kind[0] + "public"
+    return kind[0] + hashlib.blake2b(user_id.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _terms(kind: str, user_id: Optional[str], text: str) -> str:
+    prefix = partition(kind, user_id)
+    return " ".join(prefix + token for token in tokenize(text))
+
+
+def _tsvector(kind: str, user_id: Optional[str], text: str) -> str:
+    prefix = partition(kind, user_id)
+    positions: Dict[str, List[int]] = {}
+    for position, token in enumerate(tokenize(text), 1):
+        found = positions.setdefault(prefix + token, [])
+        if len(found) < _MAX_POSITIONS:
+            found.append(min(position, _MAX_POSITION))
+    return " ".join(
+        "'{}':{}".format(token.replace("'", "''"), ",".join(map(str, found)))
+        for token, found in positions.items()
+    )
+
+
+def index_statements(kind: str, docs: Sequence[Doc], replace: bool = False) -> List[Tuple[str, List[tuple]]]:
+    """(sql, executemany params) that add ``docs`` to the index."""
+    keys = [(kind, source_id) for source_id, _, _ in docs]
+    statements = [("INSERT OR IGNORE INTO search_docs (kind, source_id) VALUES (?, ?)", keys)]
+    if replace:
+        statements.append((
+            "DELETE FROM search_index WHERE rowid = "
+            "(SELECT rowid FROM search_docs WHERE kind = ? AND source_id = ?)",
+            keys,
+        ))
+    statements.append((
+        "INSERT INTO search_index (rowid, terms) "
+        "SELECT rowid, ? FROM search_docs WHERE kind = ? AND source_id = ?",
+        [(_terms(kind, owner, text), kind, source_id) for source_id, owner, text in docs],
+    ))
+    return statements
+
+
+async def index(tx, kind: str, docs: Sequence[Doc], replace: bool = False) -> None:
+    """Index rows inserted (or, with ``replace``, updated) in transaction ``tx``."""
+    if not docs:
+        return
+    if tx.dialect == "postgres":
+        await tx.execute_many(
+            "INSERT INTO search_index (kind, source_id, terms) VALUES (?, ?, ?::tsvector) "
+            "ON CONFLICT (kind, source_id) DO UPDATE SET terms = excluded.terms",
+            [(kind, source_id, _tsvector(kind, owner, text)) for source_id, owner, text in docs],
+        )
+        return
+    for sql, params in index_statements(kind, docs, replace):
+        await tx.execute_many(sql, params)
+
+
+def match_expression(query: str, user_id: str, kinds: Sequence[str]) -> Optional[str]:
+    """FTS5 query for ``query`` within what ``user_id`` may see; None if it has no terms."""
+    runs = list(_runs(query))
+    if not runs:
+        return None
+    alternatives = []
+    for kind in kinds:
+        prefix = partition(kind, None if kind == "template" else user_id)
+        phrases = []
+        for cjk, run in runs:
+            if not cjk or len(run) == 1:
+                # A lone CJK character starts the token of every position it occurs at
+                phrases.append(f'"{prefix}{run}"*')
+            else:
+                phrases.append('"' + " ".join(prefix + run[i:i + 2] for i in range(len(run) - 1)) + '"')
+        alternatives.append("(" + " AND ".join(phrases) + ")")
+    return " OR ".join(alternatives)
+
+
+def tsquery(query: str, user_id: str, kinds: Sequence[str]) -> Optional[str]:
+    """PostgreSQL counterpart of :func:`match_expression`."""
+    runs = list(_runs(query))
+    if not runs:
+        return None
+    alternatives = []
+    for kind in kinds:
+        prefix = partition(kind, None if kind == "template" else user_id)
+        phrases = []
+        for cjk, run in runs:
+            if not cjk or len(run) == 1:
+                phrases.append(f"'{prefix}{run}':*")
+            else:
+                phrases.append("(" + " <-> ".join(f"'{prefix}{run[i:i + 2]}'" for i in range(len(run) - 1)) + ")")
+        alternatives.append("(" + " & ".join(phrases) + ")")
+    return " | ".join(alternatives)
+
+
+def needles(query: str) -> List[str]:
+    return [run for _, run in _runs(query)]
+
+
+def snippet(text: str, query_needles: Sequence[str], width: int = SNIPPET_CHARS) -> str:
+    """HTML-escaped excerpt around the first match, with matches wrapped in <mark>."""
+    lowered = text.lower()
+    positions = [p for p in (lowered.find(n) for n in query_needles) if p >= 0]
+    first = min(positions) if positions else 0
+    start = max(0, first - width // 4)
+    end = min(len(text), start + width)
+    excerpt = text[start:end]
+    pattern = "|".join(re.escape(n) for n in sorted(query_needles, key=len, reverse=True))
+    parts, last = [], 0
+    if pattern:
+        for match in re.finditer(pattern, excerpt, re.IGNORECASE):
+            parts.append(html.escape(excerpt[last:match.start()]))
+            parts.append(f"<mark>{html.escape(match.group())}</mark>")
+            last = match.end()
+    parts.append(html.escape(excerpt[last:]))
+    return ("…" if start else "") + "".join(parts) + ("…" if end < len(text) else "")
+
+
+def document_text(title: str, content: str) -> str:
+    return f"{title}\n{content}"
+
+
+def template_text(name: str, description: Optional[str], content: str) -> str:
+    return f"{name}\n{description or ''}\n{content}"
+
+
+# kind -> (query for result rows by id, whether it is restricted to the searching user)
+_SOURCES = {
+    "message": (
+        "SELECT m.id, m.content, m.created_at, m.conversation_id, c.title "
+        "FROM messages m JOIN conversations c ON c.id = m.conversation_id "
+        "WHERE c.user_id = ? AND m.id IN ({ids})",
+        True,
+    ),
+    "document": (
+        "SELECT id, title, content, created_at, template_id "
+        "FROM documents WHERE user_id = ? AND id IN ({ids})",
+        True,
+    ),
+    "template": (
+        "SELECT id, name AS title, description, content, created_at, category FROM templates WHERE id IN ({ids})",
+        False,
+    ),
+}
+
+
+async def search(
+    db, user_id: str, query: str, kinds: Sequence[str], limit: int, offset: int
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """One page of results ranked by relevance; returns (results, has_more)."""
+    if db.dialect == "postgres":
+        expression = tsquery(query, user_id, kinds)
+        sql = (
+            "SELECT kind, source_id FROM search_index WHERE terms @@ ?::tsquery "
+            "ORDER BY ts_rank(terms, ?::tsquery) DESC, kind, source_id LIMIT ? OFFSET ?"
+        )
+        params = (expression, expression, limit + 1, offset)
+    else:
+        expression = match_expression(query, user_id, kinds)
+        sql = (
+            "SELECT d.kind, d.source_id FROM search_index "
+            "JOIN search_docs d ON d.rowid = search_index.rowid "
+            "WHERE search_index MATCH ? ORDER BY bm25(search_index) LIMIT ? OFFSET ?"
+        )
+        params = (expression, limit + 1, offset)
+    if expression is None:
+        return [], False
+    hits = await db.fetch_all(sql, params)
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+
+    sources: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for kind in kinds:
+        ids = [hit["source_id"] for hit in hits if hit["kind"] == kind]
+        if not ids:
+            continue
+        sql, owned = _SOURCES[kind]
+        rows = await db.fetch_all(
+            sql.format(ids=", ".join("?" * len(ids))), (user_id, *ids) if owned else ids
+        )
+        for row in rows:
+            sources[(kind, row["id"])] = row
+
+    query_needles = needles(query)
+    results = []
+    for hit in hits:
+        row = sources.get((hit["kind"], hit["source_id"]))
+        if row is None:
+            continue
+        content = row.pop("content")
+        if hit["kind"] == "template" and row["description"]:
+            content = f"{row['description']}\n{content}"
+        results.append({"type": hit["kind"], **row, "snippet": snippet(content, query_needles)})
+    return results, has_more
+
+
+def backfill(conn) -> None:
+    """Migration step: create the index and add every existing row to it."""
+    for statement in SCHEMA:
+        conn.execute(statement)
+    sources = {
+        "message": (
+            "SELECT m.id, c.user_id, m.content FROM messages m "
+            "JOIN conversations c ON c.id = m.conversation_id"
+        ),
+        "document": "SELECT id, user_id, title, content FROM documents",
+        "template": "SELECT id, NULL, name, description, content FROM templates",
+    }
+    texts = {
+        "message": lambda content: content,
+        "document": document_text,
+        "template": template_text,
+    }
+    for kind, sql in sources.items():
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(sql)
+        while True:
+            rows = cursor.fetchmany(BACKFILL_BATCH)
+            if not rows:
+                break
+            docs = [(row[0], row[1], texts[kind](*row[2:])) for row in rows]
+            for statement, params in index_statements(kind, docs):
+                conn.executemany(statement, params)
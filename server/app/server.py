@@ -0,0 +1,365 @@
+"""Production launcher: a pre-forking supervisor of uvicorn workers.
+
+    python -m app.server [--workers N] [--port 8000]
+
+The parent process binds the listening socket, imports the app once
+(workers are forked from it and share its memory copy-on-write), applies
+pending migrations once per ``DB_MIGRATE_ON_STARTUP`` and then forks the
+workers, which start with migrations turned off. The worker count defaults
+to the container's CPU quota (cgroup v2 ``cpu.max`` or v1 CFS quota) and
+falls back to the CPUs this process may run on; ``WEB_CONCURRENCY``
+overrides it.
+
+The parent restarts workers that die, backing off while they keep dying
+within ``MIN_UPTIME`` seconds of their start, and gives up after
+``MAX_QUICK_RESTARTS`` such deaths in a row so the orchestrator sees the
+crash loop. Each worker keeps its slot number across restarts, in
+``APP_WORKER_INDEX``; host-wide background jobs run in worker 0 only. On SIGTERM or SIGINT it waits ``--drain-delay`` seconds (time
+for a Kubernetes endpoint removal to propagate) with the workers still
+serving, then asks them to shut down: uvicorn stops accepting, finishes the
+requests in flight within ``--graceful-timeout`` and runs the shutdown
+event, which commits the queued writes. Workers still running after that
+are killed. Workers exit on their own if the parent dies.
+
+Behind a reverse proxy or ingress, ``--forwarded-allow-ips`` (or
+``FORWARDED_ALLOW_IPS``) must list the proxy's addresses: only then is the
+client address taken from ``X-Forwarded-For``, which per-IP rate limits
+(see admission.py) key on. Otherwise every request counts against the proxy.
+
+Without ``REDIS_URL`` each worker keeps its caches to itself, and nothing
+tells it of changes made through the others. With several workers the
+launcher then caps every in-process cache, conversation tails included, at
+``LOCAL_CACHE_TTL`` seconds (default 5). With several workers,
+``PROMETHEUS_MULTIPROC_DIR`` is set to a fresh directory unless given.
+"""
+import argparse
+import asyncio
+import glob
+import logging
+import math
+import os
+import select
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger("app.server")
+
+MIN_UPTIME = 10.0
+MAX_QUICK_RESTARTS = 5
+RESTART_DELAY_MAX = 30.0
+# Handled by the supervisor; workers get the defaults back (and uvicorn's handlers)
+SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD)
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit() -> Optional[float]:
+    """CPUs allowed by the cgroup CPU quota, or None if unlimited or unknown."""
+    # cgroup v2: the namespaced root, then this process's own group on hosts without a cgroup namespace
+    group = next(
+        (line[3:] for line in (_read("/proc/self/cgroup") or "").splitlines() if line.startswith("0::")), "",
+    )
+    for directory in ("/sys/fs/cgroup", f"/sys/fs/cgroup{group}"):
+        cpu_max = _read(os.path.join(directory, "cpu.max"))
+        if cpu_max:
+            quota, _, period = cpu_max.partition(" ")
+            if quota == "max":
+                return None
+            return int(quota) / int(period or 100000)
+    # cgroup v1
+    for directory in ("/sys/fs/cgroup/cpu", "/sys/fs/cgroup/cpu,cpuacct"):
+        quota = _read(os.path.join(directory, "cpu.cfs_quota_us"))
+        period = _read(os.path.join(directory, "cpu.cfs_period_us"))
+        if quota and period:
+            return int(quota) / int(period) if int(quota) > 0 else None
+    return None
+
+
+def default_workers() -> int:
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        # Rounded down: a worker beyond the quota only gets the group throttled
+        cpus = min(cpus, max(1, math.floor(limit)))
+    return cpus
+
+
+def bind(host: str, port: int, backlog: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+async def _init_database(url: str, mode: str) -> None:
+    from . import migrations
+    from .db import create_database
+
+    db = create_database(url)
+    try:
+        if mode == "check":
+            version = await migrations.schema_version(db)
+            if version < migrations.LATEST_VERSION:
+                raise SystemExit(
+                    f"database schema is at version {version}, expected {migrations.LATEST_VERSION}; "
+                    "run python -m app.migrations"
+                )
+        else:
+            applied = await migrations.migrate_database(db)
+            if applied:
+                logger.info("applied migrations %s", applied)
+    finally:
+        await db.close()
+
+
+async def _watch_parent(server, parent: int) -> None:
+    while not server.should_exit:
+        if os.getppid() != parent:
+            logger.warning("supervisor %d is gone, shutting down", parent)
+            server.should_exit = True
+            return
+        await asyncio.sleep(1)
+
+
+def _run_worker(app, sock: socket.socket, args, parent: int) -> int:
+    import uvicorn
+
+    config = uvicorn.Config(
+        app, lifespan="on", log_level=args.log_level, timeout_graceful_shutdown=args.graceful_timeout,
+        proxy_headers=True, forwarded_allow_ips=args.forwarded_allow_ips,
+    )
+    server = uvicorn.Server(config)
+
+    async def serve():
+        watcher = asyncio.create_task(_watch_parent(server, parent))
+        try:
+            await server.serve(sockets=[sock])
+        finally:
+            watcher.cancel()
+
+    asyncio.run(serve())
+    # Same as uvicorn: 3 when the startup event failed
+    return 0 if server.started else 3
+
+
+class Supervisor:
+    def __init__(self, app, sock: socket.socket, args):
+        self.app = app
+        self.sock = sock
+        self.args = args
+        self.workers: Dict[int, float] = {}  # pid -> start time
+        self.slots: Dict[int, int] = {}  # pid -> worker index
+        self.stopping = False
+        self.quick_deaths = 0
+        self.exit_code = 0
+        self._wakeup_r, self._wakeup_w = os.pipe()
+
+    def _on_signal(self, signum, frame) -> None:
+        if signum in (signal.SIGTERM, signal.SIGINT) and not self.stopping:
+            logger.info("received %s, draining", signal.Signals(signum).name)
+            self.stopping = True
+
+    def _spawn(self, slot: int) -> None:
+        parent = os.getpid()
+        # Blocked across the fork so a signal cannot reach the worker before it resets the handlers
+        signal.pthread_sigmask(signal.SIG_BLOCK, SIGNALS)
+        pid = os.fork()
+        if pid:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, SIGNALS)
+            self.workers[pid] = time.monotonic()
+            self.slots[pid] = slot
+            logger.info("started worker %d (#%d)", pid, slot)
+            return
+        # Worker: drop the supervisor's signal handling before uvicorn installs its own
+        code = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            for signum in SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, SIGNALS)
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+            os.environ["APP_WORKER_INDEX"] = str(slot)
+            code = _run_worker(self.app, self.sock, self.args, parent)
+        except BaseException:
+            logger.exception("worker %d failed", os.getpid())
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def _reap(self) -> None:
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.workers.clear()
+                self.slots.clear()
+                return
+            if pid == 0:
+                return
+            started = self.workers.pop(pid, None)
+            if started is None:
+                continue
+            self.slots.pop(pid, None)
+            if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+                from prometheus_client import multiprocess
+                multiprocess.mark_process_dead(pid)
+            if self.stopping:
+                continue
+            logger.warning("worker %d exited (%s)", pid, _describe(status))
+            if time.monotonic() - started < MIN_UPTIME:
+                self.quick_deaths += 1
+            else:
+                self.quick_deaths = 0
+
+    def _wait(self, timeout: float) -> None:
+        """Sleep until a signal arrives or ``timeout`` passes."""
+        try:
+            select.select([self._wakeup_r], [], [], timeout)
+            os.read(self._wakeup_r, 4096)
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def run(self) -> int:
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        signal.set_wakeup_fd(self._wakeup_w)
+        for signum in SIGNALS:
+            signal.signal(signum, self._on_signal)
+
+        for slot in range(self.args.workers):
+            self._spawn(slot)
+        while not self.stopping:
+            self._reap()
+            if self.quick_deaths >= MAX_QUICK_RESTARTS:
+                logger.error("workers keep dying right after starting, giving up")
+                self.stopping = True
+                self.exit_code = 1
+                break
+            missing = self.args.workers - len(self.workers)
+            if missing and not self.stopping:
+                if self.quick_deaths:
+                    self._wait(min(RESTART_DELAY_MAX, 0.5 * 2 ** self.quick_deaths))
+                    if self.stopping:
+                        break
+                for slot in sorted(set(range(self.args.workers)) - set(self.slots.values())):
+                    self._spawn(slot)
+            self._wait(1.0)
+
+        self._shutdown()
+        return self.exit_code
+
+    def _shutdown(self) -> None:
+        if self.exit_code == 0 and self.args.drain_delay > 0:
+            # Keep serving while the load balancer stops sending traffic here
+            deadline = time.monotonic() + self.args.drain_delay
+            while time.monotonic() < deadline:
+                self._reap()
+                self._wait(deadline - time.monotonic())
+        for pid in self.workers:
+            _kill(pid, signal.SIGTERM)
+        # uvicorn's own timeout, plus time for the shutdown event
+        deadline = time.monotonic() + self.args.graceful_timeout + 5
+        while self.workers and time.monotonic() < deadline:
+            self._wait(0.1)
+            self._reap()
+        for pid in self.workers:
+            logger.warning("worker %d did not stop in time, killing it", pid)
+            _kill(pid, signal.SIGKILL)
+        while self.workers:
+            self._wait(0.1)
+            self._reap()
+        logger.info("all workers stopped")
+
+
+def _kill(pid: int, signum: int) -> None:
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
+
+
+def _describe(status: int) -> str:
+    if os.WIFSIGNALED(status):
+        return f"killed by {signal.Signals(os.WTERMSIG(status)).name}"
+    return f"exit code {os.waitstatus_to_exitcode(status)}"
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run SalaryHelper with a supervised pool of workers")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "0")) or None,
+                        help="worker processes (default: $WEB_CONCURRENCY, else the cgroup CPU quota)")
+    parser.add_argument("--graceful-timeout", type=float, default=float(os.getenv("GRACEFUL_TIMEOUT", "30")),
+                        help="seconds a worker gets to finish requests in flight on shutdown (default 30)")
+    parser.add_argument("--drain-delay", type=float, default=float(os.getenv("DRAIN_DELAY", "0")),
+                        help="seconds to keep serving after SIGTERM before shutting down (default 0)")
+    parser.add_argument("--forwarded-allow-ips", default=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+                        help="proxies whose X-Forwarded-For gives the client address, comma-separated IPs or "
+                             "networks, or * (default: $FORWARDED_ALLOW_IPS, else 127.0.0.1)")
+    parser.add_argument("--backlog", type=int, default=2048)
+    parser.add_argument("--log-level", default=os.getenv("LOG_LEVEL", "info"))
+    args = parser.parse_args(argv)
+    args.workers = args.workers or default_workers()
+
+    logging.basicConfig(
+        level=args.log_level.upper(), format="%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s",
+    )
+    if args.workers > 1 and not os.getenv("REDIS_URL"):
+        # Read by the app, imported below
+        os.environ.setdefault("LOCAL_CACHE_TTL", "5")
+        logger.warning(
+            "%d workers without REDIS_URL: in-process caches expire after %ss",
+            args.workers, os.environ["LOCAL_CACHE_TTL"],
+        )
+
+    # Must be set before prometheus_client is imported (by the app, below)
+    metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    created_metrics_dir = False
+    if metrics_dir:
+        # Values left by a previous run would be added to this one's
+        for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+            os.remove(path)
+    elif args.workers > 1:
+        metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="salaryhelper-metrics-")
+        created_metrics_dir = True
+
+    sock = bind(args.host, args.port, args.backlog)
+    # Migrations run once, here, instead of in every worker's startup event
+    migrate_mode = os.environ.get("DB_MIGRATE_ON_STARTUP", "1")
+    os.environ["DB_MIGRATE_ON_STARTUP"] = "0"
+    from .config import DATABASE_URL
+    from .main import app
+
+    try:
+        if migrate_mode != "0":
+            asyncio.run(_init_database(DATABASE_URL, migrate_mode))
+        logger.info("serving on %s:%d with %d workers", args.host, args.port, args.workers)
+        return Supervisor(app, sock, args).run()
+    finally:
+        sock.close()
+        if created_metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
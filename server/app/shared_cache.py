@@ -0,0 +1,217 @@
+"""Caches kept coherent across replicas through Redis (``REDIS_URL``).
+
+:class:`TwoTierCache` keeps hot entries in a local :class:`~app.cache.TTLCache`
+in front of Redis, so a value loaded by one replica is reused by the others.
+Invalidations delete the Redis entry and are published on
+:data:`CHANNEL`; every :class:`CacheBus` listens there and drops its local
+copy. Purely local caches (verified tokens, conversation tails) register
+with the bus just for invalidations.
+
+Without a Redis client everything stays in-process. Redis errors never fail
+a request: reads fall back to the loader, writes are skipped, and the local
+caches are cleared after the subscription reconnects since messages may
+have been missed. Delivery is asynchronous, so another replica can serve
+its local copy for a few milliseconds after an invalidation, and an entry
+written by a concurrent reader may live until its TTL.
+"""
+import asyncio
+import json
+import logging
+import os
+import uuid
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from .cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "salaryhelper:invalidate"
+KEY_PREFIX = "salaryhelper:cache:"
+RECONNECT_DELAY_MIN = 1.0
+RECONNECT_DELAY_MAX = 30.0
+# How long the listener waits for a message before checking whether the bus is stopping
+LISTEN_POLL = 1.0
+
+
+def connect(url: Optional[str], timeout: float = 0.5):
+    """Async Redis client for ``url``, or None for in-process caching."""
+    if not url:
+        return None
+    from redis import asyncio as aioredis
+    return aioredis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+
+
+class CacheBus:
+    """Redis connection shared by the caches, plus the invalidation listener."""
+
+    def __init__(self, client=None):
+        self.client = client
+        # Lets the listener skip invalidations this process published itself
+        self.instance = uuid.uuid4().hex
+        # Workers forked from a preloaded parent (see server.py) each need their own
+        os.register_at_fork(after_in_child=self._new_instance)
+        self._caches: Dict[str, Any] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._failing = False
+        self.published = 0
+        self.received = 0
+        self.errors = 0
+        self.reconnects = 0
+
+    def _new_instance(self) -> None:
+        self.instance = uuid.uuid4().hex
+
+    def register(self, name: str, cache) -> None:
+        """Apply remote invalidations of ``name`` to ``cache`` (needs invalidate/clear)."""
+        self._caches[name] = cache
+
+    async def start(self) -> None:
+        if self.client is not None and self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            # Checked between polls too: a cancellation that races a message
+            # arriving can be lost inside the client's read
+            self._stopping = True
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def publish(self, name: str, key: str) -> None:
+        if self.client is None:
+            return
+        message = json.dumps({"o": self.instance, "c": name, "k": key})
+        if await self.call(self.client.publish, CHANNEL, message) is not None:
+            self.published += 1
+
+    async def call(self, fn, *args, **kwargs):
+        """Run a Redis command; returns None (and counts the error) if Redis fails."""
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception as e:
+            self.errors += 1
+            if not self._failing:
+                self._failing = True
+                logger.warning("redis unavailable, using local caches only: %s", e)
+            return None
+        if self._failing:
+            self._failing = False
+            logger.info("redis available again")
+        return result
+
+    def _clear_local(self) -> None:
+        for cache in self._caches.values():
+            cache.clear()
+
+    def _apply(self, data) -> None:
+        try:
+            message = json.loads(data)
+        except ValueError:
+            return
+        if message.get("o") == self.instance:
+            return
+        cache = self._caches.get(message.get("c"))
+        if cache is not None:
+            self.received += 1
+            cache.invalidate(message["k"])
+
+    async def _listen(self) -> None:
+        delay = RECONNECT_DELAY_MIN
+        while not self._stopping:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(CHANNEL)
+                # Invalidations sent while we were not subscribed are lost
+                self._clear_local()
+                delay = RECONNECT_DELAY_MIN
+                while not self._stopping:
+                    message = await pubsub.get_message(timeout=LISTEN_POLL)
+                    if message is not None and message["type"] == "message":
+                        self._apply(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                self.reconnects += 1
+                logger.warning("cache invalidation subscription lost, retrying in %.0fs: %s", delay, e)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+            if self._stopping:
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": "redis" if self.client is not None else "local",
+            "subscribed": self._task is not None and not self._task.done(),
+            "published": self.published,
+            "received": self.received,
+            "errors": self.errors,
+            "reconnects": self.reconnects,
+        }
+
+
+class TwoTierCache:
+    """Local LRU in front of Redis; values are stored in Redis as ``encode(value)`` JSON."""
+
+    def __init__(
+        self,
+        name: str,
+        bus: CacheBus,
+        local: TTLCache,
+        encode: Callable[[Any], Any] = lambda value: value,
+        decode: Callable[[Any], Any] = lambda data: data,
+    ):
+        self.name = name
+        self.bus = bus
+        self.local = local
+        self.encode = encode
+        self.decode = decode
+        self.remote_hits = 0
+        self.remote_misses = 0
+        bus.register(name, local)
+
+    def _key(self, key: Hashable) -> str:
+        return f"{KEY_PREFIX}{self.name}:{key}"
+
+    async def get(self, key: Hashable) -> Any:
+        value = self.local.get(key)
+        if value is not None or self.bus.client is None:
+            return value
+        data = await self.bus.call(self.bus.client.get, self._key(key))
+        if data is None:
+            self.remote_misses += 1
+            return None
+        self.remote_hits += 1
+        value = self.decode(json.loads(data))
+        self.local.set(key, value)
+        return value
+
+    async def set(self, key: Hashable, value: Any) -> None:
+        self.local.set(key, value)
+        if self.bus.client is not None:
+            await self.bus.call(
+                self.bus.client.set, self._key(key), json.dumps(self.encode(value), ensure_ascii=False),
+                ex=max(1, int(self.local.ttl)),
+            )
+
+    async def invalidate(self, key: Hashable) -> None:
+        self.local.invalidate(key)
+        if self.bus.client is not None:
+            await self.bus.call(self.bus.client.delete, self._key(key))
+            await self.bus.publish(self.name, str(key))
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.local.stats(), "remote_hits": self.remote_hits, "remote_misses": self.remote_misses}
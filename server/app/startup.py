@@ -0,0 +1,172 @@
+"""Cold-start timing for a worker process, served at ``/api/v1/admin/startup``.
+
+main.py creates a :class:`StartupReport` before its other imports, makes
+them inside :meth:`StartupReport.timing_imports` and calls
+:meth:`StartupReport.imports_done` at the end of the module. Within the
+``with`` block every import statement in the app's own modules that loads
+a new module is timed; the import hook is removed when the block exits,
+even if an import failed. Times are cumulative, as in ``python -X importtime``:
+``app.metrics`` includes ``prometheus_client``, which is listed as well
+because app.metrics imports it. The startup event's work is timed in
+named phases, and time-to-ready is measured from the start of the
+process, so the interpreter and server imports count too.
+
+    python -m app.startup --budget-ms 1000
+
+boots the app once (startup and shutdown events included), prints the
+report and fails if time-to-ready exceeded the budget.
+"""
+import argparse
+import asyncio
+import builtins
+import importlib.util
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+
+def process_age() -> Optional[float]:
+    """Seconds since this process started (clock-tick resolution), or None off Linux."""
+    try:
+        with open("/proc/self/stat") as f:
+            # Fields after the parenthesized command name; starttime is field 22
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupReport:
+    def __init__(self, package: str):
+        self.package = package
+        self._started = time.perf_counter()
+        # Interpreter and server startup before app.main began importing
+        self._before_app = process_age()
+        self._import = None
+        self.imports: Dict[str, float] = {}
+        self.import_total: Optional[float] = None
+        self.phases: Dict[str, float] = {}
+        self.ready_at: Optional[float] = None
+        self.preloaded = False
+
+    @classmethod
+    def begin(cls, package: str) -> "StartupReport":
+        report = cls(package)
+        os.register_at_fork(after_in_child=report._forked)
+        return report
+
+    @contextmanager
+    def timing_imports(self):
+        """Time the imports made by the package's modules until the block exits."""
+        self._import = builtins.__import__
+        builtins.__import__ = self._timed_import
+        try:
+            yield
+        finally:
+            builtins.__import__, self._import = self._import, None
+
+    def imports_done(self) -> None:
+        self.import_total = time.perf_counter() - self._started
+
+    def _forked(self) -> None:
+        # A worker forked from a preloaded parent (see server.py): the
+        # imports were paid once by the parent, readiness counts from the fork
+        self._started = time.perf_counter()
+        self._before_app = 0.0
+        self.phases = {}
+        self.ready_at = None
+        self.preloaded = True
+
+    def _module_to_time(self, name: str, globals, fromlist, level: int) -> Optional[str]:
+        if level:
+            package = (globals or {}).get("__package__")
+            if not package:
+                return None
+            name = importlib.util.resolve_name("." * level + name, package)
+        if name not in sys.modules:
+            return name
+        if fromlist and len(fromlist) == 1:
+            # from package import submodule; also taken for plain attributes, which never show up in sys.modules
+            submodule = f"{name}.{fromlist[0]}"
+            if submodule not in sys.modules:
+                return submodule
+        return None
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        importer = (globals or {}).get("__name__", "")
+        if importer != self.package and not importer.startswith(self.package + "."):
+            return self._import(name, globals, locals, fromlist, level)
+        if fromlist and len(fromlist) > 1:
+            package = self._module_to_time(name, globals, (), level)
+            if package is None:
+                # from package import a, b: time each submodule on its own
+                for item in fromlist:
+                    self._timed_import(name, globals, locals, (item,), level)
+        module = self._module_to_time(name, globals, fromlist, level)
+        if module is None:
+            return self._import(name, globals, locals, fromlist, level)
+        started = time.perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            if module in sys.modules and module not in self.imports:
+                self.imports[module] = time.perf_counter() - started
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    def ready(self) -> float:
+        """Mark the worker ready; returns seconds since the process started."""
+        elapsed = time.perf_counter() - self._started
+        self.ready_at = elapsed + (self._before_app or 0.0)
+        return self.ready_at
+
+    def to_dict(self, min_ms: float = 1.0) -> Dict[str, Any]:
+        def ms(seconds: Optional[float]) -> Optional[float]:
+            return round(seconds * 1000, 3) if seconds is not None else None
+
+        imports = sorted(self.imports.items(), key=lambda item: item[1], reverse=True)
+        return {
+            "pid": os.getpid(),
+            "time_to_ready_ms": ms(self.ready_at),
+            "before_app_ms": ms(self._before_app),
+            "preloaded": self.preloaded,
+            "app_import_ms": ms(self.import_total),
+            "phases_ms": {name: ms(seconds) for name, seconds in self.phases.items()},
+            "imports_ms": {module: ms(seconds) for module, seconds in imports if seconds * 1000 >= min_ms},
+        }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Boot the app once and report where cold start time goes")
+    parser.add_argument("--budget-ms", type=float, help="fail if time-to-ready exceeds this")
+    parser.add_argument("--min-ms", type=float, default=1.0, help="omit imports faster than this")
+    args = parser.parse_args(argv)
+
+    from .main import app, startup_report
+
+    async def boot():
+        async with app.router.lifespan_context(app):
+            pass
+
+    asyncio.run(boot())
+    report = startup_report.to_dict(args.min_ms)
+    print(json.dumps(report, indent=2))
+    if args.budget_ms is not None and report["time_to_ready_ms"] > args.budget_ms:
+        print(f"time to ready {report['time_to_ready_ms']} ms exceeds the {args.budget_ms} ms budget", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,217 @@
+"""Incrementally maintained counters and hourly/daily rollups for /admin/stats.
+
+Writers call :func:`record` inside the transaction that inserts the rows being
+counted, so the counters are exact at commit. :func:`reconcile_forever`
+periodically recomputes them from the base tables to repair any drift (e.g.
+rows written by scripts that bypass the API).
+
+Reconciliation reads the base tables and the stored values from one
+snapshot, outside any write transaction, and then adds only the
+differences in a short one. Increments committed in between are kept. A
+generation counter makes a reconciler skip its corrections when another
+worker or replica applied theirs after its snapshot was taken.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+METRICS = ("users", "conversations", "messages", "paid_orders", "revenue")
+
+# granularity -> length of the created_at prefix that identifies a bucket
+GRANULARITIES = {"day": 10, "hour": 13}
+
+# metric -> (table, WHERE clause, aggregate, timestamp column)
+SOURCES = {
+    "users": ("users", "", "COUNT(*)", "created_at"),
+    "conversations": ("conversations", "", "COUNT(*)", "created_at"),
+    "messages": ("messages", "", "COUNT(*)", "created_at"),
+    "paid_orders": ("orders", "WHERE status = 'paid'", "COUNT(*)", "paid_at"),
+    "revenue": ("orders", "WHERE status = 'paid'", "COALESCE(SUM(amount), 0)", "paid_at"),
+}
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value DOUBLE PRECISION NOT NULL DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS stats_rollups (
+        granularity TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        value DOUBLE PRECISION NOT NULL DEFAULT 0,
+        PRIMARY KEY (granularity, bucket, metric)
+    )""",
+]
+
+# Stored next to the metrics in stats_counters; bumped by every reconciliation that writes
+GENERATION = "reconcile_generation"
+
+_CLAIM_GENERATION = (
+    "INSERT INTO stats_counters (name, value) VALUES (?, ?) "
+    "ON CONFLICT(name) DO UPDATE SET value = excluded.value WHERE stats_counters.value = ?"
+)
+
+_COUNTER_UPSERT = (
+    "INSERT INTO stats_counters (name, value) VALUES (?, ?) "
+    "ON CONFLICT(name) DO UPDATE SET value = stats_counters.value + excluded.value"
+)
+_ROLLUP_UPSERT = (
+    "INSERT INTO stats_rollups (granularity, bucket, metric, value) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(granularity, bucket, metric) DO UPDATE SET value = stats_rollups.value + excluded.value"
+)
+
+
+def _timestamp(at) -> str:
+    if at is None:
+        # Same clock and format as the CURRENT_TIMESTAMP column defaults
+        at = datetime.utcnow()
+    return at.strftime("%Y-%m-%d %H:%M:%S") if isinstance(at, datetime) else str(at)
+
+
+async def record(tx, at=None, **deltas: float) -> None:
+    """Add ``deltas`` (metric=amount) to the totals and to the buckets containing ``at``."""
+    deltas = {metric: value for metric, value in deltas.items() if value}
+    if not deltas:
+        return
+    timestamp = _timestamp(at)
+    await tx.execute_many(_COUNTER_UPSERT, list(deltas.items()))
+    await tx.execute_many(_ROLLUP_UPSERT, [
+        (granularity, timestamp[:length], metric, value)
+        for granularity, length in GRANULARITIES.items()
+        for metric, value in deltas.items()
+    ])
+
+
+async def totals(db) -> Dict[str, float]:
+    rows = await db.fetch_all("SELECT name, value FROM stats_counters")
+    values = {metric: 0 for metric in METRICS}
+    values.update({row["name"]: row["value"] for row in rows if row["name"] in values})
+    return values
+
+
+async def rollups(db, granularity: str, start: Optional[str], end: Optional[str]) -> List[Dict[str, Any]]:
+    """Buckets in [start, end) for ``granularity``, one dict per bucket."""
+    conditions, params = ["granularity = ?"], [granularity]
+    if start:
+        conditions.append("bucket >= ?")
+        params.append(start[:GRANULARITIES[granularity]])
+    if end:
+        conditions.append("bucket < ?")
+        params.append(end[:GRANULARITIES[granularity]])
+    rows = await db.fetch_all(
+        f"SELECT bucket, metric, value FROM stats_rollups WHERE {' AND '.join(conditions)} "
+        "ORDER BY bucket",
+        params,
+    )
+    buckets: Dict[str, Dict[str, Any]] = {}
+    for row in rows:
+        bucket = buckets.setdefault(row["bucket"], {"bucket": row["bucket"], **{m: 0 for m in METRICS}})
+        bucket[row["metric"]] = row["value"] if row["metric"] == "revenue" else int(row["value"])
+    return list(buckets.values())
+
+
+def total_query(metric: str) -> str:
+    """SELECT computing ``metric`` from its base table."""
+    table, where, aggregate, _ = SOURCES[metric]
+    return f"SELECT {aggregate} FROM {table} {where}".rstrip()
+
+
+def rollup_query(metric: str, granularity: str) -> str:
+    """SELECT of (bucket, value) for ``metric`` in buckets from the ? timestamp onwards."""
+    table, where, aggregate, column = SOURCES[metric]
+    length = GRANULARITIES[granularity]
+    conditions = [where[len("WHERE "):]] if where else []
+    conditions.append(f"{column} >= ?")
+    return (
+        f"SELECT substr({column}, 1, {length}) AS bucket, {aggregate} AS value FROM {table} "
+        f"WHERE {' AND '.join(conditions)} GROUP BY substr({column}, 1, {length})"
+    )
+
+
+def reconcile_statements(since: Optional[str] = None) -> List[Tuple[str, Sequence[Any]]]:
+    """Statements recomputing the totals, and the rollups from ``since`` onwards."""
+    statements: List[Tuple[str, Sequence[Any]]] = []
+    for metric, (table, where, aggregate, _) in SOURCES.items():
+        statements.append((
+            f"INSERT INTO stats_counters (name, value) SELECT ?, {aggregate} FROM {table} {where or 'WHERE 1 = 1'} "
+            "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+            (metric,),
+        ))
+
+    bucket_since = since or ""
+    statements.append(("DELETE FROM stats_rollups WHERE bucket >= ?", (bucket_since,)))
+    for metric, (table, where, aggregate, column) in SOURCES.items():
+        conditions = [where[len("WHERE "):]] if where else []
+        conditions.append(f"{column} >= ?")
+        for granularity, length in GRANULARITIES.items():
+            statements.append((
+                "INSERT INTO stats_rollups (granularity, bucket, metric, value) "
+                f"SELECT ?, substr({column}, 1, {length}), ?, {aggregate} FROM {table} "
+                f"WHERE {' AND '.join(conditions)} GROUP BY substr({column}, 1, {length})",
+                (granularity, metric, bucket_since),
+            ))
+    return statements
+
+
+def backfill(conn) -> None:
+    """Migration step: create the stats tables and compute them from scratch."""
+    for statement in SCHEMA:
+        conn.execute(statement)
+    for sql, params in reconcile_statements():
+        conn.execute(sql, params)
+
+
+async def reconcile(db, days: int = 2) -> int:
+    """Correct the totals, and the rollups of the last ``days`` days; returns how many values changed."""
+    since = (datetime.utcnow() - timedelta(days=days)).strftime("%Y-%m-%d")
+    async with db.snapshot() as snap:
+        stored = {row["name"]: row["value"] for row in await snap.fetch_all("SELECT name, value FROM stats_counters")}
+        actual = {metric: await snap.fetch_val(total_query(metric)) or 0 for metric in SOURCES}
+        stored_buckets = {
+            (row["granularity"], row["bucket"], row["metric"]): row["value"]
+            for row in await snap.fetch_all(
+                "SELECT granularity, bucket, metric, value FROM stats_rollups WHERE bucket >= ?", (since,)
+            )
+        }
+        actual_buckets = {}
+        for metric in SOURCES:
+            for granularity in GRANULARITIES:
+                for row in await snap.fetch_all(rollup_query(metric, granularity), (since,)):
+                    actual_buckets[(granularity, row["bucket"], metric)] = row["value"]
+
+    counters = _differences(actual, {metric: stored.get(metric, 0) for metric in SOURCES})
+    buckets = _differences(actual_buckets, stored_buckets)
+    if not counters and not buckets:
+        return 0
+    generation = stored.get(GENERATION, 0)
+    async with db.transaction(immediate=True) as tx:
+        if not await tx.execute(_CLAIM_GENERATION, (GENERATION, float(generation + 1), float(generation))):
+            # Another reconciler corrected the values after this snapshot
+            return 0
+        if counters:
+            await tx.execute_many(_COUNTER_UPSERT, list(counters.items()))
+        if buckets:
+            await tx.execute_many(_ROLLUP_UPSERT, [(*key, delta) for key, delta in buckets.items()])
+    return len(counters) + len(buckets)
+
+
+def _differences(actual: Dict[Any, float], stored: Dict[Any, float]) -> Dict[Any, float]:
+    deltas = {}
+    for key in actual.keys() | stored.keys():
+        delta = actual.get(key, 0) - stored.get(key, 0)
+        # Revenue is a float sum; ignore rounding noise
+        if abs(delta) > 1e-6:
+            deltas[key] = delta
+    return deltas
+
+
+async def reconcile_forever(db, interval: float, days: int = 2) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reconcile(db, days)
+        except Exception:
+            logger.exception("stats reconciliation failed")
@@ -0,0 +1,84 @@
+"""Document templates compiled once into literal segments and field slots.
+
+Templates use ``str.format`` placeholders (``{field}``, ``{{``/``}}`` for
+literal braces). Compilation rejects anything beyond plain named fields, so
+rendering is a join over pre-split segments and can report every missing
+field at once instead of failing on the first ``KeyError``.
+"""
+from string import Formatter
+from typing import List, Mapping, Optional, Sequence
+
+
+class TemplateError(ValueError):
+    """Template content or data is invalid; ``errors`` lists every problem found."""
+
+    def __init__(self, errors: Sequence[str]):
+        super().__init__("; ".join(errors))
+        self.errors = list(errors)
+
+
+class MissingFieldsError(TemplateError):
+    def __init__(self, missing: Sequence[str]):
+        super().__init__([f"缺少必填字段: {', '.join(missing)}"])
+        self.missing = list(missing)
+
+
+class CompiledTemplate:
+    __slots__ = ("segments", "slots", "fields")
+
+    def __init__(self, segments: List[str], slots: List[str], fields: List[str]):
+        # len(segments) == len(slots) + 1; output is segments[0] slot0 segments[1] ...
+        self.segments = segments
+        self.slots = slots
+        self.fields = fields
+
+    def missing(self, data: Mapping[str, object]) -> List[str]:
+        return [name for name in self.fields if name not in data]
+
+    def render(self, data: Mapping[str, object]) -> str:
+        missing = self.missing(data)
+        if missing:
+            raise MissingFieldsError(missing)
+        parts = [self.segments[0]]
+        for slot, segment in zip(self.slots, self.segments[1:], strict=True):
+            parts.append(str(data[slot]))
+            parts.append(segment)
+        return "".join(parts)
+
+
+def compile_template(content: str, fields: Optional[Sequence[str]] = None) -> CompiledTemplate:
+    """Parse ``content``; if ``fields`` is given every placeholder must be declared in it."""
+    try:
+        parsed = list(Formatter().parse(content))
+    except ValueError as e:
+        raise TemplateError([f"模板语法错误: {e}"]) from e
+
+    errors, invalid = [], set()
+    segments, slots = [""], []
+    for literal, name, format_spec, conversion in parsed:
+        segments[-1] += literal
+        if name is None:
+            continue
+        if not name or name.isdigit():
+            errors.append("占位符必须是命名字段，如 {applicant_name}")
+            invalid.add(name)
+        elif any(ch in name for ch in ".[]"):
+            errors.append(f"字段 {name} 不支持属性或下标访问")
+            invalid.add(name)
+        elif format_spec or conversion:
+            errors.append(f"字段 {name} 不支持格式说明符")
+        slots.append(name)
+        segments.append("")
+
+    used = list(dict.fromkeys(slots))
+    if fields is None:
+        fields = used
+    else:
+        fields = list(dict.fromkeys(fields))
+        undeclared = [name for name in used if name not in fields and name not in invalid]
+        if undeclared:
+            errors.append(f"模板中使用了未声明的字段: {', '.join(undeclared)}")
+    if errors:
+        raise TemplateError(errors)
+    # Only placeholders are required at render time; extra declared fields are optional
+    return CompiledTemplate(segments, slots, used)
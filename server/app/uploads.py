@@ -0,0 +1,264 @@
+"""Content-addressed attachment storage with resumable, chunked uploads.
+
+Blobs live at ``<root>/blobs/<h[:2]>/<h[2:4]>/<sha256>`` and are shared by
+every attachment with the same content; ``blobs.ref_count`` tracks how many
+attachments point at each one. Resumable uploads append to
+``<root>/partial/<upload_id>`` and are hashed while they stream, so
+finalizing normally costs one rename. All file I/O runs on the default
+executor.
+"""
+import asyncio
+import fcntl
+import hashlib
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+WRITE_BUFFER_BYTES = 1024 * 1024
+
+SCHEMA = [
+    "ALTER TABLE attachments ADD COLUMN user_id TEXT",
+    "ALTER TABLE attachments ADD COLUMN content_hash TEXT",
+    "CREATE INDEX IF NOT EXISTS idx_attachments_hash ON attachments (content_hash)",
+    """CREATE TABLE IF NOT EXISTS blobs (
+        hash TEXT PRIMARY KEY,
+        size_bytes INTEGER NOT NULL,
+        storage_path TEXT NOT NULL,
+        ref_count INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS upload_sessions (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        file_name TEXT NOT NULL,
+        content_type TEXT,
+        size_bytes INTEGER,
+        received_bytes INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""",
+]
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadStore:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.partial_dir = os.path.join(root, "partial")
+        self.blob_dir = os.path.join(root, "blobs")
+        os.makedirs(self.partial_dir, exist_ok=True)
+        os.makedirs(self.blob_dir, exist_ok=True)
+        # upload_id -> (sha256 of the partial file, (size, mtime_ns) it was taken at).
+        # Only trusted while the file is unchanged; otherwise finalize rehashes from disk.
+        self._hashers: Dict[str, Tuple["hashlib._Hash", Tuple[int, int]]] = {}
+        self._locks: Dict[str, list] = {}
+
+    def partial_path(self, upload_id: str) -> str:
+        return os.path.join(self.partial_dir, upload_id)
+
+    def blob_path(self, content_hash: str) -> str:
+        return os.path.join(self.blob_dir, content_hash[:2], content_hash[2:4], content_hash)
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    @asynccontextmanager
+    async def _locked(self, upload_id: str):
+        entry = self._locks.setdefault(upload_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[upload_id]
+
+    async def append(
+        self, upload_id: str, offset: int, chunks: AsyncIterator[bytes], limit: Optional[int] = None
+    ) -> int:
+        """Write ``chunks`` at ``offset`` of the partial file; returns the new length.
+
+        Anything past ``offset`` from an earlier interrupted request is dropped
+        first. Raises ``ValueError`` if fewer than ``offset`` bytes were received.
+        """
+        limit = self.max_bytes if limit is None else min(limit, self.max_bytes)
+        async with self._locked(upload_id):
+            f, before = await self._run(_open_at, self.partial_path(upload_id), offset)
+            entry = self._hashers.pop(upload_id, None)
+            if offset == 0:
+                hasher = hashlib.sha256()
+            elif entry and entry[1] == (offset, before.st_mtime_ns) and before.st_size == offset:
+                hasher = entry[0]
+            else:
+                hasher = None
+            written = 0
+            buffer = bytearray()
+            try:
+                async for piece in chunks:
+                    if offset + written + len(buffer) + len(piece) > limit:
+                        raise UploadTooLarge()
+                    buffer += piece
+                    if len(buffer) >= WRITE_BUFFER_BYTES:
+                        written += await self._run(_write, f, hasher, bytes(buffer))
+                        buffer.clear()
+            finally:
+                try:
+                    if buffer:
+                        written += await self._run(_write, f, hasher, bytes(buffer))
+                finally:
+                    state = await self._run(_close, f)
+                if hasher is not None:
+                    self._hashers[upload_id] = (hasher, state)
+            return offset + written
+
+    async def finalize(self, upload_id: str, size: int) -> str:
+        """Check a completed partial file and return its sha256.
+
+        Uses the hash taken while streaming unless the file changed since.
+        """
+        async with self._locked(upload_id):
+            partial = self.partial_path(upload_id)
+            st = await self._run(os.stat, partial)
+            if st.st_size != size:
+                raise ValueError("partial file does not match the recorded size")
+            entry = self._hashers.pop(upload_id, None)
+            if entry and entry[1] == (st.st_size, st.st_mtime_ns):
+                return entry[0].hexdigest()
+            return await self._run(_hash_file, partial)
+
+    async def place(self, upload_id: str, content_hash: str) -> Tuple[str, bool]:
+        """Move a finalized partial file into the blob store; returns (blob path, created).
+
+        Call inside the transaction that takes the blob reference, after
+        :func:`lock_blob`, so it serializes with :func:`remove_unreferenced`.
+        ``created`` is false when the same content was already stored; if the
+        transaction then fails, only a file this call created may be removed.
+        """
+        path = self.blob_path(content_hash)
+        created = await self._run(_move_into_place, self.partial_path(upload_id), path)
+        return path, created
+
+    async def store(self, upload_id: str, chunks: AsyncIterator[bytes]) -> Tuple[str, int]:
+        """One-shot upload: stream to a partial file and hash it; returns (hash, size)."""
+        try:
+            size = await self.append(upload_id, 0, chunks)
+            return await self.finalize(upload_id, size), size
+        except BaseException:
+            await self.discard(upload_id)
+            raise
+
+    async def discard(self, upload_id: str) -> None:
+        self._hashers.pop(upload_id, None)
+        await self._run(_remove, self.partial_path(upload_id))
+
+    async def remove_blob(self, path: str) -> None:
+        await self._run(_remove, path)
+
+
+def _open_at(path: str, offset: int):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o640)
+    f = os.fdopen(fd, "r+b")
+    try:
+        # Serialize writers of the same upload, including other workers on this host
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        before = os.fstat(f.fileno())
+        if before.st_size < offset:
+            raise ValueError("offset beyond received data")
+        # Drop anything past the offset the client resumes from
+        f.truncate(offset)
+        f.seek(offset)
+        return f, before
+    except BaseException:
+        f.close()
+        raise
+
+
+def _write(f, hasher, data: bytes) -> int:
+    f.write(data)
+    if hasher is not None:
+        hasher.update(data)
+    return len(data)
+
+
+def _close(f) -> Tuple[int, int]:
+    try:
+        f.flush()
+        st = os.fstat(f.fileno())
+        return st.st_size, st.st_mtime_ns
+    finally:
+        f.close()
+
+
+def _hash_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(WRITE_BUFFER_BYTES), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _move_into_place(partial: str, path: str) -> bool:
+    if os.path.exists(path):
+        # Same content is already stored
+        os.remove(partial)
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(partial, path)
+    return True
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def lock_blob(tx, content_hash: str) -> None:
+    """Serialize the transactions that add or drop references to one blob.
+
+    BEGIN IMMEDIATE already serializes SQLite writers; PostgreSQL takes a
+    transaction-level advisory lock on the hash.
+    """
+    if tx.dialect == "postgres":
+        await tx.fetch_val("SELECT pg_advisory_xact_lock(hashtext(?))", (content_hash,))
+
+
+async def add_ref(tx, content_hash: str, size: int, path: str) -> None:
+    await tx.execute(
+        "INSERT INTO blobs (hash, size_bytes, storage_path, ref_count) VALUES (?, ?, ?, 1) "
+        "ON CONFLICT(hash) DO UPDATE SET ref_count = blobs.ref_count + 1",
+        (content_hash, size, path),
+    )
+
+
+async def release_ref(tx, content_hash: str) -> Optional[str]:
+    """Drop one reference; returns the blob path once nothing refers to it any more.
+
+    Leave the file alone until the transaction has committed, then pass the
+    path to :func:`remove_unreferenced`: a rollback keeps the reference.
+    """
+    await tx.execute("UPDATE blobs SET ref_count = ref_count - 1 WHERE hash = ?", (content_hash,))
+    blob = await tx.fetch_one(
+        "SELECT storage_path FROM blobs WHERE hash = ? AND ref_count <= 0", (content_hash,)
+    )
+    if blob is None:
+        return None
+    await tx.execute("DELETE FROM blobs WHERE hash = ?", (content_hash,))
+    return blob["storage_path"]
+
+
+async def remove_unreferenced(db, store: UploadStore, content_hash: str, path: str) -> bool:
+    """Delete a released blob's file unless an upload of the same content has referenced it since."""
+    async with db.transaction(immediate=True) as tx:
+        await lock_blob(tx, content_hash)
+        if await tx.fetch_val("SELECT 1 FROM blobs WHERE hash = ?", (content_hash,)):
+            return False
+        # Under the lock, so no upload can place the same content until the file is gone
+        await store.remove_blob(path)
+        return True
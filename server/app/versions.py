@@ -0,0 +1,70 @@
+"""Per-table version counters for ETags on read-mostly endpoints.
+
+Writers call :func:`bump` inside the transaction that changes a versioned
+table; once it commits, the caller invalidates the table in every replica's
+:class:`VersionCache` (see ``table_changed`` in main.py). Readers derive
+their ETag from the cached version, so a conditional GET that ends in 304
+needs no database work.
+"""
+import time
+from typing import Any, Dict, Tuple
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS table_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )""",
+]
+
+
+async def bump(tx, name: str) -> None:
+    await tx.execute(
+        "INSERT INTO table_versions (name, version) VALUES (?, 1) "
+        "ON CONFLICT(name) DO UPDATE SET version = table_versions.version + 1",
+        (name,),
+    )
+
+
+class VersionCache:
+    """Versions by table name, kept until invalidated or ``ttl`` seconds old.
+
+    The TTL only bounds staleness when an invalidation from another replica
+    is lost; normally entries are dropped as soon as the table changes.
+    """
+
+    def __init__(self, ttl: float = 60.0):
+        self.ttl = ttl
+        self._data: Dict[str, Tuple[int, float]] = {}
+        # Bumped by every invalidation so a read that raced one is not cached
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, db, name: str) -> int:
+        entry = self._data.get(name)
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        generation = self._generation
+        version = await db.fetch_val("SELECT version FROM table_versions WHERE name = ?", (name,)) or 0
+        if generation == self._generation:
+            self._data[name] = (version, time.monotonic() + self.ttl)
+        return version
+
+    def invalidate(self, name: str) -> None:
+        self._generation += 1
+        self._data.pop(name, None)
+
+    def clear(self) -> None:
+        self._generation += 1
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "versions": {name: version for name, (version, _) in self._data.items()},
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+        }
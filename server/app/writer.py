@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+Flush = Callable[[Any, List[Any]], Awaitable[None]]
+
+_STOP = object()
+
+
+class GroupCommitWriter:
+    """Coalesces writes from concurrent requests into shared transactions.
+
+    ``submit(item)`` queues an item and resolves once the transaction that
+    contains it has committed. A background task takes everything queued,
+    waiting at most ``max_delay`` after the first item for stragglers, and
+    hands up to ``max_batch`` items to ``flush(tx, items)`` in one transaction,
+    so N concurrent writers pay for one commit instead of N. If a batch fails,
+    its items are retried one by one so a single bad item only fails its own
+    caller.
+    """
+
+    def __init__(self, db, flush: Flush, name: str, max_batch: int = 256, max_delay: float = 0.002):
+        self.db = db
+        self.flush = flush
+        self.name = name
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self._batches = 0
+        self._items = 0
+        self._failures = 0
+        self._max_batch_seen = 0
+        self._commit_total = 0.0
+        self._commit_max = 0.0
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Commit whatever is already queued, then stop the background task."""
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        self._queue.put_nowait(_STOP)
+        await task
+        self._queue = None
+
+    async def submit(self, item: Any) -> None:
+        if self._task is None:
+            # Not running (e.g. scripts without the app lifecycle): write directly
+            async with self.db.transaction(immediate=True) as tx:
+                await self.flush(tx, [item])
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, future))
+        await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            entry = await self._queue.get()
+            if entry is _STOP:
+                return
+            batch = [entry]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                if self._queue.empty():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        entry = await asyncio.wait_for(self._queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    entry = self._queue.get_nowait()
+                if entry is _STOP:
+                    stopping = True
+                    break
+                batch.append(entry)
+            await self._commit(batch)
+
+    async def _commit(self, batch: List[tuple]) -> None:
+        started = time.perf_counter()
+        try:
+            async with self.db.transaction(immediate=True) as tx:
+                await self.flush(tx, [item for item, _ in batch])
+        except Exception as exc:
+            if len(batch) == 1:
+                self._failures += 1
+                _resolve(batch[0][1], exc)
+                return
+            logger.warning("%s batch of %d failed, retrying items individually: %s", self.name, len(batch), exc)
+            for entry in batch:
+                await self._commit([entry])
+            return
+
+        elapsed = time.perf_counter() - started
+        self._batches += 1
+        self._items += len(batch)
+        self._max_batch_seen = max(self._max_batch_seen, len(batch))
+        self._commit_total += elapsed
+        self._commit_max = max(self._commit_max, elapsed)
+        for _, future in batch:
+            _resolve(future, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "batches": self._batches,
+            "items": self._items,
+            "failures": self._failures,
+            "avg_batch_size": round(self._items / self._batches, 2) if self._batches else None,
+            "max_batch_size": self._max_batch_seen,
+            "avg_commit_ms": round(self._commit_total / self._batches * 1000, 3) if self._batches else None,
+            "max_commit_ms": round(self._commit_max * 1000, 3),
+        }
+
+
+def _resolve(future: asyncio.Future, exc: Optional[BaseException]) -> None:
+    if future.done():
+        return
+    if exc is None:
+        future.set_result(None)
+    else:
+        future.set_exception(exc)
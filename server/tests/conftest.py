@@ -0,0 +1,50 @@
+"""The app on a fresh SQLite database, driven in-process through httpx.
+
+Set TEST_DATABASE_URL to a scratch PostgreSQL database to run the same
+tests against PostgreSQL instead.
+
+app.main reads its configuration at import, so the environment is set
+before it is imported. One app instance serves the whole session; tests
+keep out of each other's way by logging in as users of their own.
+"""
+import itertools
+import os
+import tempfile
+
+import httpx
+import pytest
+
+os.environ["DATABASE_URL"] = (
+    os.environ.get("TEST_DATABASE_URL") or os.path.join(tempfile.mkdtemp(prefix="salaryhelper-test-"), "test.db")
+)
+os.environ["MESSAGE_RATE_PER_MINUTE"] = "0"
+os.environ["PAYMENT_NOTIFY_SECRET"] = "test-notify-secret"
+
+from app.main import app  # noqa: E402
+
+_phones = itertools.count(1)
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="session")
+async def client():
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test/api/v1") as client:
+            yield client
+
+
+async def login(client: httpx.AsyncClient) -> dict:
+    """Authorization headers for a new user."""
+    response = await client.post("/auth/login", json={"phone": f"137{next(_phones):08d}", "code": "123456"})
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['data']['token']}"}
+
+
+@pytest.fixture
+async def auth(client):
+    return await login(client)
@@ -0,0 +1,106 @@
+import asyncio
+
+import httpx
+import pytest
+from starlette.responses import JSONResponse
+
+from app import admission
+from app.main import admission_control, token_user
+
+pytestmark = pytest.mark.anyio
+
+USERS = {"token-a": "user-a", "token-b": "user-b"}
+
+
+class Backend:
+    """Answers 200; requests to /slow wait until ``release`` is set."""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+
+    async def __call__(self, scope, receive, send):
+        if scope["path"] == "/slow":
+            await self.release.wait()
+        await JSONResponse({"code": 0})(scope, receive, send)
+
+
+def _client(controller, backend=None, address="10.0.0.1"):
+    app = admission.AdmissionMiddleware(backend or Backend(), controller)
+    transport = httpx.ASGITransport(app=app, client=(address, 50000))
+    return httpx.AsyncClient(transport=transport, base_url="http://test")
+
+
+def _controller(*rules, max_concurrency=8, max_queue=8):
+    return admission.AdmissionController(
+        list(rules), max_concurrency=max_concurrency, max_queue=max_queue, queue_timeout=1.0, identify=USERS.get,
+    )
+
+
+def _bearer(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def test_rate_limited_per_user():
+    controller = _controller(admission.Rule("post", [("POST", "/items/{id}")], rate=0.01, burst=2))
+    async with _client(controller) as client:
+        statuses = [(await client.post("/items/1", headers=_bearer("token-a"))).status_code for _ in range(3)]
+        assert statuses == [200, 200, 429]
+        response = await client.post("/items/2", headers=_bearer("token-a"))
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) >= 1
+
+        # Another user has a bucket of their own
+        assert (await client.post("/items/1", headers=_bearer("token-b"))).status_code == 200
+        # Routes without a rule are not rate limited
+        assert (await client.post("/other", headers=_bearer("token-a"))).status_code == 200
+
+
+async def test_unverified_tokens_share_the_address_bucket():
+    controller = _controller(admission.Rule("post", [("POST", "/items")], rate=0.01, burst=2))
+    async with _client(controller) as client:
+        statuses = [
+            (await client.post("/items", headers=_bearer(f"made-up-{i}"))).status_code for i in range(3)
+        ]
+        assert statuses == [200, 200, 429]
+        assert (await client.post("/items")).status_code == 429
+        assert (await client.post("/items", headers=_bearer("token-a"))).status_code == 200
+    assert controller.stats()["rules"]["post"]["rate"]["keys"] == 2
+
+
+async def test_rate_limited_per_address():
+    controller = _controller(
+        admission.Rule("sms", [("POST", "/sms")], rate=0.01, burst=1, key=admission.BY_IP),
+    )
+    async with _client(controller, address="10.0.0.1") as first, _client(controller, address="10.0.0.2") as second:
+        assert (await first.post("/sms", headers=_bearer("token-a"))).status_code == 200
+        assert (await first.post("/sms", headers=_bearer("token-b"))).status_code == 429
+        assert (await second.post("/sms")).status_code == 200
+
+
+async def test_queue_full_sheds_and_critical_routes_pass():
+    controller = _controller(
+        admission.Rule("health", [("GET", "/health")], critical=True), max_concurrency=1, max_queue=0,
+    )
+    backend = Backend()
+    async with _client(controller, backend) as client:
+        slow = asyncio.ensure_future(client.get("/slow"))
+        while controller.limit.active == 0:
+            await asyncio.sleep(0.001)
+
+        response = await client.get("/fast")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+        assert (await client.get("/health")).status_code == 200
+
+        backend.release.set()
+        assert (await slow).status_code == 200
+        assert (await client.get("/fast")).status_code == 200
+    assert controller.stats()["global"]["rejected"][admission.QUEUE_FULL] == 1
+
+
+async def test_app_identifies_users_by_verified_token(client, auth):
+    token = auth["Authorization"].split(" ", 1)[1]
+    user_id = (await client.get("/auth/me", headers=auth)).json()["data"]["id"]
+    assert token_user(token) == user_id
+    assert token_user(token + "x") is None
+    assert admission_control.identify(token) == user_id
@@ -0,0 +1,108 @@
+import time
+from datetime import timedelta
+
+import pytest
+
+from app import cache as cache_module
+from app.cache import TTLCache
+from app.main import _token_digest, create_access_token, decode_access_token, token_cache, user_cache
+from conftest import login
+
+pytestmark = pytest.mark.anyio
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, "monotonic", clock)
+    return clock
+
+
+def test_ttl_expiry(clock):
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=5)
+    clock.now += 5
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    clock.now += 55
+    assert cache.get("a") is None
+    # A per-entry TTL never extends the cache's own
+    cache.set("c", 3, ttl=600)
+    clock.now += 60
+    assert cache.get("c") is None
+    cache.set("d", 4, ttl=-1)
+    assert "d" not in cache._data
+
+
+def test_lru_eviction(clock):
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats()["evictions"] == 1
+
+
+def _bearer(token: str):
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def test_expired_token_not_served_from_cache(client, auth):
+    user_id = (await client.get("/auth/me", headers=auth)).json()["data"]["id"]
+    token = create_access_token({"sub": user_id}, expires_delta=timedelta(seconds=2))
+    assert (await client.get("/auth/me", headers=_bearer(token))).status_code == 200
+    assert token_cache.get(_token_digest(token)) == user_id
+
+    # The JWT check itself compares whole seconds
+    time.sleep(max(0.0, decode_access_token(token)["exp"] + 1 - time.time()))
+    assert token_cache.get(_token_digest(token)) is None
+    assert (await client.get("/auth/me", headers=_bearer(token))).status_code == 401
+
+
+async def test_logout_revokes_the_token(client, auth):
+    other = await login(client)
+    token = auth["Authorization"].split(" ", 1)[1]
+    assert (await client.get("/auth/me", headers=auth)).status_code == 200
+    assert token_cache.get(_token_digest(token)) is not None
+
+    assert (await client.post("/auth/logout", headers=auth)).status_code == 200
+    assert token_cache.get(_token_digest(token)) is None
+    assert (await client.get("/auth/me", headers=auth)).status_code == 401
+    # Still refused by a worker that never cached it
+    token_cache.clear()
+    assert (await client.get("/auth/me", headers=auth)).status_code == 401
+    assert (await client.get("/auth/me", headers=other)).status_code == 200
+
+
+async def test_logout_keeps_the_users_other_tokens(client):
+    phone_auth = await login(client)
+    user = (await client.get("/auth/me", headers=phone_auth)).json()["data"]
+    second = await client.post("/auth/login", json={"phone": user["phone"], "code": "123456"})
+    second_auth = _bearer(second.json()["data"]["token"])
+    assert second_auth != phone_auth
+
+    await client.post("/auth/logout", headers=phone_auth)
+    assert (await client.get("/auth/me", headers=second_auth)).status_code == 200
+
+
+async def test_profile_update_evicts_cached_user(client, auth):
+    me = (await client.get("/auth/me", headers=auth)).json()["data"]
+    assert (await user_cache.get(me["id"]))["name"] == me["name"]
+
+    response = await client.put("/auth/me", json={"name": "  新名字 "}, headers=auth)
+    assert response.json()["data"]["name"] == "新名字"
+    assert (await client.get("/auth/me", headers=auth)).json()["data"]["name"] == "新名字"
+
+    assert (await client.put("/auth/me", json={"name": " "}, headers=auth)).status_code == 400
+    assert (await client.put("/auth/me", json={"name": "名" * 51}, headers=auth)).status_code == 422
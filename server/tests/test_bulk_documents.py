@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from app.bulk_documents import generate_documents
+from app.main import db, render_pool
+from app.template_engine import compile_template
+
+pytestmark = pytest.mark.anyio
+
+
+def _lines(body: bytes):
+    return [json.loads(line) for line in body.decode("utf-8").splitlines()]
+
+
+async def _template(client, auth) -> str:
+    template = {"name": "收入证明", "content": "{name} 月收入 {salary} 元"}
+    return (await client.post("/templates", json=template, headers=auth)).json()["data"]["id"]
+
+
+async def _contents(client, auth, lines):
+    contents = []
+    for line in lines:
+        if "id" in line:
+            document = (await client.get(f"/documents/{line['id']}", headers=auth)).json()["data"]
+            contents.append(document["content"])
+    return contents
+
+
+async def test_batch_reports_each_row(client, auth):
+    template_id = await _template(client, auth)
+    rows = [{"name": "张三", "salary": "8000"}, {"name": "李四"}, {"name": "王五", "salary": "9000"}]
+    response = await client.post("/documents/batch", json={"template_id": template_id, "rows": rows}, headers=auth)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+
+    lines = _lines(response.content)
+    assert lines[-1] == {"done": True, "created": 2, "failed": 1}
+    assert [line["row"] for line in lines[:-1]] == [1, 2, 3]
+    assert "salary" in lines[1]["error"]
+    assert await _contents(client, auth, lines) == ["张三 月收入 8000 元", "王五 月收入 9000 元"]
+
+
+async def test_batch_from_csv(client, auth):
+    template_id = await _template(client, auth)
+    csv = "\ufeffname,salary\r\n赵六,7000\r\n孙七\r\n".encode("utf-8")
+    response = await client.post(
+        "/documents/batch/csv", data={"template_id": template_id, "title": "批量"},
+        files={"file": ("rows.csv", csv, "text/csv")}, headers=auth,
+    )
+    lines = _lines(response.content)
+    assert lines[-1] == {"done": True, "created": 1, "failed": 1}
+    assert "salary" in lines[1]["error"]
+    assert await _contents(client, auth, lines) == ["赵六 月收入 7000 元"]
+
+    response = await client.post(
+        "/documents/batch/csv", data={"template_id": template_id},
+        files={"file": ("rows.csv", "name\n张三\n".encode("gbk"), "text/csv")}, headers=auth,
+    )
+    assert response.status_code == 400
+
+
+async def test_batch_unknown_template(client, auth):
+    response = await client.post("/documents/batch", json={"template_id": "missing", "rows": []}, headers=auth)
+    assert response.status_code == 404
+
+
+async def test_generate_across_chunks(client, auth):
+    user_id = (await client.get("/auth/me", headers=auth)).json()["data"]["id"]
+    template_id = await _template(client, auth)
+    compiled = compile_template("第 {n} 份")
+    rows = [{"n": str(i)} if i % 3 else {} for i in range(7)]
+
+    documents = generate_documents(db, render_pool, compiled, template_id, "分块", user_id, rows, chunk_size=2)
+    body = b"".join([part async for part in documents])
+    lines = _lines(body)
+    assert [line["row"] for line in lines[:-1]] == list(range(1, 8))
+    assert lines[-1] == {"done": True, "created": 4, "failed": 3}
+    stored = await db.fetch_all("SELECT content FROM documents WHERE user_id = ? AND title = ?", (user_id, "分块"))
+    assert sorted(row["content"] for row in stored) == [f"第 {i} 份" for i in (1, 2, 4, 5)]
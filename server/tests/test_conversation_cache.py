@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+from app import main
+from app.conversation_cache import ConversationCache
+from app.main import conversation_cache
+from app.pagination import encode_cursor
+
+pytestmark = pytest.mark.anyio
+
+
+async def _conversation(client, auth, count: int) -> str:
+    conv_id = (await client.post("/conversations", json={"title": "缓存"}, headers=auth)).json()["data"]["id"]
+    for i in range(count):
+        await client.post(f"/conversations/{conv_id}/messages", json={"text": f"消息 {i}"}, headers=auth)
+    return conv_id
+
+
+async def test_posted_message_served_from_cache(client, auth):
+    conv_id = await _conversation(client, auth, 1)
+    url = f"/conversations/{conv_id}"
+    await client.get(url, headers=auth)
+    assert conversation_cache.get(conv_id) is not None
+
+    response = await client.post(f"{url}/messages", json={"text": "新消息"}, headers=auth)
+    message_id = response.json()["data"]["message_id"]
+    misses, fallbacks = conversation_cache.misses, conversation_cache.fallbacks
+    messages = (await client.get(url, headers=auth)).json()["data"]["messages"]
+    assert [m["content"] for m in messages[-2:]] == ["新消息", response.json()["data"]["ai_reply"]["content"]]
+    assert messages[-2]["id"] == message_id
+    assert (conversation_cache.misses, conversation_cache.fallbacks) == (misses, fallbacks)
+
+
+async def test_append_during_cold_load_is_not_cached():
+    cache = ConversationCache(max_bytes=1 << 20, tail_size=10)
+    conversation = {"id": "c", "user_id": "u"}
+    old = [{"id": "m1", "conversation_id": "c", "sender": "user", "sender_id": "u", "content": "旧",
+            "created_at": "2026-01-01 00:00:00.000001"}]
+    release = asyncio.Event()
+
+    async def slow_loader():
+        # Read before the append commits, returned after it
+        await release.wait()
+        return conversation, list(old), True
+
+    load = asyncio.ensure_future(cache.load("c", slow_loader))
+    await asyncio.sleep(0)
+    cache.append("c", [("m2", "c", "ai", None, "新", "2026-01-01 00:00:00.000002")])
+    release.set()
+
+    tail = await load
+    assert [m["id"] for m in tail.messages] == ["m1"]
+    assert cache.get("c") is None
+
+    # The next load, which sees the append, is cached
+    fresh = old + [{"id": "m2", "conversation_id": "c", "sender": "ai", "sender_id": None, "content": "新",
+                    "created_at": "2026-01-01 00:00:00.000002"}]
+
+    async def loader():
+        return conversation, fresh, True
+
+    await cache.load("c", loader)
+    assert [m["id"] for m in cache.get("c").messages] == ["m1", "m2"]
+
+
+async def _walk(client, auth, url):
+    """Every response paging back from the latest page, then forward from the first message."""
+    bodies, params = [], {"limit": 4}
+    while True:
+        body = (await client.get(url, params=params, headers=auth)).json()
+        bodies.append(body)
+        if body["before_cursor"] is None:
+            break
+        params = {"limit": 4, "before": body["before_cursor"]}
+    params = {"limit": 4, "cursor": encode_cursor(body["data"]["messages"][0])}
+    while True:
+        body = (await client.get(url, params=params, headers=auth)).json()
+        bodies.append(body)
+        if body["next_cursor"] is None:
+            return bodies
+        params = {"limit": 4, "cursor": body["next_cursor"]}
+
+
+async def test_cached_pages_match_the_database(client, auth, monkeypatch):
+    conv_id = await _conversation(client, auth, 7)
+    url = f"/conversations/{conv_id}"
+
+    # The whole conversation is in the tail
+    conversation_cache.invalidate(conv_id)
+    fallbacks = conversation_cache.fallbacks
+    cached = await _walk(client, auth, url)
+    assert conversation_cache.fallbacks == fallbacks
+
+    # Only the last 3 messages are: most pages go to the database
+    monkeypatch.setattr(main, "CONVERSATION_TAIL_SIZE", 3)
+    conversation_cache.invalidate(conv_id)
+    from_db = await _walk(client, auth, url)
+    assert conversation_cache.fallbacks > fallbacks
+
+    # 14 messages: 4 pages back, then 13 more going forward
+    assert [len(body["data"]["messages"]) for body in cached] == [4, 4, 4, 2, 4, 4, 4, 1]
+    assert from_db == cached
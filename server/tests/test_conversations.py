@@ -0,0 +1,70 @@
+import pytest
+
+from app.pagination import decode_cursor, encode_cursor
+from conftest import login
+
+pytestmark = pytest.mark.anyio
+
+
+def test_cursor_round_trip():
+    row = {"created_at": "2026-10-17 08:00:00.123456", "id": "会话-1"}
+    assert decode_cursor(encode_cursor(row)) == (row["created_at"], row["id"])
+
+
+async def test_invalid_cursor(client, auth):
+    response = await client.get("/conversations", params={"cursor": "not-a-cursor"}, headers=auth)
+    assert response.status_code == 400
+
+
+async def _conversation_with_messages(client, auth, count: int) -> str:
+    conv_id = (await client.post("/conversations", json={"title": "分页"}, headers=auth)).json()["data"]["id"]
+    for i in range(count):
+        response = await client.post(f"/conversations/{conv_id}/messages", json={"text": f"消息 {i}"}, headers=auth)
+        assert response.status_code == 200, response.text
+    return conv_id
+
+
+async def test_conversation_pages_back_and_forward(client, auth):
+    # Each message gets an AI reply
+    conv_id = await _conversation_with_messages(client, auth, 6)
+    url = f"/conversations/{conv_id}"
+
+    # Latest page first, then before_cursor back to the start
+    pages = []
+    params = {"limit": 5}
+    while True:
+        body = (await client.get(url, params=params, headers=auth)).json()
+        pages.insert(0, body["data"]["messages"])
+        assert body["next_cursor"] is None
+        if body["before_cursor"] is None:
+            break
+        params = {"limit": 5, "before": body["before_cursor"]}
+    backward = [message["id"] for page in pages for message in page]
+    assert len(backward) == len(set(backward)) == 12
+    assert [len(page) for page in pages] == [2, 5, 5]
+
+    # And from the first message forward with next_cursor
+    first = pages[0][0]
+    forward = [first["id"]]
+    params = {"limit": 5, "cursor": encode_cursor(first)}
+    while True:
+        body = (await client.get(url, params=params, headers=auth)).json()
+        forward += [message["id"] for message in body["data"]["messages"]]
+        if body["next_cursor"] is None:
+            break
+        params = {"limit": 5, "cursor": body["next_cursor"]}
+    assert forward == backward
+
+
+async def test_cursor_and_before_together(client, auth):
+    conv_id = await _conversation_with_messages(client, auth, 1)
+    response = await client.get(
+        f"/conversations/{conv_id}", params={"cursor": "x", "before": "y"}, headers=auth,
+    )
+    assert response.status_code == 400
+
+
+async def test_conversation_of_another_user(client, auth):
+    conv_id = await _conversation_with_messages(client, auth, 1)
+    response = await client.get(f"/conversations/{conv_id}", headers=await login(client))
+    assert response.status_code == 404
@@ -0,0 +1,138 @@
+"""The SQLite and PostgreSQL backends, side by side.
+
+The PostgreSQL runs need TEST_DATABASE_URL to point at a scratch
+PostgreSQL database and are skipped otherwise.
+"""
+import asyncio
+import os
+import uuid
+
+import pytest
+
+from app import migrations, payments
+from app.db import create_database
+from app.db_postgres import translate
+
+pytestmark = pytest.mark.anyio
+
+POSTGRES_URL = os.environ.get("TEST_DATABASE_URL", "")
+
+
+def test_translate():
+    assert translate("SELECT * FROM t WHERE a = ? AND b IN (?, ?)") == "SELECT * FROM t WHERE a = $1 AND b IN ($2, $3)"
+    # Placeholders in quoted text are left alone, including escaped quotes
+    assert translate("SELECT 'a?b', 'it''s ?', \"odd?name\" FROM t WHERE c = ?") == (
+        "SELECT 'a?b', 'it''s ?', \"odd?name\" FROM t WHERE c = $1"
+    )
+    # The same value bound twice is two placeholders
+    assert translate("SELECT ts_rank(terms, ?::tsquery) WHERE terms @@ ?::tsquery") == (
+        "SELECT ts_rank(terms, $1::tsquery) WHERE terms @@ $2::tsquery"
+    )
+    assert translate("SELECT '$1', ?, $$ ? $$, $fn$ it's ? $fn$, ?") == "SELECT '$1', $1, $$ ? $$, $fn$ it's ? $fn$, $2"
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+async def database(request, tmp_path):
+    if request.param == "sqlite":
+        database = create_database(str(tmp_path / "backend.db"))
+    else:
+        if not POSTGRES_URL.startswith(("postgres://", "postgresql://")):
+            pytest.skip("TEST_DATABASE_URL is not a PostgreSQL database")
+        pytest.importorskip("asyncpg")
+        database = create_database(POSTGRES_URL)
+        try:
+            await database.fetch_val("SELECT 1")
+        except Exception as e:
+            await database.close()
+            pytest.skip(f"PostgreSQL is not available: {e}")
+    await migrations.migrate_database(database)
+    yield database
+    await database.close()
+
+
+async def _user(database) -> str:
+    user_id = str(uuid.uuid4())
+    await database.execute(
+        "INSERT INTO users (id, phone, name) VALUES (?, ?, ?)", (user_id, uuid.uuid4().hex[:11], "测试")
+    )
+    return user_id
+
+
+async def _order(database, user_id: str, amount: float = 9.9, key=None) -> int:
+    return await database.execute(
+        "INSERT INTO orders (id, user_id, product_type, amount, status, idempotency_key) "
+        "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(user_id, idempotency_key) DO NOTHING",
+        (str(uuid.uuid4()), user_id, "document", amount, "pending", key),
+    )
+
+
+async def test_migrated_to_latest(database):
+    assert await migrations.schema_version(database) == migrations.LATEST_VERSION
+
+
+async def test_on_conflict_do_nothing_rowcount(database):
+    user_id = await _user(database)
+    phone = await database.fetch_val("SELECT phone FROM users WHERE id = ?", (user_id,))
+    assert await database.execute(
+        "INSERT INTO users (id, phone, name) VALUES (?, ?, ?) ON CONFLICT(phone) DO NOTHING",
+        (str(uuid.uuid4()), phone, "重复"),
+    ) == 0
+
+    assert await _order(database, user_id, key="key-1") == 1
+    assert await _order(database, user_id, key="key-1") == 0
+    # NULL keys never conflict
+    assert await _order(database, user_id) == await _order(database, user_id) == 1
+
+
+def _notification(transaction_id: str, order_id: str, amount: float = 9.9):
+    return payments.Notification("wechat", transaction_id, order_id, amount, True, "2026-01-01 00:00:00")
+
+
+async def test_notifications_claimed_once(database):
+    user_id = await _user(database)
+    await _order(database, user_id)
+    await _order(database, user_id)
+    first, second = [row["id"] for row in await database.fetch_all(
+        "SELECT id FROM orders WHERE user_id = ? ORDER BY id", (user_id,)
+    )]
+    txn = uuid.uuid4().hex
+
+    async with database.transaction(immediate=True) as tx:
+        await payments.apply_notifications(tx, [
+            _notification(f"{txn}-1", first), _notification(f"{txn}-2", second, amount=1.0),
+        ])
+    # A retry is not returned by ON CONFLICT ... RETURNING, so only the new one is applied
+    async with database.transaction(immediate=True) as tx:
+        await payments.apply_notifications(tx, [_notification(f"{txn}-1", first), _notification(f"{txn}-3", first)])
+
+    rows = await database.fetch_all(
+        "SELECT provider_transaction_id, outcome FROM payment_notifications "
+        "WHERE provider_transaction_id LIKE ? ORDER BY provider_transaction_id",
+        (f"{txn}-%",),
+    )
+    assert [row["outcome"] for row in rows] == [payments.PAID, payments.AMOUNT_MISMATCH, payments.ALREADY_PAID]
+    order = await database.fetch_one("SELECT status, transaction_id FROM orders WHERE id = ?", (first,))
+    assert (order["status"], order["transaction_id"]) == ("paid", f"{txn}-1")
+
+
+async def test_for_update_serializes_read_then_write(database):
+    user_id = await _user(database)
+    await _order(database, user_id)
+    order_id = await database.fetch_val("SELECT id FROM orders WHERE user_id = ?", (user_id,))
+
+    async def pay(transaction_id: str) -> bool:
+        async with database.transaction(immediate=True) as tx:
+            order = await tx.fetch_one("SELECT status FROM orders WHERE id = ?" + database.for_update, (order_id,))
+            # Give the other transaction every chance to read the same status
+            await asyncio.sleep(0.05)
+            if order["status"] != "pending":
+                return False
+            await tx.execute(
+                "UPDATE orders SET status = 'paid', transaction_id = ? WHERE id = ?", (transaction_id, order_id)
+            )
+            return True
+
+    results = await asyncio.gather(pay("first"), pay("second"))
+    assert sorted(results) == [False, True]
+    winner = "first" if results[0] else "second"
+    assert await database.fetch_val("SELECT transaction_id FROM orders WHERE id = ?", (order_id,)) == winner
@@ -0,0 +1,53 @@
+import csv
+import io
+import json
+
+import pytest
+
+from app import export
+
+pytestmark = pytest.mark.anyio
+
+
+def _csv_rows(body: bytes):
+    return list(csv.reader(io.StringIO(body.decode("utf-8-sig"))))
+
+
+async def test_empty_csv_export_has_header(client, auth):
+    response = await client.get(
+        "/admin/export/orders", params={"format": "csv", "start": "2000-01-01", "end": "2000-01-02"}, headers=auth,
+    )
+    assert response.status_code == 200
+    assert response.content.startswith("﻿".encode("utf-8"))
+    assert _csv_rows(response.content) == [export.columns("orders")]
+    assert response.content.endswith(b"closed_at,phone,user_name\r\n")
+
+
+async def test_csv_export(client, auth):
+    created = [
+        (await client.post("/orders/create", json={"product_type": "document", "amount": 1.5}, headers=auth))
+        .json()["data"]["order_id"]
+        for _ in range(3)
+    ]
+    response = await client.get("/admin/export/orders", params={"format": "csv"}, headers=auth)
+    header, *rows = _csv_rows(response.content)
+    assert header == export.columns("orders")
+    assert all(len(row) == len(header) for row in rows)
+    exported = {row[0]: dict(zip(header, row)) for row in rows}
+    for order_id in created:
+        assert exported[order_id]["status"] == "pending"
+        assert exported[order_id]["amount"] == "1.5"
+        assert exported[order_id]["phone"].startswith("137")
+
+
+async def test_ndjson_export(client, auth):
+    response = await client.get("/admin/export/users", headers=auth)
+    users = [json.loads(line) for line in response.text.splitlines()]
+    assert users and all(list(user) == export.columns("users") for user in users)
+
+
+async def test_status_filter(client, auth):
+    response = await client.get("/admin/export/users", params={"status": "paid"}, headers=auth)
+    assert response.status_code == 400
+    response = await client.get("/admin/export/orders", params={"status": "paid", "format": "csv"}, headers=auth)
+    assert all(row[export.columns("orders").index("status")] == "paid" for row in _csv_rows(response.content)[1:])
@@ -0,0 +1,107 @@
+import hashlib
+import os
+
+import pytest
+from starlette.requests import Request
+
+from app.http_cache import etag_matches, http_date, is_not_modified, quote_etag
+from conftest import login
+
+pytestmark = pytest.mark.anyio
+
+
+def _request(**headers):
+    return Request({"type": "http", "headers": [(k.replace("_", "-").encode(), v.encode()) for k, v in headers.items()]})
+
+
+def test_etag_matches_weakly():
+    etag = quote_etag("templates-3")
+    assert etag == '"templates-3"'
+    assert etag_matches('"templates-3"', etag)
+    assert etag_matches('W/"templates-3"', etag)
+    assert etag_matches('"other", W/"templates-3"', etag)
+    assert etag_matches('"templates-3"', 'W/"templates-3"')
+    assert etag_matches("*", etag)
+    assert not etag_matches('"templates-4"', etag)
+    assert not etag_matches("templates-3", etag)
+
+
+def test_if_none_match_takes_precedence():
+    modified = 1_700_000_000.5
+    assert is_not_modified(_request(if_modified_since=http_date(modified)), '"a"', modified)
+    assert not is_not_modified(_request(if_modified_since=http_date(modified - 1)), '"a"', modified)
+    assert not is_not_modified(_request(if_modified_since="not a date"), '"a"', modified)
+    # A mismatching If-None-Match wins over a matching If-Modified-Since
+    assert not is_not_modified(_request(if_none_match='"b"', if_modified_since=http_date(modified)), '"a"', modified)
+    assert not is_not_modified(_request(), '"a"', modified)
+
+
+async def _get(client, auth, url, etag=None):
+    headers = dict(auth, **({"If-None-Match": etag} if etag else {}))
+    return await client.get(url, headers=headers)
+
+
+async def test_template_etags(client, auth):
+    template = {"name": "ETag 模板", "content": "{name}"}
+    template_id = (await client.post("/templates", json=template, headers=auth)).json()["data"]["id"]
+
+    for url in ("/templates", f"/templates/{template_id}"):
+        response = await _get(client, auth, url)
+        etag = response.headers["ETag"]
+        assert response.status_code == 200
+        assert response.headers["Cache-Control"] == "private, no-cache"
+        for validator in (etag, f"W/{etag}", f'"stale", {etag}'):
+            not_modified = await _get(client, auth, url, validator)
+            assert not_modified.status_code == 304
+            assert not_modified.headers["ETag"] == etag
+            assert not_modified.content == b""
+        # Any user gets the same answer for shared templates
+        assert (await _get(client, await login(client), url, etag)).status_code == 304
+
+
+async def test_template_etag_changes_on_update(client, auth):
+    template = {"name": "更新前", "content": "{name}"}
+    template_id = (await client.post("/templates", json=template, headers=auth)).json()["data"]["id"]
+    url = f"/templates/{template_id}"
+    list_etag = (await _get(client, auth, "/templates")).headers["ETag"]
+    etag = (await _get(client, auth, url)).headers["ETag"]
+
+    await client.put(url, json=dict(template, name="更新后"), headers=auth)
+    response = await _get(client, auth, url, etag)
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()["data"]["name"] == "更新后"
+    assert (await _get(client, auth, "/templates", list_etag)).status_code == 200
+    assert (await _get(client, auth, url, response.headers["ETag"])).status_code == 304
+
+    # A failed update of a missing template changes nothing
+    etag = response.headers["ETag"]
+    assert (await client.put("/templates/missing", json=template, headers=auth)).status_code == 404
+    assert (await _get(client, auth, url, etag)).status_code == 304
+
+
+async def test_document_etag_is_per_user(client, auth):
+    template_id = (await client.get("/templates", headers=auth)).json()["data"][0]["id"]
+    fields = (await client.get(f"/templates/{template_id}", headers=auth)).json()["data"]["fields"]
+    response = await client.post(
+        "/documents", json={"template_id": template_id, "data": {field: "x" for field in fields}}, headers=auth,
+    )
+    url = f"/documents/{response.json()['data']['id']}"
+
+    etag = (await _get(client, auth, url)).headers["ETag"]
+    assert (await _get(client, auth, url, etag)).status_code == 304
+    # Another user's matching validator does not reveal that the document exists
+    assert (await _get(client, await login(client), url, etag)).status_code == 404
+
+
+async def test_attachment_etag_is_its_content_hash(client, auth):
+    content = os.urandom(128)
+    response = await client.post("/upload", files={"file": ("etag.bin", content)}, headers=auth)
+    url = f"/attachments/{response.json()['data']['file_id']}/content"
+
+    response = await _get(client, auth, url)
+    assert response.headers["ETag"] == quote_etag(hashlib.sha256(content).hexdigest())
+    not_modified = await _get(client, auth, url, response.headers["ETag"])
+    assert not_modified.status_code == 304
+    assert not_modified.headers["Last-Modified"] == response.headers["Last-Modified"]
+    assert (await _get(client, auth, url, '"other"')).content == content
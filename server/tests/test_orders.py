@@ -0,0 +1,63 @@
+import pytest
+
+from app import orders
+from app.main import db
+
+pytestmark = pytest.mark.anyio
+
+ORDER = {"product_type": "document", "product_id": "tpl-1", "amount": 9.9}
+
+
+async def _order(client, auth) -> str:
+    return (await client.post("/orders/create", json=ORDER, headers=auth)).json()["data"]["order_id"]
+
+
+async def _status(client, auth, order_id: str) -> str:
+    return (await client.get(f"/orders/{order_id}", headers=auth)).json()["data"]["status"]
+
+
+def test_final_states():
+    assert orders.sources(orders.PAID) == (orders.PENDING,)
+    assert orders.sources(orders.REFUNDED) == (orders.PAID,)
+    assert orders.sources(orders.PENDING) == ()
+
+
+async def test_refund_of_pending_order(client, auth):
+    order_id = await _order(client, auth)
+    response = await client.post(f"/orders/{order_id}/refund", headers=auth)
+    assert response.status_code == 409
+    assert await _status(client, auth, order_id) == orders.PENDING
+
+
+async def test_pay_refund_and_repeat(client, auth):
+    order_id = await _order(client, auth)
+    paid = await client.post(f"/orders/{order_id}/pay", headers=auth)
+    assert (await client.post(f"/orders/{order_id}/pay", headers=auth)).json() == paid.json()
+
+    refunded = await client.post(f"/orders/{order_id}/refund", headers=auth)
+    assert refunded.status_code == 200
+    assert (await client.post(f"/orders/{order_id}/refund", headers=auth)).json() == refunded.json()
+
+    # Refunded is final
+    response = await client.post(f"/orders/{order_id}/pay", headers=auth)
+    assert response.status_code == 409
+    assert await _status(client, auth, order_id) == orders.REFUNDED
+
+
+async def test_expired_order_cannot_be_paid(client, auth):
+    order_id = await _order(client, auth)
+    await db.execute("UPDATE orders SET created_at = '2000-01-01 00:00:00' WHERE id = ?", (order_id,))
+    assert await orders.ExpirySweeper(db, ttl=60).sweep() >= 1
+    assert await _status(client, auth, order_id) == orders.EXPIRED
+
+    assert (await client.post(f"/orders/{order_id}/pay", headers=auth)).status_code == 409
+    assert (await client.post(f"/orders/{order_id}/refund", headers=auth)).status_code == 409
+    assert await _status(client, auth, order_id) == orders.EXPIRED
+
+
+async def test_transition_from_wrong_state(client, auth):
+    order_id = await _order(client, auth)
+    async with db.transaction(immediate=True) as tx:
+        assert not await orders.transition(tx, order_id, orders.REFUNDED)
+        assert await orders.transition(tx, order_id, orders.EXPIRED)
+        assert not await orders.transition(tx, order_id, orders.PAID)
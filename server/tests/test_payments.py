@@ -0,0 +1,90 @@
+import json
+from datetime import datetime
+
+import pytest
+
+from app import payments
+from app.main import PAYMENT_NOTIFY_SECRET, db
+
+pytestmark = pytest.mark.anyio
+
+ORDER = {"product_type": "document", "product_id": "tpl-1", "amount": 9.9, "payment_method": "wechat"}
+
+
+async def _create_order(client, auth, key=None, **fields):
+    headers = dict(auth, **({"Idempotency-Key": key} if key else {}))
+    return await client.post("/orders/create", json=dict(ORDER, **fields), headers=headers)
+
+
+async def _notify(client, order_id: str, transaction_id: str, cents: int = 990):
+    body = json.dumps({
+        "transaction_id": transaction_id, "out_trade_no": order_id,
+        "amount": {"total": cents}, "trade_state": "SUCCESS",
+    }).encode("utf-8")
+    headers = {payments.SIGNATURE_HEADER: payments.sign(PAYMENT_NOTIFY_SECRET, body)}
+    return await client.post("/payments/notify/wechat", content=body, headers=headers)
+
+
+async def test_order_creation_replay(client, auth):
+    first = await _create_order(client, auth, key="order-key-1")
+    replay = await _create_order(client, auth, key="order-key-1")
+    assert replay.status_code == 200
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert replay.json()["data"]["order_id"] == first.json()["data"]["order_id"]
+
+    response = await client.get("/orders", headers=auth)
+    assert len(response.json()["data"]) == 1
+
+
+async def test_idempotency_key_reused_for_another_order(client, auth):
+    await _create_order(client, auth, key="order-key-2")
+    response = await _create_order(client, auth, key="order-key-2", amount=19.9)
+    assert response.status_code == 409
+
+
+async def test_orders_without_key_are_not_deduplicated(client, auth):
+    first = await _create_order(client, auth)
+    second = await _create_order(client, auth)
+    assert first.json()["data"]["order_id"] != second.json()["data"]["order_id"]
+
+
+async def test_notification_replay_applies_once(client, auth):
+    order_id = (await _create_order(client, auth)).json()["data"]["order_id"]
+    for _ in range(3):
+        response = await _notify(client, order_id, "wx-txn-replay")
+        assert response.status_code == 200
+
+    order = (await client.get(f"/orders/{order_id}", headers=auth)).json()["data"]
+    assert order["status"] == "paid"
+    assert order["transaction_id"] == "wx-txn-replay"
+    # Stored in UTC, like every other timestamp
+    assert abs((datetime.utcnow() - datetime.fromisoformat(order["paid_at"])).total_seconds()) < 60
+    rows = await db.fetch_all(
+        "SELECT outcome FROM payment_notifications WHERE provider_transaction_id = ?", ("wx-txn-replay",)
+    )
+    assert [row["outcome"] for row in rows] == [payments.PAID]
+
+
+async def test_second_transaction_for_a_paid_order(client, auth):
+    order_id = (await _create_order(client, auth)).json()["data"]["order_id"]
+    await _notify(client, order_id, "wx-txn-first")
+    await _notify(client, order_id, "wx-txn-second")
+
+    order = (await client.get(f"/orders/{order_id}", headers=auth)).json()["data"]
+    assert order["transaction_id"] == "wx-txn-first"
+    outcome = await db.fetch_val(
+        "SELECT outcome FROM payment_notifications WHERE provider_transaction_id = ?", ("wx-txn-second",)
+    )
+    assert outcome == payments.ALREADY_PAID
+
+
+async def test_notification_signature_and_amount(client, auth):
+    order_id = (await _create_order(client, auth)).json()["data"]["order_id"]
+    response = await client.post(
+        "/payments/notify/wechat", content=b"{}", headers={payments.SIGNATURE_HEADER: "forged"},
+    )
+    assert response.status_code == 401
+
+    await _notify(client, order_id, "wx-txn-short", cents=1)
+    order = (await client.get(f"/orders/{order_id}", headers=auth)).json()["data"]
+    assert order["status"] == "pending"
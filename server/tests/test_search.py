@@ -0,0 +1,108 @@
+import sqlite3
+
+import pytest
+
+from app import search
+from conftest import login
+
+pytestmark = pytest.mark.anyio
+
+
+def test_tokenize():
+    assert search.tokenize("工资证明 Salary-2024 年") == ["工资", "资证", "证明", "明", "salary", "2024", "年"]
+    assert search.tokenize("“ ” * -") == []
+
+
+def test_match_expression_quotes_every_term():
+    expression = search.match_expression('a"b NEAR * OR(工资', "user", ["message"])
+    prefix = search.partition("message", "user")
+    assert expression == f'("{prefix}a"* AND "{prefix}b"* AND "{prefix}near"* AND "{prefix}or"* AND "{prefix}工资")'
+    assert search.match_expression('"*"', "user", ["message"]) is None
+
+
+async def _say(client, auth, *texts):
+    """Posts ``texts`` to a new conversation; returns the ids of the user's messages."""
+    conv_id = (await client.post("/conversations", json={"title": "搜索"}, headers=auth)).json()["data"]["id"]
+    said = []
+    for text in texts:
+        response = await client.post(f"/conversations/{conv_id}/messages", json={"text": text}, headers=auth)
+        said.append(response.json()["data"]["message_id"])
+    return said
+
+
+async def _search(client, auth, q, types="message"):
+    response = await client.get("/search", params={"q": q, "types": types}, headers=auth)
+    assert response.status_code == 200, response.text
+    return response.json()["data"]
+
+
+async def _found(client, auth, q, said):
+    # Every message gets an AI reply echoing it; count the user's own
+    return sorted(result["id"] for result in await _search(client, auth, q) if result["id"] in said)
+
+
+async def test_chinese_phrase(client, auth):
+    said = await _say(client, auth, "请帮我开具工资证明", "证明材料已提交")
+    results = await _search(client, auth, "工资证明")
+    assert [r["snippet"] for r in results if r["id"] == said[0]] == ["请帮我开具<mark>工资证明</mark>"]
+    assert await _found(client, auth, "工资证明", said) == [said[0]]
+    # Both characters must be adjacent and in order
+    assert await _found(client, auth, "证明工资", said) == []
+    assert await _found(client, auth, "证明", said) == sorted(said)
+
+
+async def test_prefix(client, auth):
+    said = await _say(client, auth, "Monthly salaryslip uploaded", "社保")
+    assert await _found(client, auth, "salary", said) == [said[0]]
+    assert await _found(client, auth, "SAL", said) == [said[0]]
+    assert await _found(client, auth, "slip", said) == []
+    # A lone character matches wherever it starts a token
+    assert await _found(client, auth, "保", said) == [said[1]]
+
+
+async def test_query_syntax_is_literal(client, auth):
+    said = await _say(client, auth, "meet NEAR the office, bring *all* papers")
+    for q in ('"NEAR"', "near*", "NEAR(office", 'office" *', "papers*all", "-office", "{bring}"):
+        assert await _found(client, auth, q, said) == said, q
+    assert await _search(client, auth, '"*" ()') == []
+    # Operators are plain words: every one of them must occur
+    assert await _found(client, auth, "office OR desk", said) == []
+
+
+async def test_results_are_per_user(client, auth):
+    other = await login(client)
+    said = await _say(client, auth, "独有关键词甲乙")
+    assert await _found(client, auth, "关键词甲乙", said) == said
+    assert await _search(client, other, "关键词甲乙") == []
+
+    # Templates are shared
+    template = {"name": "共享模板丙丁", "content": "{name}"}
+    await client.post("/templates", json=template, headers=auth)
+    for headers in (auth, other):
+        assert [r["title"] for r in await _search(client, headers, "模板丙丁", "template")] == ["共享模板丙丁"]
+
+
+def test_backfill_indexes_existing_rows():
+    conn = sqlite3.connect(":memory:")
+    conn.executescript("""
+        CREATE TABLE conversations (id TEXT, user_id TEXT);
+        CREATE TABLE messages (id TEXT, conversation_id TEXT, content TEXT);
+        CREATE TABLE documents (id TEXT, user_id TEXT, title TEXT, content TEXT);
+        CREATE TABLE templates (id TEXT, name TEXT, description TEXT, content TEXT);
+        INSERT INTO conversations VALUES ('c1', 'u1');
+        INSERT INTO messages VALUES ('m1', 'c1', '年终奖发放');
+        INSERT INTO documents VALUES ('d1', 'u2', '年终奖', '证明');
+        INSERT INTO templates VALUES ('t1', '年终奖模板', NULL, '{name}');
+    """)
+    search.backfill(conn)
+
+    def found(user_id):
+        expression = search.match_expression("年终奖", user_id, search.KINDS)
+        rows = conn.execute(
+            "SELECT d.source_id FROM search_index JOIN search_docs d ON d.rowid = search_index.rowid "
+            "WHERE search_index MATCH ?", (expression,)
+        )
+        return sorted(row[0] for row in rows)
+
+    assert found("u1") == ["m1", "t1"]
+    assert found("u2") == ["d1", "t1"]
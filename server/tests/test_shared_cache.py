@@ -0,0 +1,153 @@
+import asyncio
+import logging
+
+import pytest
+
+from app import shared_cache, versions
+from app.cache import TTLCache
+from app.db import create_database
+from app.shared_cache import CHANNEL, CacheBus, TwoTierCache
+
+fakeredis = pytest.importorskip("fakeredis")
+redis = pytest.importorskip("redis")
+
+pytestmark = pytest.mark.anyio
+
+
+async def _eventually(predicate, timeout: float = 2.0):
+    # Invalidations are delivered asynchronously
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not await predicate():
+        assert loop.time() < deadline, "condition not reached"
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+async def buses(server):
+    """Two replicas' buses on one Redis server, both subscribed."""
+    buses = [CacheBus(fakeredis.FakeAsyncRedis(server=server)) for _ in range(2)]
+    for bus in buses:
+        await bus.start()
+
+    async def subscribed():
+        return (await buses[0].client.pubsub_numsub(CHANNEL))[0][1] == 2
+
+    await _eventually(subscribed)
+    yield buses
+    for bus in buses:
+        await bus.stop()
+
+
+def _users(bus):
+    return TwoTierCache("users", bus, TTLCache(maxsize=10, ttl=60))
+
+
+async def test_value_shared_and_invalidated_across_replicas(buses):
+    first, second = _users(buses[0]), _users(buses[1])
+    await first.set("u1", {"name": "张三"})
+    assert await second.get("u1") == {"name": "张三"}
+    assert second.remote_hits == 1
+    assert second.local.get("u1") == {"name": "张三"}
+
+    await first.invalidate("u1")
+
+    async def dropped():
+        return second.local.get("u1") is None
+
+    await _eventually(dropped)
+    assert await second.get("u1") is None
+    assert await buses[0].client.get(first._key("u1")) is None
+    # A replica ignores its own invalidations
+    assert (buses[0].received, buses[1].received) == (0, 1)
+
+
+async def test_version_bump_reaches_other_replicas(buses, tmp_path):
+    db = create_database(str(tmp_path / "versions.db"))
+    for statement in versions.SCHEMA:
+        await db.execute(statement)
+    caches = [versions.VersionCache(ttl=60) for _ in buses]
+    for bus, cache in zip(buses, caches):
+        bus.register("versions", cache)
+    assert [await cache.get(db, "templates") for cache in caches] == [0, 0]
+
+    async with db.transaction(immediate=True) as tx:
+        await versions.bump(tx, "templates")
+    # What table_changed does once the bump has committed
+    caches[0].invalidate("templates")
+    await buses[0].publish("versions", "templates")
+
+    async def bumped():
+        return await caches[1].get(db, "templates") == 1
+
+    await _eventually(bumped)
+    assert await caches[0].get(db, "templates") == 1
+    await db.close()
+
+
+async def test_outage_falls_back_and_recovers(buses, server, caplog):
+    caplog.set_level(logging.INFO, logger=shared_cache.__name__)
+    users = _users(buses[0])
+    server.connected = False
+
+    await users.set("u1", {"name": "李四"})
+    assert await users.get("u1") == {"name": "李四"}
+    assert await users.get("u2") is None
+    await users.invalidate("u1")
+    # set, the remote get of u2, and invalidate's delete and publish
+    assert buses[0].errors == 4
+    # One warning for the whole outage
+    assert [r.getMessage() for r in caplog.records].count(
+        "redis unavailable, using local caches only: FakeRedis is emulating a connection error."
+    ) == 1
+
+    server.connected = True
+    await users.set("u1", {"name": "李四"})
+    assert caplog.records[-1].getMessage() == "redis available again"
+    assert await buses[0].client.get(users._key("u1")) is not None
+
+
+class _DroppedSubscription:
+    """A pubsub whose connection is lost on its first read."""
+
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    def __getattr__(self, name):
+        return getattr(self.pubsub, name)
+
+    async def get_message(self, **kwargs):
+        raise redis.ConnectionError("connection lost")
+
+
+async def test_lost_subscription_reconnects_and_clears(server, caplog, monkeypatch):
+    monkeypatch.setattr(shared_cache, "RECONNECT_DELAY_MIN", 0.01)
+    client = fakeredis.FakeAsyncRedis(server=server)
+    pubsub, dropped = client.pubsub, []
+
+    def once_dropped(**kwargs):
+        if dropped:
+            return pubsub(**kwargs)
+        dropped.append(True)
+        return _DroppedSubscription(pubsub(**kwargs))
+
+    monkeypatch.setattr(client, "pubsub", once_dropped)
+    bus = CacheBus(client)
+    users = _users(bus)
+    users.local.set("u1", {"name": "stale"})
+    await bus.start()
+
+    async def resubscribed():
+        return bus.reconnects == 1 and (await client.pubsub_numsub(CHANNEL))[0][1] == 1
+
+    await _eventually(resubscribed)
+    assert "cache invalidation subscription lost" in caplog.text
+    # Invalidations may have been missed meanwhile
+    assert users.local.get("u1") is None
+    assert bus.stats()["subscribed"]
+    await bus.stop()
@@ -0,0 +1,96 @@
+from contextlib import asynccontextmanager
+
+import pytest
+
+from app import stats
+from app.main import db
+
+pytestmark = pytest.mark.anyio
+
+
+async def _recount():
+    return {metric: await db.fetch_val(stats.total_query(metric)) or 0 for metric in stats.METRICS}
+
+
+async def _recount_buckets(granularity: str):
+    buckets = {}
+    for metric in stats.METRICS:
+        for row in await db.fetch_all(stats.rollup_query(metric, granularity), ("",)):
+            buckets[(row["bucket"], metric)] = row["value"]
+    return buckets
+
+
+async def _stored_buckets(granularity: str):
+    return {
+        (bucket["bucket"], metric): value
+        for bucket in await stats.rollups(db, granularity, None, None)
+        for metric, value in bucket.items() if metric != "bucket" and value
+    }
+
+
+async def _write_some(client, auth):
+    conv_id = (await client.post("/conversations", json={"title": "统计"}, headers=auth)).json()["data"]["id"]
+    for i in range(3):
+        await client.post(f"/conversations/{conv_id}/messages", json={"text": f"统计 {i}"}, headers=auth)
+    for amount in (3.3, 6.6):
+        order_id = (await client.post("/orders/create", json={"product_type": "document", "amount": amount},
+                                      headers=auth)).json()["data"]["order_id"]
+        await client.post(f"/orders/{order_id}/pay", headers=auth)
+    await client.post(f"/orders/{order_id}/refund", headers=auth)
+
+
+async def test_counters_follow_writes(client, auth):
+    await stats.reconcile(db)
+    before = await stats.totals(db)
+
+    await _write_some(client, auth)
+    after = await stats.totals(db)
+    assert after["conversations"] - before["conversations"] == 1
+    assert after["messages"] - before["messages"] == 6
+    assert after["paid_orders"] - before["paid_orders"] == 1
+    assert after["revenue"] - before["revenue"] == pytest.approx(3.3)
+
+    assert after == pytest.approx(await _recount())
+    for granularity in stats.GRANULARITIES:
+        assert await _stored_buckets(granularity) == pytest.approx(await _recount_buckets(granularity))
+    # Consistent counters need no corrections
+    assert await stats.reconcile(db) == 0
+
+
+async def test_reconcile_corrects_skew(client, auth):
+    await _write_some(client, auth)
+    await db.execute("UPDATE stats_counters SET value = value + 5 WHERE name = 'messages'")
+    await db.execute("UPDATE stats_rollups SET value = value - 1 WHERE granularity = 'day' AND metric = 'users'")
+
+    assert await stats.reconcile(db, days=36500) >= 2
+    assert await stats.totals(db) == pytest.approx(await _recount())
+    assert await _stored_buckets("day") == pytest.approx(await _recount_buckets("day"))
+    assert await stats.reconcile(db, days=36500) == 0
+
+
+class _Overtaken:
+    """The database, with another reconciler finishing between snapshot and write."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def snapshot(self):
+        return self.db.snapshot()
+
+    @asynccontextmanager
+    async def transaction(self, immediate=False):
+        assert await stats.reconcile(self.db) > 0
+        async with self.db.transaction(immediate=immediate) as tx:
+            yield tx
+
+
+async def test_stale_generation_does_not_overwrite(client, auth):
+    await db.execute("UPDATE stats_counters SET value = value + 7 WHERE name = 'conversations'")
+    generation = await db.fetch_val("SELECT value FROM stats_counters WHERE name = ?", (stats.GENERATION,))
+
+    # Its differences were computed before the other run corrected them; applying them would undercount
+    assert await stats.reconcile(_Overtaken(db)) == 0
+    assert await stats.totals(db) == pytest.approx(await _recount())
+    assert await db.fetch_val(
+        "SELECT value FROM stats_counters WHERE name = ?", (stats.GENERATION,)
+    ) == (generation or 0) + 1
@@ -0,0 +1,145 @@
+import asyncio
+import json
+
+import pytest
+
+from app import main
+from app.ai import AIBackend, StubBackend
+from app.main import app, db
+
+pytestmark = pytest.mark.anyio
+
+
+def _events(body: str):
+    """(event, data) pairs of a text/event-stream body."""
+    events = []
+    for frame in body.split("\n\n"):
+        if frame:
+            event, data = frame.split("\n")
+            assert event.startswith("event: ") and data.startswith("data: ")
+            events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+async def _conversation(client, auth) -> str:
+    return (await client.post("/conversations", json={"title": "流式"}, headers=auth)).json()["data"]["id"]
+
+
+async def _stored(conv_id: str):
+    return await db.fetch_all(
+        "SELECT id, sender, content FROM messages WHERE conversation_id = ? ORDER BY created_at, id", (conv_id,)
+    )
+
+
+async def _settled():
+    # The reply is stored by a task of its own once the stream has been generated
+    while main.background_tasks:
+        await asyncio.gather(*main.background_tasks, return_exceptions=True)
+
+
+class GatedBackend(AIBackend):
+    """Yields the first chunk, then the rest once ``release`` is set."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.release = asyncio.Event()
+
+    async def stream_reply(self, prompt, history):
+        yield self.chunks[0]
+        await self.release.wait()
+        for chunk in self.chunks[1:]:
+            yield chunk
+
+
+class FailingBackend(AIBackend):
+    async def stream_reply(self, prompt, history):
+        yield "半句"
+        raise RuntimeError("backend down")
+
+
+async def test_stream_frames_and_storage(client, auth):
+    conv_id = await _conversation(client, auth)
+    response = await client.post(f"/conversations/{conv_id}/messages/stream", json={"text": "你好"}, headers=auth)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+
+    events = _events(response.text)
+    names = [name for name, _ in events]
+    assert names[0] == "start" and names[-1] == "done"
+    assert set(names[1:-1]) == {"delta"}
+
+    start, done = events[0][1], events[-1][1]
+    reply = "".join(data["content"] for name, data in events if name == "delta")
+    assert reply == done["content"]
+    assert reply == await StubBackend().reply("你好", [])
+    assert done["message_id"] == start["ai_message_id"]
+
+    await _settled()
+    stored = await _stored(conv_id)
+    # The user's message is stored ahead of the reply
+    assert [(row["id"], row["sender"], row["content"]) for row in stored] == [
+        (start["message_id"], "user", "你好"), (start["ai_message_id"], "ai", reply),
+    ]
+    conversation = (await client.get(f"/conversations/{conv_id}", headers=auth)).json()["data"]
+    assert [m["id"] for m in conversation["messages"]] == [row["id"] for row in stored]
+
+
+async def test_failed_reply_keeps_the_users_message(client, auth, monkeypatch):
+    monkeypatch.setattr(main, "ai_backend", FailingBackend())
+    conv_id = await _conversation(client, auth)
+
+    response = await client.post(f"/conversations/{conv_id}/messages/stream", json={"text": "在吗"}, headers=auth)
+    events = _events(response.text)
+    assert [name for name, _ in events] == ["start", "delta", "error"]
+    await _settled()
+    assert [(row["sender"], row["content"]) for row in await _stored(conv_id)] == [("user", "在吗")]
+
+    # Likewise without streaming
+    with pytest.raises(RuntimeError):
+        await client.post(f"/conversations/{conv_id}/messages", json={"text": "还在吗"}, headers=auth)
+    await _settled()
+    assert [row["content"] for row in await _stored(conv_id)] == ["在吗", "还在吗"]
+
+
+async def test_reply_stored_after_client_disconnects(client, auth, monkeypatch):
+    backend = GatedBackend(["第一段", "第二段", "第三段"])
+    monkeypatch.setattr(main, "ai_backend", backend)
+    conv_id = await _conversation(client, auth)
+
+    # Driven over raw ASGI: the client goes away after the first delta
+    body = json.dumps({"text": "断开"}).encode("utf-8")
+    requested = False
+    disconnected = asyncio.Event()
+    sent = []
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+        if b"event: delta" in message.get("body", b""):
+            disconnected.set()
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+        "path": f"/api/v1/conversations/{conv_id}/messages/stream", "raw_path": b"", "query_string": b"",
+        "root_path": "", "client": ("127.0.0.1", 50000), "server": ("test", 80),
+        "headers": [
+            (b"host", b"test"), (b"content-type", b"application/json"),
+            (b"authorization", auth["Authorization"].encode("ascii")),
+        ],
+    }
+    await asyncio.wait_for(app(scope, receive, send), 5)
+    streamed = b"".join(message.get("body", b"") for message in sent).decode("utf-8")
+    assert "event: done" not in streamed
+
+    backend.release.set()
+    await asyncio.wait_for(_settled(), 5)
+    assert [(row["sender"], row["content"]) for row in await _stored(conv_id)] == [
+        ("user", "断开"), ("ai", "第一段第二段第三段"),
+    ]
@@ -0,0 +1,71 @@
+import pytest
+
+from app.main import template_cache
+from app.template_engine import MissingFieldsError, TemplateError, compile_template
+
+pytestmark = pytest.mark.anyio
+
+
+def test_render():
+    compiled = compile_template("{{证明}} {name} 于 {date} 入职，{name} 月薪 {salary} 元")
+    assert compiled.fields == ["name", "date", "salary"]
+    assert compiled.render({"name": "张三", "date": "2024-01-01", "salary": 8000, "extra": "x"}) == (
+        "{证明} 张三 于 2024-01-01 入职，张三 月薪 8000 元"
+    )
+    assert compile_template("没有字段").render({}) == "没有字段"
+
+
+def test_render_reports_every_missing_field():
+    compiled = compile_template("{a}{b}{c}")
+    with pytest.raises(MissingFieldsError) as excinfo:
+        compiled.render({"b": "1"})
+    assert excinfo.value.missing == ["a", "c"]
+
+
+def test_compile_reports_every_error_at_once():
+    with pytest.raises(TemplateError) as excinfo:
+        compile_template("{} {0} {user.name} {items[0]} {amount:.2f} {name!r} {undeclared}", fields=["name", "amount"])
+    errors = excinfo.value.errors
+    assert len(errors) == 7
+    assert errors[-1] == "模板中使用了未声明的字段: undeclared"
+
+
+def test_syntax_error_is_chained():
+    with pytest.raises(TemplateError) as excinfo:
+        compile_template("未闭合 {name")
+    assert excinfo.value.errors[0].startswith("模板语法错误")
+    assert isinstance(excinfo.value.__cause__, ValueError)
+
+
+def test_declared_fields_are_optional_at_render():
+    compiled = compile_template("{name}", fields=["name", "department"])
+    assert compiled.fields == ["name"]
+    assert compiled.render({"name": "李四"}) == "李四"
+
+
+async def test_update_template_invalidates_compiled_template(client, auth):
+    template = {"name": "在职证明", "content": "兹证明 {name} 在职"}
+    template_id = (await client.post("/templates", json=template, headers=auth)).json()["data"]["id"]
+
+    async def render(data):
+        return await client.post("/documents", json={"template_id": template_id, "data": data}, headers=auth)
+
+    assert (await render({"name": "王五"})).json()["data"]["content"] == "兹证明 王五 在职"
+    assert await template_cache.get(template_id) is not None
+
+    updated = dict(template, content="兹证明 {name} 自 {date} 起在职")
+    assert (await client.put(f"/templates/{template_id}", json=updated, headers=auth)).status_code == 200
+    assert await template_cache.get(template_id) is None
+
+    response = await render({"name": "王五"})
+    assert response.status_code == 400
+    assert "date" in response.json()["detail"]
+    assert (await render({"name": "王五", "date": "2024-01-01"})).json()["data"]["content"] == (
+        "兹证明 王五 自 2024-01-01 起在职"
+    )
+
+
+async def test_invalid_template_rejected(client, auth):
+    response = await client.post("/templates", json={"name": "坏模板", "content": "{a.b} {c:>5}"}, headers=auth)
+    assert response.status_code == 400
+    assert len(response.json()["detail"].split("; ")) == 2
@@ -0,0 +1,152 @@
+import hashlib
+import os
+from contextlib import asynccontextmanager
+
+import pytest
+
+from app import main
+from app.main import db, upload_store
+from conftest import login
+
+pytestmark = pytest.mark.anyio
+
+
+async def _start(client, auth, size: int) -> str:
+    response = await client.post("/uploads", json={"file_name": "工资条.pdf", "size_bytes": size}, headers=auth)
+    assert response.status_code == 200, response.text
+    assert response.json()["data"]["offset"] == 0
+    return response.json()["data"]["upload_id"]
+
+
+async def test_resumable_upload(client, auth):
+    content = os.urandom(3000)
+    upload_id = await _start(client, auth, len(content))
+
+    for start in range(0, len(content), 1000):
+        response = await client.put(
+            f"/uploads/{upload_id}", params={"offset": start}, content=content[start:start + 1000], headers=auth,
+        )
+        assert response.json()["data"]["offset"] == start + 1000
+    response = await client.post(f"/uploads/{upload_id}/complete", headers=auth)
+    assert response.status_code == 200, response.text
+    attachment = response.json()["data"]
+    assert attachment["content_hash"] == hashlib.sha256(content).hexdigest()
+
+    response = await client.get(f"/attachments/{attachment['file_id']}/content", headers=auth)
+    assert response.content == content
+
+
+async def test_offset_conflict(client, auth):
+    upload_id = await _start(client, auth, 20)
+    await client.put(f"/uploads/{upload_id}", params={"offset": 0}, content=b"0123456789", headers=auth)
+
+    # A retry of the chunk already received, and one skipping ahead
+    for offset in (0, 15):
+        response = await client.put(
+            f"/uploads/{upload_id}", params={"offset": offset}, content=b"0123456789", headers=auth,
+        )
+        assert response.status_code == 409
+        assert response.headers["Upload-Offset"] == "10"
+    response = await client.get(f"/uploads/{upload_id}", headers=auth)
+    assert response.json()["data"]["offset"] == 10
+
+
+async def test_complete_before_all_bytes(client, auth):
+    upload_id = await _start(client, auth, 20)
+    await client.put(f"/uploads/{upload_id}", params={"offset": 0}, content=b"0123456789", headers=auth)
+    response = await client.post(f"/uploads/{upload_id}/complete", headers=auth)
+    assert response.status_code == 409
+
+
+async def test_chunk_beyond_declared_size(client, auth):
+    upload_id = await _start(client, auth, 5)
+    response = await client.put(f"/uploads/{upload_id}", params={"offset": 0}, content=b"0123456789", headers=auth)
+    assert response.status_code == 413
+
+
+async def test_blob_removed_with_last_reference(client, auth):
+    content = os.urandom(64)
+    file_ids = []
+    for _ in range(2):
+        response = await client.post("/upload", files={"file": ("a.bin", content)}, headers=auth)
+        file_ids.append(response.json()["data"]["file_id"])
+    path = upload_store.blob_path(hashlib.sha256(content).hexdigest())
+
+    assert (await client.delete(f"/attachments/{file_ids[0]}", headers=auth)).status_code == 200
+    assert os.path.exists(path)
+    assert (await client.delete(f"/attachments/{file_ids[1]}", headers=auth)).status_code == 200
+    assert not os.path.exists(path)
+
+
+async def test_attachments_private_to_their_owner(client, auth):
+    other = await login(client)
+    response = await client.post("/upload", files={"file": ("私人.pdf", os.urandom(32))}, headers=auth)
+    file_id = response.json()["data"]["file_id"]
+
+    listed = (await client.get("/attachments", headers=auth)).json()["data"]
+    assert [attachment["id"] for attachment in listed] == [file_id]
+    assert (await client.get("/attachments", headers=other)).json()["data"] == []
+    assert (await client.get(f"/attachments/{file_id}/content", headers=other)).status_code == 404
+    assert (await client.delete(f"/attachments/{file_id}", headers=other)).status_code == 404
+    assert (await client.get(f"/attachments/{file_id}/content", headers=auth)).status_code == 200
+
+
+class InsertFailed(Exception):
+    pass
+
+
+class _FailingTransaction:
+    def __init__(self, tx):
+        self.tx = tx
+
+    def __getattr__(self, name):
+        return getattr(self.tx, name)
+
+    async def execute(self, sql, params=()):
+        if "INSERT INTO attachments" in sql and "fail.bin" in params:
+            raise InsertFailed()
+        return await self.tx.execute(sql, params)
+
+
+class _FailingDatabase:
+    """The database, where attachments named fail.bin can't be inserted."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    @asynccontextmanager
+    async def transaction(self, immediate=False):
+        async with self.db.transaction(immediate=immediate) as tx:
+            yield _FailingTransaction(tx)
+
+
+@pytest.fixture
+def failing_insert(monkeypatch):
+    monkeypatch.setattr(main, "db", _FailingDatabase(db))
+
+
+async def test_failed_insert_leaves_no_blob(client, auth, failing_insert):
+    content = os.urandom(64)
+    content_hash = hashlib.sha256(content).hexdigest()
+    partials = set(os.listdir(upload_store.partial_dir))
+    with pytest.raises(InsertFailed):
+        await client.post("/upload", files={"file": ("fail.bin", content)}, headers=auth)
+    assert not os.path.exists(upload_store.blob_path(content_hash))
+    assert await db.fetch_val("SELECT 1 FROM blobs WHERE hash = ?", (content_hash,)) is None
+    assert set(os.listdir(upload_store.partial_dir)) == partials
+
+
+async def test_failed_insert_keeps_a_blob_already_stored(client, auth, failing_insert):
+    content = os.urandom(64)
+    path = upload_store.blob_path(hashlib.sha256(content).hexdigest())
+    response = await client.post("/upload", files={"file": ("ok.bin", content)}, headers=auth)
+    file_id = response.json()["data"]["file_id"]
+
+    with pytest.raises(InsertFailed):
+        await client.post("/upload", files={"file": ("fail.bin", content)}, headers=auth)
+    assert os.path.exists(path)
+    response = await client.get(f"/attachments/{file_id}/content", headers=auth)
+    assert response.content == content
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from app.db import create_database
+from app.writer import GroupCommitWriter
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def database(tmp_path):
+    database = create_database(str(tmp_path / "writer.db"))
+    await database.execute("CREATE TABLE items (value INTEGER NOT NULL CHECK (value >= 0))")
+    yield database
+    await database.close()
+
+
+class Flush:
+    """Inserts each item as a row and records the batches it was handed."""
+
+    def __init__(self):
+        self.batches = []
+
+    async def __call__(self, tx, items):
+        self.batches.append(list(items))
+        await tx.execute_many("INSERT INTO items (value) VALUES (?)", [(item,) for item in items])
+
+
+async def _values(database):
+    return sorted(row["value"] for row in await database.fetch_all("SELECT value FROM items"))
+
+
+async def test_concurrent_submits_share_one_transaction(database):
+    flush = Flush()
+    writer = GroupCommitWriter(database, flush, name="items", max_delay=0.05)
+    writer.start()
+    try:
+        results = await asyncio.gather(*(writer.submit(i) for i in range(20)))
+    finally:
+        await writer.stop()
+
+    assert results == [None] * 20
+    assert [sorted(batch) for batch in flush.batches] == [list(range(20))]
+    assert await _values(database) == list(range(20))
+    stats = writer.stats()
+    assert (stats["batches"], stats["items"], stats["failures"]) == (1, 20, 0)
+
+
+async def test_bad_item_fails_only_its_caller(database):
+    flush = Flush()
+    writer = GroupCommitWriter(database, flush, name="items", max_delay=0.05)
+    writer.start()
+    try:
+        results = await asyncio.gather(*(writer.submit(i) for i in (1, 2, -1, 3)), return_exceptions=True)
+    finally:
+        await writer.stop()
+
+    assert results[:2] == [None, None] and results[3] is None
+    assert isinstance(results[2], Exception)
+    # The shared batch rolled back, then each item was retried on its own
+    assert len(flush.batches) == 5
+    assert await _values(database) == [1, 2, 3]
+    assert writer.stats()["failures"] == 1
+
+
+async def test_stop_commits_queued_items(database):
+    writer = GroupCommitWriter(database, Flush(), name="items", max_delay=10)
+    writer.start()
+    pending = [asyncio.ensure_future(writer.submit(i)) for i in range(3)]
+    await asyncio.sleep(0)
+    await writer.stop()
+    await asyncio.gather(*pending)
+    assert await _values(database) == [0, 1, 2]
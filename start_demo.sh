@@ -12,7 +12,7 @@ fi
 echo "1. 启动后端服务..."
 cd server
 source .venv/bin/activate
-python app/main.py &
+python -m app.main &
 SERVER_PID=$!
 cd ..
 
@@ -25,7 +25,7 @@ echo "3. 测试API连接..."
 cd server
 source .venv/bin/activate
 cd ..
-python test_api.py
+python scripts/benchmark.py --smoke --url http://localhost:8000
 
 if [ $? -eq 0 ]; then
     echo ""
@@ -7,7 +7,7 @@
     - getCurrentUser()
     - logout()
     - listConversations(), createConversation(title), getConversation(id), sendMessage(convId, text)
-    - uploadFile(file), listAttachments()
+    - uploadFile(file), listAttachments(), getAttachmentBlob(fileId)
     - Health check and error handling
 */
 (function(global){
@@ -83,6 +83,10 @@
     },
     
     logout(){
+      if (localStorage.getItem('sh_token')) {
+        // Revoke the token on the server too; the local logout does not wait for it
+        apiRequest('/auth/logout', { method: 'POST' }).catch(() => {});
+      }
       localStorage.removeItem('sh_token');
       localStorage.removeItem('sh_current_user');
     },
@@ -139,6 +143,18 @@
       return response.data || [];
     },
     
+    // Served with ETag/Last-Modified, so repeat views revalidate instead of re-downloading
+    async getAttachmentBlob(fileId){
+      const response = await fetch(`${API_BASE}/attachments/${fileId}/content`, {
+        headers: getAuthHeaders(),
+        cache: 'no-cache'
+      });
+      if (!response.ok) {
+        throw new Error(`Download failed: ${response.statusText}`);
+      }
+      return await response.blob();
+    },
+    
     // Health check
     async healthCheck(){
       return await apiRequest('/health');